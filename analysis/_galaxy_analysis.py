@@ -57,6 +57,22 @@ _all_fields = ['density', 'temperature', 'cell_mass']
 
 __all__ = ['Galaxy']
 
+# top level groups of the saved analysis data (see _map_class_to_output)
+_saved_data_groups = ['meta_data', 'gas_meta_data', 'particle_meta_data', 'time_data',
+                      'gas_profiles', 'particle_profiles', 'observables']
+
+# attributes set by loading the data set (_load_dataset and
+# _construct_dataset_regions). In lazy mode, only these load the data set
+# when accessed - anything else missing raises AttributeError as usual
+_lazy_dataset_attributes = ['ds', 'df', 'current_time', 'species_list', '_has_particles',
+                            'M_vir', 'R_vir',
+                            'disk', 'large_disk', 'stellar_disk', 'sphere', 'halo_sphere',
+                            'disk_region', 'large_disk_region', 'stellar_disk_region',
+                            'spherical_region', 'halo_spherical_region',
+                            '_accumulation_fields', '_projection_fields', '_radiation_fields',
+                            'total_quantities', '_total_quantities_calculated',
+                            'boundary_mass_flux']
+
 
 def load(dsname):
     """
@@ -66,22 +82,112 @@ def load(dsname):
 
 class Galaxy(object):
 
-    def __init__(self, dsname, wdir = './'):
+    def __init__(self, dsname, wdir = './', lazy = False):
         """
         Galaxy object to run full analysis on individual data dumps
         in yt. Defines uniform set of galaxy disk an halo regions, species
         and abundance fields given field list, and functions for running
         a variety of analysis.
+
+        If lazy is True, nothing is loaded on construction. The data set
+        (and everything derived from it, e.g. regions) is loaded the first
+        time any of it is accessed, and each group of saved analysis
+        data (e.g. meta_data) is read from the hdf5 file the first time
+        it is accessed. This makes reading saved products fast.
         """
 
         self.wdir    = wdir
         self.dsname = dsname
 
-        # load, generate fields, reload
-        with util.nooutput(): # silence yt for now
-            self.ds     = yt.load(self.wdir + '/' + self.dsname + '/' + self.dsname)
+        self.hdf5_filename   = self.wdir + '/' + self.dsname + '_galaxy_data.h5'
+
+        self._lazy           = lazy
+        self._dataset_loaded = False
+
+        if lazy:
+            return
+
+        self._load_dataset()
+
+        self.particle_meta_data = {}
+        self.gas_meta_data      = {}
+        self.meta_data          = {}
+        self.gas_profiles       = {}
+        self.particle_profiles  = {}
+        self.time_data          = {}
+        self.observables        = {}
+
+        self._construct_dataset_regions()
+
+        if os.path.isfile( self.hdf5_filename ):
+            self.load()
+
+        return
+
+    def __getattr__(self, name):
+        """
+        Only called when an attribute is not found. In lazy mode, loads
+        the saved data group or the data set that provides it.
+        """
+
+        if name.startswith('__') or (not self.__dict__.get('_lazy', False)):
+            raise AttributeError(name)
+
+        if name in _saved_data_groups:
+            value = self._load_saved_group(name)
+            setattr(self, name, value)
+            return value
+
+        # only load for dataset-backed attributes, and only once (hasattr
+        # checks made while loading must not start another load)
+        if (not (name in _lazy_dataset_attributes)) or\
+           self.__dict__.get('_dataset_loaded', True) or\
+           self.__dict__.get('_dataset_loading', False):
+            raise AttributeError(name)
+
+        self._dataset_loading = True
+        try:
+            self._load_dataset()
+            self._construct_dataset_regions()
+        except Exception:
+            self._dataset_loaded = False
+            raise
+        finally:
+            self._dataset_loading = False
+
+        # saved values take precedence, as in _map_output_to_class
+        if 'R_vir' in self.meta_data.keys():
+            self.R_vir = self.meta_data['R_vir']
+        if 'M_vir' in self.meta_data.keys():
+            self.M_vir = self.meta_data['M_vir']
+
+        return getattr(self, name)
+
+    def _load_saved_group(self, name):
+        """
+        Load a single top level group of the saved analysis data
+        """
 
-        # define fields if they have not yet been defined
+        if not os.path.isfile(self.hdf5_filename):
+            return {}
+
+        with h5py.File(self.hdf5_filename, 'r') as f:
+            if not ((name in f) or (name in f.attrs)):
+                return {} # group not saved
+
+        try:
+            return dd.io.load(self.hdf5_filename, '/' + name)
+        except (KeyError, LookupError):
+            return {}
+
+    def _load_dataset(self):
+        """
+        Load the data set, define derived fields, and set up the
+        properties that depend on the data set
+        """
+
+        # define fields if they have not yet been defined in this process.
+        # Use the most recent output so particle fields are included
         if not fg.FIELDS_DEFINED:
             dfiles = glob.glob(self.wdir + '/' + 'DD????/DD????')
             dfiles = np.sort(dfiles)
@@ -98,11 +204,11 @@ class Galaxy(object):
 
                     break
 
-            fg.generate_derived_fields(dstemp)
-            fg.FIELDS_DEFINED = True
+            fg.define_derived_fields(dstemp)
 
-        # load data set and data
-        self.ds     = fg.load_and_define(self.wdir + '/' + self.dsname + '/' + self.dsname)
+        # load data set (only loaded again if its species need new fields)
+        with util.nooutput(): # silence yt for now
+            self.ds     = fg.load_and_define(self.wdir + '/' + self.dsname + '/' + self.dsname)
         self.current_time = self.ds.current_time.to(UNITS['Time'].units).value
         self.df     = self.ds.all_data()
 
@@ -111,8 +217,6 @@ class Galaxy(object):
         if ('io','particle_position_x') in self.ds.field_list:
             self._has_particles = True
 
-        self.hdf5_filename   = self.wdir + '/' + self.dsname + '_galaxy_data.h5'
-
         self._compute_virial_parameters()
 
         self._set_data_region_properties()
@@ -124,13 +228,14 @@ class Galaxy(object):
         self._set_projection_fields()
         self._set_radiation_fields()
 
-        self.particle_meta_data = {}
-        self.gas_meta_data      = {}
-        self.meta_data          = {}
-        self.gas_profiles       = {}
-        self.particle_profiles  = {}
-        self.time_data          = {}
-        self.observables        = {}
+        self._dataset_loaded = True
+
+        return
+
+    def _construct_dataset_regions(self):
+        """
+        Construct the regions and other data set quantities
+        """
 
         self.construct_regions()
 
@@ -147,9 +252,6 @@ class Galaxy(object):
 
         self._load_boundary_mass_flux() # load directly from parameter file
 
-        if os.path.isfile( self.hdf5_filename ):
-            self.load()
-
         return
 
     def _compute_virial_parameters(self):
@@ -193,6 +295,17 @@ class Galaxy(object):
         Save all of the generated data to file using deepdish.
         This constructs a nested dictionary which is then outputted to file.
         """
+
+        # in lazy mode the existing file has not been read. Start from
+        # what is on disk so that groups that were never accessed, and any
+        # other top level groups in the file, are kept
+        if self._lazy and (not hasattr(self, '_output_data_dict')) and\
+           os.path.isfile(self.hdf5_filename):
+            self._output_data_dict = dd.io.load(self.hdf5_filename)
+            for name in _saved_data_groups:
+                if (not (name in self.__dict__)) and (name in self._output_data_dict):
+                    setattr(self, name, self._output_data_dict[name])
+
         if filename is None:
             filename = self.hdf5_filename
         else:
@@ -397,10 +510,6 @@ class Galaxy(object):
         center = np.array([0.1, 0.2, 0.25, 0.5, 0.75, 1.0, 1.25]) # in units of R_Vir
         dL     = 0.1                           # in units of R_vir
 
-        for field in fields:
-            profile[field] = np.zeros(np.size(center))
-            profile['mass_profile'][field] = np.zeros(np.size(center))
-
         # convert from r_vir to kpc
         center = (center * self.R_vir).to('kpc')
         dL     = (dL     * self.R_vir).to('kpc')
@@ -417,19 +526,31 @@ class Galaxy(object):
         else:
             phase_filter = ISM_FILTER[phase](data)
 
-        for i in np.arange(np.size(center)):
-            # define the shell
-            x_filter = ( xdata >= (center[i] - 0.5*dL)) * ( xdata < (center[i] + 0.5*dL))
+        #
+        # The shells can overlap, so bin once on the sorted set of all shell
+        # edges and build each shell from cumulative sums over those bins.
+        # M and M*v for every field are binned together in one call.
+        #
+        lower = (center - 0.5*dL).value
+        upper = (center + 0.5*dL).value
+        edges = np.unique(np.concatenate([lower, upper]))
 
-            # filter out the data
-            filter = x_filter * v_filter * phase_filter
-            for field in fields:
-                M        = data[field].to(UNITS['Mass'].units)
-                Mdot     = np.sum( M[filter] * vel[filter] ) / dL
-                Mdot     = Mdot.to('Msun/yr')
+        M      = np.array([data[field].to(UNITS['Mass'].units).value for field in fields])
+        values = np.concatenate([M, M * vel.value])
+        sums   = util.binned_field_sums(xdata.to(center.units).value, edges, values,
+                                        mask = v_filter * phase_filter)
+
+        cumulative = np.zeros((np.shape(sums)[0], np.size(edges)))
+        cumulative[:,1:] = np.cumsum(sums, axis = 1)
+        shells = cumulative[:, np.searchsorted(edges, upper)] -\
+                 cumulative[:, np.searchsorted(edges, lower)]
+
+        # sum(M * v) / dL in Msun/yr
+        conversion = (UNITS['Mass'] * UNITS['Velocity'] / dL).to('Msun/yr').value
 
-                profile[field][i] = Mdot
-                profile['mass_profile'][field][i] = np.sum(M[filter])
+        for j, field in enumerate(fields):
+            profile[field] = shells[len(fields) + j] * conversion
+            profile['mass_profile'][field] = shells[j]
 
         #
         # save profiles
@@ -531,15 +652,12 @@ class Galaxy(object):
 
         profiles = {}
 
-        for field in fields:
-            profiles[field] = np.zeros(np.size(xbins)-1)
-
-        for i in np.arange(np.size(xbins)-1):
-            x_filter = (xdata >= xbins[i]) * (xdata < xbins[i+1])
+        # bin all fields at once from a single digitization of the coordinate
+        values = np.array([data[field].to(FIELD_UNITS[field].units).value for field in fields])
+        sums   = util.binned_field_sums(xdata.value, xbins.to(xdata.units).value, values)
 
-            for field in fields:
-                profiles[field][i] = np.sum(\
-                      data[field][x_filter].to(FIELD_UNITS[field].units))
+        for j, field in enumerate(fields):
+            profiles[field] = sums[j]
 
         centers = 0.5 * (xbins[1:] + xbins[:-1])
 
@@ -796,10 +914,16 @@ class Galaxy(object):
         self.gas_meta_data['volume_fractions'] = {}
         self.gas_meta_data['mass_fractions']   = {}
 
-        total_volume = np.sum(self.disk['cell_volume'].to('cm**(3)'))
+        volume_filters = {'Total' : None}
         for crtype in cut_region_names:
-            v = self.disk.cut_region(ISM[crtype])['cell_volume'].to('cm**(3)')
-            self.gas_meta_data['volume_fractions'][crtype] = np.sum(v) / total_volume
+            volume_filters[crtype] = ISM_FILTER[crtype]
+        volumes = util.masked_field_sums(self.disk, [('gas','cell_volume')], volume_filters,
+                                         units = 'cm**(3)')
+
+        total_volume = volumes['Total'][('gas','cell_volume')] * yt.units.cm**3
+        for crtype in cut_region_names:
+            v = volumes[crtype][('gas','cell_volume')] * yt.units.cm**3
+            self.gas_meta_data['volume_fractions'][crtype] = v / total_volume
 
             self.gas_meta_data['mass_fractions'][crtype] = self.gas_meta_data['masses'][crtype]['Total']/\
                                                                self.gas_meta_data['masses']['Disk']['Total']
@@ -836,61 +960,47 @@ class Galaxy(object):
         fields = {'H':'H_total_mass','He':'He_total_mass','Total':'cell_mass','Metals':'metal_mass', 'H2' : 'H2_mass',
                   'HI':'H_p0_mass', 'HII': 'H_p1_mass'}
 
+        for s in self.species_list:
+            fields[s] = ('gas', s + '_Mass')
+
         def _sum_tracked_metals(d): # sum tracked metals species only
             return np.sum([d[k] for k in d.keys() if (not any([k in ['Metals','Total','H','H2','He','HI','HeI','HeII','HeIII','H2I','H2II','HII']]))])
 
-        # do this for the disk ISM regions
-        for crtype in cut_region_names:
-            mdict[crtype] = {}
-            for s in fields:
-                mdict[crtype][s] = np.sum(self.disk.cut_region( ISM[crtype])[fields[s]]).to('Msun')
-
-            for s in self.species_list:
-                mdict[crtype][s] = np.sum(self.disk.cut_region( ISM[crtype])[('gas',s + '_Mass')]).to('Msun')
-            mdict[crtype]['Total Tracked Metals'] = _sum_tracked_metals(mdict[crtype])
+        #
+        # Each region is reduced in a single pass over its data, reading every
+        # field once and summing all species over all phase masks together,
+        # rather than re-evaluating a cut region for every (phase, field) pair
+        #
+        def _add_region_sums(data_source, filters):
+            sums = util.masked_field_sums(data_source, list(fields.values()), filters, units = 'Msun')
+            for name in filters:
+                mdict[name] = {}
+                for s in fields:
+                    mdict[name][s] = sums[name][fields[s]] * yt.units.Msun
+                mdict[name]['Total Tracked Metals'] = _sum_tracked_metals(mdict[name])
+            return
 
-        # now do this for the whole disk
-        mdict['Disk'] = {}
-        for s in fields:
-            mdict['Disk'][s] = np.sum(self.disk[fields[s]]).to('Msun')
-        for s in self.species_list:
-            mdict['Disk'][s] = np.sum(self.disk[('gas',s + '_Mass')]).to('Msun')
-        mdict['Disk']['Total Tracked Metals'] = _sum_tracked_metals(mdict['Disk'])
+        # do this for the whole disk and the disk ISM regions
+        disk_filters = {'Disk' : None}
+        for crtype in cut_region_names:
+            disk_filters[crtype] = ISM_FILTER[crtype]
+        _add_region_sums(self.disk, disk_filters)
 
         # now do this for the halo
-        mdict['Halo'] = {}
-        for s in fields:
-            #print s
-            #print fields[s]
-            #print self.halo_sphere[fields[s]]
-            mdict['Halo'][s] = np.sum(self.halo_sphere[fields[s]]).to('Msun')
-        for s in self.species_list:
-            mdict['Halo'][s] = np.sum(self.halo_sphere[('gas',s + '_Mass')]).to('Msun')
-        mdict['Halo']['Total Tracked Metals'] = _sum_tracked_metals(mdict['Halo'])
+        _add_region_sums(self.halo_sphere, {'Halo' : None})
 
-        # now do this for full box
-        mdict['FullBox'] = {}
-        for s in fields:
-            mdict['FullBox'][s] = np.sum(self.df[fields[s]]).to('Msun')
-        for s in self.species_list:
-            mdict['FullBox'][s] = np.sum(self.df[('gas', s + '_Mass')]).to('Msun')
-        mdict['FullBox']['Total Tracked Metals'] = _sum_tracked_metals(mdict['FullBox'])
+        # now do this for full box, and the gravitationally bound gas IF potential is present
+        box_filters = {'FullBox' : None}
+        if 'PotentialField' in self.ds.field_list or ('enzo','GravPotential') in self.ds.field_list:
+            box_filters['GravBound'] = lambda x : x[('gas','gravitationally_bound')] > 0
+        _add_region_sums(self.df, box_filters)
 
         # now we need to do some subtraction of the fields
         mdict['OutsideHalo'] = {}
-        for s in list(fields.keys()) + self.species_list + ['Total Tracked Metals']:
+        for s in list(fields.keys()) + ['Total Tracked Metals']:
             mdict['OutsideHalo'][s] = mdict['FullBox'][s] - mdict['Halo'][s]
             mdict['Halo'][s]        = mdict['Halo'][s]    - mdict['Disk'][s]
 
-        # now we compute the gravitationally bound gas IF potential is present
-        if 'PotentialField' in self.ds.field_list or ('enzo','GravPotential') in self.ds.field_list:
-            mdict['GravBound'] = {}
-            for s in fields:
-                mdict['GravBound'][s] = np.sum( self.ds.cut_region(self.df, "obj[('gas','gravitationally_bound')] > 0" )[fields[s]]).to('Msun')
-            for s in self.species_list:
-                mdict['GravBound'][s] = np.sum(self.ds.cut_region(self.df, "obj[('gas','gravitationally_bound')] > 0")[('gas', s + '_Mass')]).to('Msun')
-            mdict['GravBound']['Total Tracked Metals'] = _sum_tracked_metals(mdict['GravBound'])
-
         # and finally add up the mass in stars
         mdict['stars'] = {}
         for s in ['H','He'] + self.species_list:
@@ -958,6 +1068,9 @@ class Galaxy(object):
         self.meta_data['Time']  = self.ds.current_time.to(UNITS['Time'].units)
         self.meta_data['dx']    = np.min(self.df['dx'].to(UNITS['Length'].units))
 
+        if 'InitialCycleNumber' in self.ds.parameters:
+            self.meta_data['cycle'] = self.ds.parameters['InitialCycleNumber']
+
         return
 
     def compute_time_evolution(self):
@@ -969,42 +1082,25 @@ class Galaxy(object):
             self.time_data = {}
 
         #
-        # Make a set of SFR and SNR evolutions with default bin spacing (10 Myr)
-        #
-        # x is temp dummy variable
-        self.time_data['time'], self.time_data['SFR'] = pa.sfrFromParticles(self.ds, self.df)
-        x, self.time_data['SFH'] = pa.sfhFromParticles(self.ds, self.df, times=self.time_data['time'])
-        x, self.time_data['SNII_snr'] = pa.snr(self.ds, self.df, times=x, sn_type ='II')
-        x, self.time_data['SNIa_snr'] = pa.snr(self.ds, self.df, times=x, sn_type ='Ia')
-        x, self.time_data['AGB_rate'] = pa.snr(self.ds, self.df, times=x, sn_type = 'AGB')
-
-        self.time_data['time'] = 0.5 * (x[1:] + x[:-1]) # bin centers
-
-        self.meta_data['SFR']  = self.time_data['SFR'][-1]
-
-        #
-        # Make a set of SFR and SNR evolutions with longer bin spacing (100 Myr)
+        # Make a set of SFR and SNR evolutions with default bin spacing (10 Myr),
+        # longer bin spacing (100 Myr), and very short bin spacing (1 Myr).
+        # Particle formation / explosion times are sorted only once for all
         #
-        self.time_data['time_100'], self.time_data['SFR_100'] = pa.sfrFromParticles(self.ds, self.df, times = 100.0 * yt.units.Myr)
-        x, self.time_data['SFH_100'] = pa.sfhFromParticles(self.ds, self.df, times=self.time_data['time_100'])
-        x, self.time_data['SNII_snr_100'] = pa.snr(self.ds, self.df ,times=x, sn_type ='II')
-        x, self.time_data['SNIa_snr_100'] = pa.snr(self.ds, self.df ,times=x, sn_type ='Ia')
+        rates = pa.rates_from_particles(self.ds, self.df,
+                                        bin_spacings = [None, 100.0 * yt.units.Myr, 1.0 * yt.units.Myr])
 
-        self.time_data['time_100'] = 0.5 * (x[1:] + x[:-1]) # bin centers
+        for suffix, r in zip(['', '_100', '_1'], rates):
+            fields = ['SFR', 'SFH', 'SNII_snr', 'SNIa_snr']
+            if suffix == '':
+                fields = fields + ['AGB_rate']
 
-        self.meta_data['SFR_100']  = self.time_data['SFR_100'][-1]
-
-        #
-        # Make a set of SFR and SNR evolutions with very short bin spacing (1 Myr)
-        #
-        self.time_data['time_1'], self.time_data['SFR_1'] = pa.sfrFromParticles(self.ds, self.df, times = 1.0 * yt.units.Myr)
-        x, self.time_data['SFH_1'] = pa.sfhFromParticles(self.ds, self.df, times=self.time_data['time_1'])
-        x, self.time_data['SNII_snr_1'] = pa.snr(self.ds, self.df ,times=x, sn_type ='II')
-        x, self.time_data['SNIa_snr_1'] = pa.snr(self.ds, self.df ,times=x, sn_type ='Ia')
+            for field in fields:
+                self.time_data[field + suffix] = r[field]
 
-        self.time_data['time_1'] = 0.5 * (x[1:] + x[:-1]) # bin centers
+            x = r['times']
+            self.time_data['time' + suffix] = 0.5 * (x[1:] + x[:-1]) # bin centers
 
-        self.meta_data['SFR_1']  = self.time_data['SFR_1'][-1]
+            self.meta_data['SFR' + suffix]  = self.time_data['SFR' + suffix][-1]
 
 
 
@@ -1157,31 +1253,38 @@ class Galaxy(object):
             data = self.stellar_disk
 
         if pt is None:
-            particle_filter = [True] * np.size(data['particle_type'])
+            particle_filter = np.ones(np.size(data['particle_type']), dtype = bool)
         else:
             particle_filter = data['particle_type'] == pt
 
-        profiles = {}
+        # stack all fields so every profile comes from a single binning call
+        values = []
         for field in fields:
-            profiles[field] = np.zeros(np.size(xbins) - 1)
+            field_data = data[field]
 
-        for field in fields:
-            for i in np.arange(np.size(xbins)-1):
-                x_filter   = (x < xbins[i]) * (x >= xbins[i-1])
-                filter     = x_filter * particle_filter
-
-                field_data = data[field][filter]
-
-                if field in UNITS:
-                    field_data = field_data.to(FIELD_UNITS[field].units)
-
-                if accumulate:
-                    profiles[field][i] = np.sum( field_data )
-                elif weight_field is None:
-                    profiles[field][i] = np.average( field_data )
-                else:
-                    weights = data[weight_field][filter]
-                    profiles[field][i] = np.average( field_data, weights = weights)
+            if field in UNITS:
+                field_data = field_data.to(FIELD_UNITS[field].units)
+
+            values.append(np.asarray(field_data))
+        values = np.array(values).reshape(len(fields), np.size(x))
+
+        if accumulate:
+            sums = util.binned_field_sums(x.value, xbins.value, values, mask = particle_filter)
+        else:
+            if weight_field is None:
+                weights = np.ones(np.size(x))
+            else:
+                weights = np.asarray(data[weight_field])
+
+            sums = util.binned_field_sums(x.value, xbins.value,
+                                          np.concatenate([values * weights, [weights]]),
+                                          mask = particle_filter)
+            with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                sums = sums[:-1] / sums[-1] # empty bins are NaN, as with np.average
+
+        profiles = {}
+        for j, field in enumerate(fields):
+            profiles[field] = sums[j]
 
         #
         # save profiles
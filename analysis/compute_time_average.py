@@ -5,14 +5,49 @@ import deepdish as dd
 import numpy as np
 
 import glob
+import functools
+from multiprocessing import Pool
 
 from galaxy_analysis.utilities import utilities as util
 
+def _field_path_string(field_path):
+    """
+    Convert a field path (list of keys, or a single string key) into
+    a string path with a leading '/'
+    """
+
+    if isinstance(field_path, str):
+        if field_path[0] != '/':
+            field_path = '/' + field_path
+    else:
+        field_path = "/" + "/".join([str(x) for x in field_path])
+
+    return field_path
+
+def _load_field(d, field_path, index = None):
+    """
+    Read only `field_path` from the output file `d`, falling back to
+    loading the whole file for paths deepdish cannot address
+    (e.g. tuple keys). deepdish raises a NoSuchNodeError (a LookupError)
+    for these.
+    """
+
+    try:
+        y = dd.io.load(d, _field_path_string(field_path))
+    except LookupError:
+        y = util.extract_nested_dict(dd.io.load(d), field_path)
+
+    if not (index is None):
+        y = y[index]
+
+    return y
+
 def compute_time_average(field_path,
                          dir = '.', tmin = None, tmax = None,
                          times = None, data_list = None,
                          self_contained = False, sc_data = None, index = None,
-                         x_field = 'xbins', return_quartiles = False):
+                         x_field = 'xbins', return_quartiles = False,
+                         nproc = 1):
     """
     Computes the time average of some quantity pre-computed for a given
     set of simulations dumps using the galaxy analysis framework. The quantity
@@ -24,6 +59,11 @@ def compute_time_average(field_path,
     Additionally computes the min, max, and standard deviation over the averaging
     time.
 
+    Only the requested `field_path` is read from each file, and the
+    statistics are accumulated as each file is read. Reads can be done
+    on a pool of `nproc` processes (not threads, as deepdish / PyTables
+    is not thread safe).
+
     If self_contained is true, then the data is all contained in a single
     file, rather than one file per output. This is currently a hacky way
     to handle this, but it works. If self_contained is true, then
@@ -51,8 +91,7 @@ def compute_time_average(field_path,
             for i, d in enumerate(data_list):
                 times[i] = sc_data[d]['general']['Time']
         else:
-            for i, d in enumerate(data_list):
-                times[i] = dd.io.load(d, '/meta_data/Time')
+            times = util.output_times(data_list)
 
     # now select which data sets to average
     if tmin is None and tmax is None:
@@ -64,39 +103,39 @@ def compute_time_average(field_path,
     else:
         avg_data_list = data_list[(times<tmax)*(times>=tmin)]
 
-    # now load all fields, avg, compute min and max
-    if self_contained:
-        temp = sc_data[avg_data_list[0]]
-    else:
-        temp = dd.io.load(avg_data_list[0])
+    # read only the requested path from each output
+    def _load(d, path):
+        if self_contained:
+            return util.extract_nested_dict(sc_data[d], path)
 
-    sum  = util.extract_nested_dict(temp, field_path)
-    if not (index is None):
-        sum = sum[index]
-    min  =  np.inf * np.ones(np.size(sum))
-    max  = -1 * min
-    std  = 0.0 * sum
+        return _load_field(d, path)
 
-    del(temp)
+    def _load_y(d):
+        y = _load(d, field_path)
+        if not (index is None):
+            y = y[index]
+        return y
 
-    s0 = 0
-    s2 = 0.0 * std
-    avg = 0.0 * sum
-    M2  = 0.0 * sum
-    store_profiles = [None] * np.size(avg_data_list)
+    n    = np.size(avg_data_list)
+    s0   = 0
 
-    for i,d in enumerate(avg_data_list):
-        if self_contained:
-            data = sc_data[ d ]
-        else:
-            data = dd.io.load(d)
+    if nproc > 1 and not self_contained:
+        pool   = Pool(nproc)
+        loaded = pool.imap(functools.partial(_load_field, field_path = field_path,
+                                             index = index), avg_data_list)
+    else:
+        pool   = None
+        loaded = map(_load_y, avg_data_list)
 
-        y    = util.extract_nested_dict(data, field_path)
-        if not (index is None):
-            y = y[index]
+    for i, y in enumerate(loaded):
+        if i == 0:
+            min   =  np.inf * np.ones(np.size(y))
+            max   = -1 * min
+            avg   = 0.0 * y
+            M2    = 0.0 * y
+            all_y = np.zeros( (n,) + np.shape(y) )
 
-        sum += y
-        store_profiles[i] = y
+        all_y[i] = y
 
         min  = np.min( [y,min], axis=0)
         max  = np.max( [y,max], axis=0)
@@ -106,26 +145,27 @@ def compute_time_average(field_path,
         avg   += delta /(1.0 * s0)
         M2    += delta*(y - avg)
 
-    std = np.sqrt( M2 / (1.0*(s0 - 1)))
+    if not (pool is None):
+        pool.close()
+        pool.join()
 
-    avg = sum / (1.0 * s0)
+    std = np.sqrt( M2 / (1.0*(s0 - 1)))
 
-    q1  = np.percentile(np.array(store_profiles), 25, axis = 0)
-    q2  = np.percentile(np.array(store_profiles), 50, axis = 0)
-    q3  = np.percentile(np.array(store_profiles), 75, axis = 0)
+    q1, q2, q3 = np.percentile(all_y, [25, 50, 75], axis = 0)
 
     if np.size(avg) > 0 and (not (x_field is None)):
+        d = avg_data_list[-1]
         try:
             temp_field_path     = list(field_path)
             temp_field_path[-1] = x_field
             print(temp_field_path)
-            x = util.extract_nested_dict(data, temp_field_path)
+            x = _load(d, temp_field_path)
         except:
             try:
                 temp_field_path = list(field_path)
                 del(temp_field_path[-1])
                 temp_field_path[-1] = x_field
-                x = util.extract_nested_dict(data, temp_field_path)
+                x = _load(d, temp_field_path)
             except:
                 print(field_path)
                 print(("x_field not found in current layer or above layer", x_field))
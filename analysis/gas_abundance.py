@@ -1,6 +1,20 @@
 SKIP_ABUNDANCES = False
 ABUNDANCE_DENOM = ['H','Fe','O','Mg']
 
+# number of fields whose radial profiles are computed together
+RADIAL_PROFILE_BLOCK_SIZE = 16
+
+# suffix of output groups that are still being written
+_INCOMPLETE_SUFFIX = '_incomplete'
+
+# The output file (gas_abundances.h5) is written with h5py, one group per
+# output (see _write_stats_group), and is marked with this layout version
+# in its root attributes. Files written with deepdish by older versions
+# can still be read with load_all_stats, but cannot be added to and must
+# be regenerated with generate_all_stats(..., overwrite = True)
+_LAYOUT_ATTRIBUTE = 'gas_abundance_layout'
+_LAYOUT_VERSION   = 2
+
 # do the following to limit computation a lot
 NONEQFIELDS     = None
 METALS          = ["N","O","Mg","Fe","Ba"]
@@ -28,13 +42,15 @@ import deepdish as dd
 from multiprocessing import Pool
 from contextlib import closing
 import itertools
+import functools
 
 
 # --- internal ---
 from galaxy_analysis import Galaxy
 from galaxy_analysis.utilities import utilities as utilities
 from galaxy_analysis.utilities import functions
-from galaxy_analysis.static_data import ISM
+from galaxy_analysis.utilities import task_runner
+from galaxy_analysis.static_data import ISM, ISM_FILTER
 
 
 #
@@ -124,8 +140,55 @@ _mask_ls    = {'star_forming' : '-',
                'Disk'         : '-'}
 
 
+class _CachedFields(object):
+    """
+    Thin wrapper around a yt data source that reads (and derives) each
+    field only once, keeping the resulting array in memory so it can be
+    shared by every mask applied to that data source.
+    """
+
+    def __init__(self, data_source):
+        self.data_source = data_source
+        self._fields     = {}
+
+    def __getitem__(self, field):
+        if not (field in self._fields):
+            self._fields[field] = self.data_source[field]
+        return self._fields[field]
+
+def _shared_mask_sources(galaxy, names):
+    """
+    Data sources and masks for each of the standard masks, sharing a
+    single field cache for the disk and one for the halo. Phase masks
+    are boolean cuts on the cached disk arrays (ISM_FILTER) rather than
+    separate yt cut regions.
+    """
+
+    disk = _CachedFields(galaxy.disk)
+    halo = _CachedFields(galaxy.halo_sphere)
+
+    sources = {}
+    for name in names:
+        if name == 'Disk':
+            sources[name] = (disk, np.ones(np.shape(disk['x'])))
+        elif name == 'halo':
+            sources[name] = (halo, halo['spherical_radius'] > galaxy.disk.radius)
+        elif name == 'star_forming':
+            sources[name] = (disk, disk[('gas','is_star_forming')])
+        else:
+            sources[name] = (disk, ISM_FILTER[name](disk))
+
+    return sources
+
 def compute_stats_all_masks(galaxy, fraction_fields = None, 
-                                    abundance_fields = None, combine_fields = None):
+                                    abundance_fields = None, combine_fields = None,
+                                    shared_fields = True):
+    """
+    Compute abundance statistics for each of the standard masks. If
+    `shared_fields` is True (default), disk and halo fields are read once
+    and shared by all masks. Otherwise, each mask is its own yt data
+    source and re-reads every field.
+    """
 
     # define the standard masks, then compute things for all of them
     all_masks   = {
@@ -138,15 +201,96 @@ def compute_stats_all_masks(galaxy, fraction_fields = None,
                    'Molecular' : _molecular,
                    'Disk'   : _disk}
 
+    if shared_fields:
+        sources = _shared_mask_sources(galaxy, all_masks.keys())
+
     data = {}
     for m in all_masks.keys():
-        data_source, mask = all_masks[m](galaxy)
+        if shared_fields:
+            data_source, mask = sources[m]
+        else:
+            data_source, mask = all_masks[m](galaxy)
+
         data[m] = compute_abundance_stats(galaxy.ds,
                                           data_source, mask, fraction_fields,
                                           abundance_fields, combine_fields=combine_fields)
 
     return data
 
+def _radial_profiles(field_data, weights, r_index, nr, bins, min_number = 3):
+    """
+    Weighted radial profiles for a block of fields that share the same
+    value bins. For each field and each radial bin, computes the weighted
+    histogram mode and the `compute_weighted_stats` statistics of the
+    cells in that bin. All fields in the block are handled together:
+    one 2D (radius x value) weighted histogram through a single bincount
+    and one sort for all of the statistics.
+
+    Parameters
+    ----------
+    field_data : list of arrays
+        Field values for each field, all for the same set of cells
+    weights : array
+        Weight of each cell
+    r_index : integer array
+        Radial bin index of each cell (cells outside 0 <= r_index < nr
+        are ignored)
+    nr : int
+        Number of radial bins
+    bins : array
+        Value bin edges for the histograms
+    min_number : int, optional
+        Radial bins with fewer than this many cells are set to NaN.
+        Default : 3
+
+    Returns
+    -------
+    profiles : list of dicts
+        One dictionary per field with arrays of size nr for each statistic
+        and for the histogram 'mode'
+    """
+
+    nfields  = len(field_data)
+    ncells   = np.size(weights)
+    nbins    = np.size(bins) - 1
+    centers  = 0.5 * (bins[1:] + bins[:-1])
+
+    values   = np.concatenate(field_data)
+    w        = np.tile(weights, nfields)
+    segments = np.repeat(np.arange(nfields), ncells) * nr + np.tile(r_index, nfields)
+
+    select   = np.tile((r_index >= 0) * (r_index < nr), nfields)
+    values   = values[select]
+    w        = w[select]
+    segments = segments[select]
+
+    stats    = utilities.segmented_weighted_stats(values, segments, nfields*nr, w)
+    number   = np.bincount(segments, minlength = nfields*nr)
+
+    # 2D weighted histogram in (field, radius) x value. Matches np.histogram
+    # binning: last bin is closed on the right, out-of-range values dropped
+    v_index  = np.searchsorted(bins, values, side = 'right') - 1
+    v_index[values == bins[-1]] = nbins - 1
+    select   = (v_index >= 0) * (v_index < nbins)
+    hist     = np.bincount(segments[select] * nbins + v_index[select],
+                           weights = w[select], minlength = nfields*nr*nbins)
+    mode     = centers[np.argmax(hist.reshape(nfields*nr, nbins), axis = 1)]
+
+    empty    = number < min_number
+    mode[empty] = np.nan
+    for k in stats:
+        stats[k][empty] = np.nan
+
+    profiles = []
+    for i in np.arange(nfields):
+        profile = {}
+        for k in stats:
+            profile[k] = stats[k][i*nr:(i+1)*nr]
+        profile['mode'] = mode[i*nr:(i+1)*nr]
+        profiles.append(profile)
+
+    return profiles
+
 def compute_abundance_stats(ds, data_source, mask = None,
                                 fraction_fields = None,
                                 abundance_fields = None,
@@ -206,6 +350,28 @@ def compute_abundance_stats(ds, data_source, mask = None,
     total_volume = np.sum(cv.value) * cv.unit_quantity * 1.0     # total volume of masked cells
     total_mass   = np.sum(cm.value) * cm.unit_quantity * 1.0     # total mass   of masked cells
 
+    # digitize the radial position of each cell once, shared by all fields
+    if not mask_empty:
+        r_cyl   = data_source['cylindrical_radius'][mask].to('pc').value
+        r_index = np.digitize(r_cyl, rbins.to('pc').value) - 1
+
+    radial_blocks = {'fbins' : {'bins' : fbins, 'fields' : [], 'data' : []},
+                     'abins' : {'bins' : abins, 'fields' : [], 'data' : []}}
+
+    def _flush_radial_block(block):
+        if len(block['fields']) == 0:
+            return
+
+        profiles = _radial_profiles(block['data'], cm.value, r_index,
+                                    np.size(rbins) - 1, block['bins'])
+
+        for field, profile in zip(block['fields'], profiles):
+            data_dict['radial_profile'][field] = profile
+
+        block['fields'] = []
+        block['data']   = []
+        return
+
     all_fields = None
     if not (fraction_fields is None):
         all_fields = fraction_fields
@@ -272,7 +438,6 @@ def compute_abundance_stats(ds, data_source, mask = None,
         else:
 
             fdata = data_source[field][mask]
-            r_cyl = data_source['cylindrical_radius'][mask]
 
             # compute the histograms of the data
             mass_hist, temp = np.histogram(fdata.value, weights = cm.value, bins = bins) / total_mass.value
@@ -288,33 +453,21 @@ def compute_abundance_stats(ds, data_source, mask = None,
             data_dict['mass_fraction'][field]['mode'] = centers[np.argmax(mass_hist)]
 
             # save these into the dictionary
-            data_dict['radial_profile'][field] = {} # and set up rprof
             for k in stats:
                 data_dict['volume_fraction'][field][k] = stats[k]
                 data_dict['mass_fraction'][field][k]   = stats2[k]
 
-                # set up radial profile bins
-                data_dict['radial_profile'][field][k]  = np.zeros(np.size(rbins)-1)
-            data_dict['radial_profile'][field]['mode'] = np.zeros(np.size(rbins)-1)
+            # queue up the radial profile (mass weighted ONLY), done
+            # together for blocks of fields sharing the same bins
+            block = radial_blocks['abins' if 'over' in field else 'fbins']
+            block['fields'].append(field)
+            block['data'].append(fdata.value)
 
-            # now compute the radial profile - mass weighted ONLY
-            for i in np.arange(np.size(rbins)-1):
-                selection = (r_cyl >= rbins[i]) * (r_cyl < rbins[i+1])
-                x         = fdata[selection] # sub-select field
-                w         = cm[selection]    #
+            if len(block['fields']) >= RADIAL_PROFILE_BLOCK_SIZE:
+                _flush_radial_block(block)
 
-                if np.size(x) >= 3:
-                    hist, temp = np.histogram(x, weights = w, bins = bins)
-
-                    stats     = utilities.compute_weighted_stats(x, w, return_dict = True)
-                    for k in stats:
-                        data_dict['radial_profile'][field][k][i] = stats[k]
-                    data_dict['radial_profile'][field]['mode'][i] = centers[np.argmax(hist)]
-
-                else:
-                    for k in stats:
-                        data_dict['radial_profile'][field][k][i] = None
-                    data_dict['radial_profile'][field]['mode'][i] = None
+    for key in radial_blocks:
+        _flush_radial_block(radial_blocks[key])
 
     #
     # general properties
@@ -385,198 +538,172 @@ def _parallel_loop(dsname, fraction_fields):
 
     return dictionary
 
-def _parallel_loop_star(combined):
-    return _parallel_loop(*combined)
-
-def generate_all_stats(outfile = 'gas_abundances.h5',
-                        dir = './abundances/', overwrite=False, nproc = 1,
-                        output_interval = None):
+def _write_stats_group(hf, groupname, group_data):
     """
-    For all data files, generate gas abundance statistics for all
-    element fractions and abundance ratios (as defined below). This is
-    an expensive operation.
-
-
+    Write the statistics for a single output to its own group. The group
+    is written under a temporary name and only renamed once complete, so
+    an interrupted write never looks like a finished output.
     """
 
-    if not os.path.exists(dir):
-        os.makedirs(dir)
-
-    hdf5_filename = dir + outfile
-
-    if not os.path.isfile(hdf5_filename) or overwrite:
-        hf = h5py.File(hdf5_filename, 'w')
-        hf.close()
-
-    # set to some large number if needed and not set
-    if (nproc > 1) and (output_interval is None):
-        output_interval = 9999
+    tmpname = groupname + _INCOMPLETE_SUFFIX
+    if tmpname in hf:
+        del hf[tmpname]
 
-    hf = dd.io.load(hdf5_filename)
+    utilities.save_dict_to_hdf5_group(hf, tmpname, group_data)
+    hf.move(tmpname, groupname)
+    hf.flush()
 
-    ds_list = np.sort( glob.glob('./DD???0/DD???0') + glob.glob('./DD???2/DD???2') + glob.glob('./DD???4/DD???4') +\
-                       glob.glob('./DD???6/DD???6') + glob.glob('./DD???8/DD???8'))
-
-    print("WARNING: Only doing limited number of outputs for ease of use")
-
-    for i, dsname in enumerate(ds_list):
-        ds = yt.load(dsname)
-        if ds.parameters['NumberOfParticles'] > 0:
-            start_index = i
-            del(ds)
-            break
-        del(ds)
+    return
 
-    times = np.zeros(np.size(ds_list))
-    ds_list = ds_list[start_index:]
-    times   = times[start_index:]
+def _save_field_names(hf, dsname):
+    """
+    Save the species and abundance field names used (if not already saved)
+    """
 
-    # get the fields
-    ds = yt.load(ds_list[0])
-    metals = utilities.species_from_fields(ds.field_list)
+    if all( [y in hf for y in ['species','metal_species','abundance_fields']]):
+        return
 
-    # additional fraction fields for the non-equillibrium chemistry species
-    if NONEQFIELDS is None:
-        fraction_fields = ['H_p0_fraction','H_p1_fraction','He_p0_fraction',
-                           'He_p1_fraction','He_p2_fraction','H2_fraction']
+    gal = Galaxy(dsname)
+    if ABUNDANCES is None:
+        abundance_fields = utilities.abundance_ratios_from_fields(gal.ds.derived_field_list,
+                                                                  select_denom = ABUNDANCE_DENOM)
     else:
-        fraction_fields = NONEQFIELDS
-
-    if not (METALS is None):
-        metals = METALS
-
-    for m in metals:
-        fraction_fields += [m + '_Fraction']
-
-    # make the abundance ratio fields
-    #   - should do everything over H
-    #   - should do everything over Fe
-    #   - should do everything over Mg
-
-    # loop through all data files
-    if nproc == 1:
-        for i, dsname in enumerate(ds_list):
-            print(i, dsname)
-            groupname = dsname.rsplit('/')[1]
-            gal = Galaxy(groupname)
-
-            # if first loop, define the fields
-            if i == 0:
-                # limit ourselves to Fe and H demoninators for now to speed up computation
-                if ABUNDANCES is None:
-                    abundance_fields = utilities.abundance_ratios_from_fields(gal.ds.derived_field_list,
-                                                                          select_denom = ABUNDANCE_DENOM)
-                else:
-                    abundance_fields = ABUNDANCES
+        abundance_fields = ABUNDANCES
+    species = utilities.species_from_fields(gal.ds.field_list,include_primordial=True)
+    metal_species = utilities.species_from_fields(gal.ds.field_list)
 
-                species = utilities.species_from_fields(gal.ds.field_list,include_primordial=True)
-                metal_species = utilities.species_from_fields(gal.ds.field_list)
+    for name, value in [('species', species), ('metal_species', metal_species),
+                        ('abundance_fields', abundance_fields)]:
+        if not (name in hf):
+            hf.create_dataset(name, data = np.array(value).astype('S'))
 
-            # don't recompute things unless overwrite is set
-            if groupname in hf.keys() and (not overwrite):
-                continue
+    hf.flush()
+    del(gal)
 
-            hf[groupname] = {} # make an empty key for this group
-            g = hf[groupname]
+    return
 
-            g['general'] = {}
-            g['general']['Time']    = gal.ds.current_time.convert_to_units('Myr').value
+def _is_old_layout(hf):
+    """
+    True if an open, non-empty output file was written with deepdish
+    (by older versions of generate_all_stats)
+    """
+    return (not (_LAYOUT_ATTRIBUTE in hf.attrs)) and (len(hf.keys()) > 0)
 
-            # generalized function to loop through all mask types and compute stats
-            gas_data  = compute_stats_all_masks(gal, fraction_fields  = fraction_fields,
-                                              abundance_fields = abundance_fields)
+def load_all_stats(filename):
+    """
+    Load the full output of `generate_all_stats` into a nested dictionary.
+    Files in the older deepdish layout are loaded with deepdish.
+    """
 
-            # make the stats group and the histogram group
-            for k in gas_data.keys():
-                g[k] = gas_data[k]
+    with h5py.File(filename, 'r') as hf:
+        if _is_old_layout(hf):
+            all_data = None
+        else:
+            all_data = utilities.load_dict_from_hdf5_group(hf)
 
-            del(gal)
+    if all_data is None:
+        all_data = dd.io.load(filename)
 
+    return all_data
 
-        # save field names
-        if not ('species' in hf.keys()):
-            hf['species']          = species
-        if not ('metal_species' in hf.keys()):
-            hf['metal_species']    = metal_species
-        if not ('abundance_fields' in hf.keys()):
-            hf['abundance_fields'] = abundance_fields
+def generate_all_stats(outfile = 'gas_abundances.h5',
+                        dir = './abundances/', overwrite=False, nproc = 1,
+                        output_interval = None):
+    """
+    For all data files, generate gas abundance statistics for all
+    element fractions and abundance ratios (as defined below). This is
+    an expensive operation.
 
-    else: # parallel
+    Outputs are computed on a single pool of nproc workers, and each is
+    written to its own group (named DDxxxx) as soon as it is computed.
+    Outputs that already have a group are skipped (unless overwrite is
+    True), so a crashed run can be resumed at the cost of only the
+    outputs that were in progress. Existing files in the older deepdish
+    layout raise a ValueError unless overwrite is True. output_interval
+    is no longer used and is kept for backwards compatability.
+    """
 
-        # select out data sets that already exist in output
-        if not overwrite:
-            ds_list = [x for x in ds_list if ( not any( [x.rsplit('/')[1] in y for y in hf.keys() ]))]
+    if not os.path.exists(dir):
+        os.makedirs(dir)
 
-        # construct the pool, and map the results to a holder
-        #   pool splits computation among processors
+    hdf5_filename = dir + outfile
 
-        def _check_if_fields_saved(dsname,dataset):
+    if not os.path.isfile(hdf5_filename) or overwrite:
+        hf = h5py.File(hdf5_filename, 'w')
+    else:
+        hf = h5py.File(hdf5_filename, 'a')
 
-            if not all( [y in dataset.keys() for y in ['species','metal_species','abundance_fields']]):
+        if _is_old_layout(hf):
+            hf.close()
+            print(hdf5_filename + " was written with deepdish by an older version and cannot be " +\
+                  "added to. Regenerate it with generate_all_stats(..., overwrite = True)")
+            raise ValueError
 
-              gal = Galaxy(dsname)
-              if ABUNDANCES is None:
-                  abundance_fields = utilities.abundance_ratios_from_fields(gal.ds.derived_field_list,
-                                                                        select_denom = ABUNDANCE_DENOM)
-              else:
-                  abundance_fields = ABUNDANCES
-              species = utilities.species_from_fields(gal.ds.field_list,include_primordial=True)
-              metal_species = utilities.species_from_fields(gal.ds.field_list)
+    hf.attrs[_LAYOUT_ATTRIBUTE] = _LAYOUT_VERSION
 
-              # save field names
-              if not ('species' in dataset.keys()):
-                  dataset['species']          = species
-              if not ('metal_species' in dataset.keys()):
-                  dataset['metal_species']    = metal_species
-              if not ('abundance_fields' in dataset.keys()):
-                  dataset['abundance_fields'] = abundance_fields
+    try:
+        # remove anything left over from an interrupted write
+        for k in list(hf.keys()):
+            if k.endswith(_INCOMPLETE_SUFFIX):
+                del hf[k]
 
-              del(gal)
-              return
+        ds_list = np.sort( glob.glob('./DD???0/DD???0') + glob.glob('./DD???2/DD???2') + glob.glob('./DD???4/DD???4') +\
+                           glob.glob('./DD???6/DD???6') + glob.glob('./DD???8/DD???8'))
 
+        print("WARNING: Only doing limited number of outputs for ease of use")
 
-        #
-        # do this in a loop, so we can save progressively once a full set of processors is complete
-        #   saves you if there is a crash (kinda). This way we do better memory management if
-        #   operating on many large datasets.
-        #
-        iter_count = 0
-        for sub_list in itertools.zip_longest(*(iter(ds_list),) * nproc):
+        for i, dsname in enumerate(ds_list):
+            ds = yt.load(dsname)
+            if ds.parameters['NumberOfParticles'] > 0:
+                start_index = i
+                del(ds)
+                break
+            del(ds)
 
-            sub_list = list(sub_list)
-            sub_list = [s for s in sub_list if s is not None] # remove None values
-            reduced_nproc = np.min( [len(sub_list), nproc] )  # only run on needed processors
+        times = np.zeros(np.size(ds_list))
+        ds_list = ds_list[start_index:]
+        times   = times[start_index:]
 
-            pool = Pool(reduced_nproc)
-            results = pool.map_async(_parallel_loop_star,
-                                      zip(sub_list, itertools.repeat(fraction_fields)))
-            pool.close() # no more processes
-            pool.join()  # wait and join running processes
+        # get the fields
+        ds = yt.load(ds_list[0])
+        metals = utilities.species_from_fields(ds.field_list)
 
-            # gather results and add to output
-            for r in results.get():
-                hf[list(r.keys())[0]] = r[list(r.keys())[0]]
+        # additional fraction fields for the non-equillibrium chemistry species
+        if NONEQFIELDS is None:
+            fraction_fields = ['H_p0_fraction','H_p1_fraction','He_p0_fraction',
+                               'He_p1_fraction','He_p2_fraction','H2_fraction']
+        else:
+            fraction_fields = NONEQFIELDS
 
-            # save output!
-            if not (iter_count % output_interval):
-                _check_if_fields_saved(ds_list[0].split('/')[1], hf)
-                dd.io.save(hdf5_filename,hf)
+        if not (METALS is None):
+            metals = METALS
 
-            del(results)
-            iter_count = iter_count + 1
+        for m in metals:
+            fraction_fields += [m + '_Fraction']
 
+        # make the abundance ratio fields
+        #   - should do everything over H
+        #   - should do everything over Fe
+        #   - should do everything over Mg
 
-        # define these fields (which are defined in the Pool funtion but don't want to
-        # deal with passing this back) ------
-        if len(ds_list) > 0:
+        # save field names
+        _save_field_names(hf, ds_list[0].split('/')[1])
 
-            _check_if_fields_saved(ds_list[0].split('/')[1], hf)
+        # select out data sets that already exist in output (only checks
+        # group names - nothing is loaded)
+        if not overwrite:
+            ds_list = [x for x in ds_list if not (x.rsplit('/')[1] in hf)]
 
+        # loop through all data files, writing each as it completes
+        def _write_result(result):
+            groupname = list(result.keys())[0]
+            _write_stats_group(hf, groupname, result[groupname])
+            return
 
-    #
-    # Output
-    #
-    dd.io.save(hdf5_filename, hf)
+        task_runner.run_tasks(functools.partial(_parallel_loop, fraction_fields = fraction_fields),
+                              ds_list, nproc = nproc, callback = _write_result)
+    finally:
+        hf.close()
 
     return
 
@@ -589,7 +716,7 @@ def plot_gas_fractions(dir = './abundances/', fname = 'gas_abundances.h5', overw
 
     # for each dataset, plot the distributions of gas fractions in each phase
 
-    all_data = dd.io.load(dir + fname)
+    all_data = load_all_stats(dir + fname)
 
     plot_fields = all_data['metal_species']
     nplots      = len(plot_fields)
@@ -649,7 +776,7 @@ def plot_abundances(plot_type = 'standard', dir = './abundances/', fname = 'gas_
 
     # for each dataset, plot the distributions of gas fractions in each phase
 
-    all_data   = dd.io.load(dir + fname)
+    all_data   = load_all_stats(dir + fname)
     all_fields = all_data['abundance_fields']
 
     if plot_type == 'standard' or plot_type == 'Fe':
@@ -727,7 +854,7 @@ def plot_time_evolution(dir = './abundances/', fname = 'gas_abundances.h5',
 
     # for each dataset, plot the distributions of gas fractions in each phase
 
-    all_data   = dd.io.load(dir + fname)
+    all_data   = load_all_stats(dir + fname)
     all_fields = all_data['abundance_fields']
 
     share_axis = False
@@ -892,7 +1019,7 @@ def plot_time_evolution(dir = './abundances/', fname = 'gas_abundances.h5',
 def collate_to_time_array(filepath = None):
     if filepath is None:
         filepath = './gas_abundances.h5'
-    data = dd.io.load(filepath)
+    data = load_all_stats(filepath)
     # make a new array to hold times
     if (not ('time_evolution') in data.keys()):
         data['time_evolution'] = {}
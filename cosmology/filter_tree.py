@@ -34,9 +34,12 @@ def select_root_halos(a, criteria, fields):
     return roots
 
 
-def get_neighbors(a, all_halos, n = 1, selection = None):
+def get_neighbors(a, all_halos, n = 1, selection = None, periodic = False):
     """
     Get the properties of the nearest neighbor to all of the halos.
+    Neighbors are searched for among the halos in `selection` (all
+    halos if None), optionally accounting for the periodic box of
+    the catalog (a.box_size).
     """
 
     all_neighbors = []
@@ -44,34 +47,44 @@ def get_neighbors(a, all_halos, n = 1, selection = None):
     if selection is None:
         selection = a['id']==a['id']
 
-    all_ids = a['id'][selection]
-    x = a['x'][selection].to('kpc')
-    y = a['y'][selection].to('kpc')
-    z = a['z'][selection].to('kpc')
+    # index into the full catalog of each selected halo, and
+    # position of each halo ID in the selection
+    selected = np.where(selection)[0]
+    all_ids  = a['id'][selected]
+    id_index = dict(zip(all_ids.astype(np.int64).tolist(), np.arange(np.size(all_ids))))
+
+    x = a['x'][selected].to('kpc')
+    y = a['y'][selected].to('kpc')
+    z = a['z'][selected].to('kpc')
+
+    box_size = a.box_size.to('kpc').value if periodic else None
 
     nn_sorted, nn_distances = nn_search(x=x,y=y,z=z,
-                                        return_distances=True, n = n)
+                                        return_distances=True, n = n,
+                                        box_size = box_size)
     print(np.min(nn_distances), np.max(nn_distances))
 
+    fields   = ['mass','virial_radius','id','x','y','z']
+    values   = {}
+    for field in ['mass','virial_radius','id']:
+        values[field] = np.asarray(a[field][selected])
+    for field in ['x','y','z']:
+        values[field] = a[field][selected].to('kpc').value / a.box_size.to('kpc').value
+
     for halos in all_halos:
 
         nhalos = len(halos)
         nn_dict = {}
-        fields = ['mass','virial_radius','id','x','y','z']
         for field in ['distance'] + fields:
             nn_dict[field] = np.zeros(nhalos)
 
-        for i,h in enumerate(halos):
-            host_index = np.argwhere(a['id'] == h['id'])[0]
-            nn_index   = nn_sorted[host_index]
-
-            for field in ['mass','virial_radius','id']:
-                nn_dict[field][i] = a[field][nn_index]
+        host_index = np.array([id_index[int(h['id'])] for h in halos], dtype = np.int64)
+        nn_index   = nn_sorted[host_index]
 
-            for field in ['x','y','z']:
-                nn_dict[field][i] = a[field][nn_index].to('kpc').value / a.box_size.to('kpc').value
+        for field in fields:
+            nn_dict[field][:] = values[field][nn_index]
 
-            nn_dict['distance'][i] = nn_distances[host_index] # in kpc
+        nn_dict['distance'][:] = nn_distances[host_index] # in kpc
 
         all_neighbors.append(nn_dict)
 
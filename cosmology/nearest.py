@@ -1,23 +1,23 @@
 import numpy as np
 
+from scipy.spatial import cKDTree
+
 
 def nn_search(X=None, x=None, y=None, z=None, 
               n=1,
-              return_distances=False):
+              return_distances=False,
+              box_size=None):
     """
-    Vectorized nearest neighbor search accepting either
+    Nearest neighbor search accepting either
     an (N,D) matrix (first kwarg) or three (N,) vectors
     (representing x, y, and z coordinates) to identify
     the nearest neighbors to a selection of points. Uses
     Euclidean distance.
 
-    This is naiively vectorized, so will operate quickly
-    but will likely blow up for very large N.
-
-    Core algorithm taken from the
-    vectorized_nearest_neighbor.py routine in 
-    astroML (Statistics, Data Mining, and Machine Learning
-    in Astronomy; Ch. 2.5, pg 55).
+    Uses a KD-tree, so memory scales as O(N) and time as
+    O(N log N) (the original brute force version, adapted
+    from the vectorized_nearest_neighbor.py routine in
+    astroML, formed the full N x N distance matrix).
 
     Parameters
     -----------
@@ -41,6 +41,11 @@ def nn_search(X=None, x=None, y=None, z=None,
         By default, returns just the indexes corresponding
         to the nearest neighbor for each value. If True,
         also returns the distances to these values.
+
+    box_size : float or (D,) array, optional
+        If given, treat the points as lying in a periodic box
+        of this size (in the same units as the points), with
+        its lower corner at the origin. Default : None (not periodic)
     """
 
     if X is None:
@@ -62,19 +67,23 @@ def nn_search(X=None, x=None, y=None, z=None,
 
         X = np.array(l).T
 
-    # now do the sorting
-    XXT = np.dot(X, X.T)
-    Xii = XXT.diagonal()
-    D   = Xii - 2 * XXT + Xii[:, np.newaxis]
+    X = np.asarray(X, dtype = np.float64)
+
+    if not (box_size is None):
+        box_size = np.asarray(box_size, dtype = np.float64)
+        X        = np.mod(X, box_size) # points must lie within [0, box_size)
+        X        = np.where(X >= box_size, X - box_size, X) # round off
+
+    tree = cKDTree(X, boxsize = box_size)
 
     #
-    # generate array that sorts the distances
-    # to get indexes of nearest nth neighbor
-    # for each point
+    # query n+1 neighbors, since the nearest (0th) is
+    # the point itself
     #
-    nn_sort = np.argsort(D, axis=1)[:,n]
+    distances, nn_sort = tree.query(X, k = [n + 1])
+    nn_sort   = nn_sort[:,0]
 
     if return_distances:
-        return nn_sort, np.sqrt(D[np.arange(len(nn_sort)), nn_sort])
+        return nn_sort, distances[:,0]
     else:
         return nn_sort
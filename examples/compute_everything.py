@@ -7,8 +7,9 @@ import sys
 import re
 
 from galaxy_analysis.misc import process_boundary_flux as pbf
+from galaxy_analysis.utilities import task_runner
+from galaxy_analysis.utilities import time_series_store
 
-from joblib import Parallel, delayed
 import multiprocessing
 
 import yt
@@ -50,7 +51,10 @@ def run_analysis(imin, imax, di, n_jobs = None):
 #
     print(("Beginning analysis on %i files on %i processors"%((imax+di-imin)/(1.0*di),n_jobs)))
 
-    Parallel(n_jobs=n_jobs)(delayed(_parallel_loop)(i) for i in np.arange(imin,imax+di,di))
+    task_runner.run_tasks(_parallel_loop, np.arange(imin,imax+di,di), nproc = n_jobs)
+
+    # consolidate new outputs into the time series store
+    time_series_store.update_time_series_store()
 
     return
 
@@ -24,16 +24,6 @@ SOLAR_METALLICITY = 0.02 # as defined in Gizmo / FIRE defaults
 
 
 
-CYTHON_ON = True
-
-if CYTHON_ON:
-    import pyximport; pyximport.install(setup_args={'include_dirs':[np.get_include()]},
-                                        language_level=3)
-
-    from galaxy_analysis.gizmo import age_fields
-    from galaxy_analysis.utilities import cy_convert_abundances as ca
-
-
 # in Gizmo output, first metal tracer field corresponding to
 # the age bins (0-14 are the 11 default species + 4 r-process)
 OFFSET             = 15
@@ -47,6 +37,54 @@ for e in elements:
     element_num[e] = i
     i = i + 1
 
+def _age_tracer_element_masses(data, ptype, agebins, yields, age_is_fraction = False):
+    """
+    Compute the mass (in Msun) of every element in each particle from the
+    age bin tracer fields. The (n_particles x n_agebins) tracer matrix is
+    read once and multiplied by the (n_agebins x n_elements) yield table.
+
+    The result is kept on the data object (for each particle type) for
+    its current io chunk and yield table, so each element's field in
+    that chunk is just a column lookup. It goes away with the data
+    object, and is replaced when the next chunk is read.
+
+    Returns
+    -------
+    masses : np.ndarray
+        Element masses (in Msun), shape (n_particles, n_elements)
+    """
+
+    nbins = np.size(agebins) - 1
+    first = data[(ptype, 'Metallicity_%02i'%(OFFSET))]
+
+    # data objects are evaluated one io chunk at a time. Otherwise, the
+    # tracer field itself identifies the data
+    chunk = getattr(data, '_current_chunk', None)
+    if chunk is None:
+        chunk = first
+
+    cache  = data.__dict__.setdefault('_element_mass_cache', {})
+    key    = (ptype, age_is_fraction)
+    cached = cache.get(key, None)
+    if (not (cached is None)) and (cached[0] is chunk) and (cached[1] is yields):
+        return cached[2]
+
+    tracers = np.empty( (np.size(first), nbins) )
+    tracers[:,0] = first.value
+    for i in np.arange(1, nbins):
+        tracers[:,i] = data[(ptype, 'Metallicity_%02i'%(OFFSET + i))].value
+
+    masses = np.dot(tracers, yields[:nbins])
+
+    if age_is_fraction:
+        masses *= data[(ptype,'particle_mass')].to('code_mass').value[:,np.newaxis]
+
+    masses /= data.ds.hubble_constant
+
+    cache[key] = (chunk, yields, masses)
+
+    return masses
+
 def generate_metal_fields(ds, _agebins=None,
                               _elements=elements,
                               _yields=None,
@@ -61,8 +99,10 @@ def generate_metal_fields(ds, _agebins=None,
     yield (in solar masses) per solar mass of star formation
     in each age bin for each element.
 
-    The derived fields computing elemental mass loop through
-    all the age bin tracer fields.
+    The age bin tracer fields are read once per chunk of data and
+    the masses of all elements are computed together (see
+    _age_tracer_element_masses), and shared by all of the derived
+    fields for that chunk.
 
     Derived fields will be of form:
         (ptype,"ELEMENTNAME_mass")
@@ -78,44 +118,10 @@ def generate_metal_fields(ds, _agebins=None,
     """
 
     def _metal_mass_test(_ptype, _ei):
-        # test metals in bin zero
         def temp(field,data):
-            mass_p = np.zeros(np.shape( data[(_ptype,'particle_mass')]))
+            masses = _age_tracer_element_masses(data, _ptype, _agebins, _yields, age_is_fraction)
 
-            # do this in cython:
-            if CYTHON_ON:
-
-                for i in np.arange(np.size(_agebins)-1):
-                    fname    = 'Metallicity_%02i'%(OFFSET + i)
-                    mass_p += data[(ptype,fname)].value * _yields[i,_ei] #(agebinnum,  elementnum)
-
-#
-#                Both the calculations below *should* work but don't for some reason. I am
-#                absolutely mystified by this.... it works just fine in tests outside of 
-#                the derived fields routines.... but for some reason this gives wrong answers...
-#                unfortunate since its slightly faster (and is how I wrote the cython version....
-#
-#                age_vals = np.array([ data[(_ptype     ,"Metallicity_%02i"%(OFFSET+i))].value for i in np.arange(np.size(_agebins)-1)])
-#                mass_p = np.matmul(age_vals.T, _yields[:,ei].T)
-#                mass_p = np.matmul(_yields[:,ei].T, age_vals)
-
-            else:
-
-
-                for i in np.arange(np.size(_agebins)-1):
-                    fname    = 'Metallicity_%02i'%(OFFSET + i)
-                    mass_p += data[(_ptype,fname)].value * _yields[i,_ei] #(agebinnum,  elementnum)
-
-#                age_vals = np.array([ data[(_ptype,"Metallicity_%02i"%(OFFSET+i))] for i in np.arange(np.size(_agebins)-1)])
-#                mass_p = np.matmul(_yields[:ei].T, age_vals)
-#np.sum(np.transpose(age_vals) * _yields[:,ei], axis=1)
-
-            if age_is_fraction:
-                mass_p = (mass_p * data[(_ptype,'particle_mass')].to('code_mass').value) * yt.units.Msun
-            else:
-                mass_p = mass_p * yt.units.Msun
-
-            return mass_p / data.ds.hubble_constant
+            return masses[:,_ei] * yt.units.Msun
 
         return temp
 
@@ -166,21 +172,10 @@ def _generate_star_metal_fields(ds,
     """
 
     def _star_metal_mass_test(_ptype, _ei):
-        # test metals in bin zero
-
         def temp(field,data):
-            mass_p = np.zeros(np.shape( data[(_ptype,'particle_mass')]))
-            for i in np.arange(np.size(_agebins)-1):
-                fname    = 'Metallicity_%02i'%(OFFSET + i)
-                mass_p += data[(ptype,fname)].value * _yields[i,_ei] #(agebinnum,  elementnum)
-
-
-            if age_is_fraction:
-                mass_p = (mass_p * data[(ptype,'particle_mass')].to('code_mass').value) * yt.units.Msun
-            else:
-                mass_p = mass_p * yt.units.Msun
+            masses = _age_tracer_element_masses(data, _ptype, _agebins, _yields, age_is_fraction)
 
-            return mass_p / data.ds.hubble_constant
+            return masses[:,_ei] * yt.units.Msun
 
         return temp
 
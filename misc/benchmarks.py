@@ -0,0 +1,315 @@
+"""
+    benchmarks
+
+    Notes: timing comparisons between the original per-element
+           implementations of some analysis kernels and their
+           vectorized replacements (each of these also checks that
+           the two give the same answer), and of Galaxy start up
+           time. Run as:
+
+               python -m galaxy_analysis.misc.benchmarks
+"""
+import numpy as np
+import time
+
+from galaxy_analysis import physics
+from galaxy_analysis import star_analysis
+
+
+def _timeit(function, *args, **kwargs):
+    start  = time.time()
+    result = function(*args, **kwargs)
+    return time.time() - start, result
+
+
+def _popIII_lifetime_loop(m):
+    """
+    Original per-element popIII lifetime lookup
+    """
+    lifetimes = np.zeros(np.size(m))
+    for i, mass in enumerate(m):
+        lifetimes[i] = physics._popIII_lifetimes[np.argmin(np.abs(physics._popIII_lifetime_masses-mass))]
+    return lifetimes
+
+
+def _popII_lifetime_loop(m, z):
+    """
+    Original per-element popII lifetime lookup through the onezone tables
+    """
+    from onezone import data_tables
+    SE_table = data_tables.StellarEvolutionData()
+
+    lifetimes = np.zeros(np.size(m))
+    for i in np.arange(np.size(m)):
+        lifetimes[i] = SE_table.interpolate({'mass' : m[i], 'metallicity' : z[i]}, 'lifetime')
+    return lifetimes
+
+
+def benchmark_lifetimes(sizes = [10**4, 10**5, 10**6], max_loop_size = 10**5, seed = 12345):
+    """
+    Compare per-element and batched lifetime lookups for popIII and popII
+    stars. Per-element timings above `max_loop_size` are extrapolated
+    linearly from a `max_loop_size` subsample.
+    """
+
+    rng = np.random.RandomState(seed)
+
+    print("%10s %12s %12s %12s %10s %10s"%('N', 'kind', 'loop (s)', 'batched (s)', 'speedup', 'max diff'))
+
+    for n in sizes:
+        n_loop = min(n, max_loop_size)
+
+        m_III = 10.0**rng.uniform(np.log10(1.0), np.log10(1000.0), n)
+        m_II  = 10.0**rng.uniform(np.log10(0.95), np.log10(120.0), n)
+        z_II  = 10.0**rng.uniform(-4.0, np.log10(0.017), n)
+
+        t_loop, loop = _timeit(_popIII_lifetime_loop, m_III[:n_loop])
+        t_loop       = t_loop * n / (1.0 * n_loop)
+        t_vec, vec   = _timeit(physics.popIII_lifetime, m_III)
+        print("%10i %12s %12.4E %12.4E %10.1f %10.3E"%(n, 'popIII', t_loop, t_vec, t_loop / t_vec,
+                                                    np.max(np.abs(loop - vec[:n_loop]) / loop)))
+
+        t_vec, vec = _timeit(star_analysis.interpolate_stellar_properties, m_II, z_II, ['lifetime'])
+        vec        = vec['lifetime']
+        try:
+            t_loop, loop = _timeit(_popII_lifetime_loop, m_II[:n_loop], z_II[:n_loop])
+        except ImportError:
+            print("%10i %12s %12s %12.4E %10s %10s"%(n, 'popII', 'n/a', t_vec, 'n/a', 'n/a'))
+            continue
+
+        t_loop = t_loop * n / (1.0 * n_loop)
+        print("%10i %12s %12.4E %12.4E %10.1f %10.3E"%(n, 'popII', t_loop, t_vec, t_loop / t_vec,
+                                                    np.max(np.abs(loop - vec[:n_loop]) / loop)))
+
+    return
+
+
+def benchmark_star_properties(sizes = [10**3, 10**4], rtol = 1.0E-3, seed = 12345):
+    """
+    Check the table stellar model (star_analysis.compute_star_properties)
+    against onezone over the PARSEC mass / metallicity grid (nodes and
+    midpoints, see star_analysis.compare_to_onezone), and time it against
+    building one onezone Star per particle. Raises a ValueError if any
+    property differs from onezone by more than rtol.
+    """
+    from galaxy_analysis.star_analysis import _stellar_model
+    from galaxy_analysis.star_analysis import Star, StarList, get_star_property
+
+    max_difference = star_analysis.compare_to_onezone()
+
+    print("%16s %10s %8s"%('property', 'max diff', 'ok'))
+    for k in max_difference.keys():
+        print("%16s %10.3E %8s"%(k, max_difference[k], max_difference[k] <= rtol))
+
+    rng       = np.random.RandomState(seed)
+    Mmin, Mmax = star_analysis.table_mass_range()
+    names     = ['luminosity', 'L_FUV', 'L_LW', 'Q0', 'Q1', 'E0', 'E1', 'Teff', 'R']
+
+    print("%10s %12s %12s %10s"%('N', 'onezone (s)', 'table (s)', 'speedup'))
+    for n in sizes:
+        M = 10.0**rng.uniform(np.log10(Mmin), np.log10(Mmax), n)
+        Z = 10.0**rng.uniform(-4.0, np.log10(0.017), n)
+
+        def _onezone():
+            AllStars = StarList([Star(star_type = 'star', M = m, Z = z, tform = 0.0, id = i)
+                                 for i, (m, z) in enumerate(zip(M, Z))])
+            return get_star_property(None, None, AllStars = AllStars, property_names = names)
+
+        t_loop, loop = _timeit(_onezone)
+        t_vec, vec   = _timeit(_stellar_model._table_star_properties, M, Z)
+        print("%10i %12.4E %12.4E %10.1f"%(n, t_loop, t_vec, t_loop / t_vec))
+
+    failed = [k for k in max_difference.keys() if max_difference[k] > rtol]
+    if len(failed) > 0:
+        print("Table stellar model does not match onezone for: ", failed)
+        raise ValueError
+
+    return max_difference
+
+
+def _abundance_ratio_array_loop(x1e, x1, x2e, x2, input_type = 'abundance'):
+    """
+    Original per-element abundance ratio conversion (a list comprehension
+    over convert_abundances.abundance_ratio, which is also what the
+    original Cython abundance_ratio_array did element by element)
+    """
+    from galaxy_analysis.utilities import convert_abundances
+
+    return np.array([convert_abundances.abundance_ratio( (x1e,val1), (x2e,val2), input_type=input_type)
+                     for val1,val2 in zip(x1,x2)])
+
+
+def benchmark_abundance_ratios(sizes = [10**6, 10**7, 10**8], max_loop_size = 10**5,
+                               nratios = 10, seed = 12345):
+    """
+    Compare the per-element abundance ratio conversion to the NumPy
+    (convert_abundances) and, if it can be compiled, Cython
+    (cy_convert_abundances) kernels, both for a single ratio (allocating
+    a new output array, and writing in place) and for `nratios` ratios
+    at once. Per-element timings above `max_loop_size` are extrapolated
+    linearly from a `max_loop_size` subsample. Note: 10^8 elements needs
+    a few GB of memory.
+    """
+    from galaxy_analysis.utilities import convert_abundances
+
+    try:
+        import pyximport; pyximport.install(setup_args={'include_dirs':[np.get_include()]},
+                                            language_level=3)
+        from galaxy_analysis.utilities import cy_convert_abundances
+    except ImportError:
+        cy_convert_abundances = None
+
+    rng = np.random.RandomState(seed)
+
+    elements = ['H','C','N','O','Mg','Si','Ca','Fe','Ba','Eu']
+    ratios   = [e + '/H' for e in elements[1:]]
+    ratios   = (ratios * int(np.ceil(nratios / (1.0 * len(ratios)))))[:nratios]
+
+    print("%10s %12s %12s %12s %10s %10s"%('N', 'kind', 'loop (s)', 'vector (s)', 'speedup', 'max diff'))
+
+    for n in sizes:
+        n_loop = min(n, max_loop_size)
+
+        values = {}
+        for e in elements:
+            values[e] = 10.0**rng.uniform(-12.0, -6.0, n)
+
+        t_loop, loop = _timeit(_abundance_ratio_array_loop, 'Fe', values['Fe'][:n_loop],
+                                                           'H', values['H'][:n_loop], 'mass')
+        t_loop       = t_loop * n / (1.0 * n_loop)
+
+        out = np.empty(n)
+        implementations = [('numpy', convert_abundances)]
+        if not (cy_convert_abundances is None):
+            implementations.append( ('cython', cy_convert_abundances) )
+
+        for name, module in implementations:
+            t_vec, vec = _timeit(module.abundance_ratio_array, 'Fe', values['Fe'], 'H', values['H'],
+                                 input_type = 'mass')
+            print("%10i %12s %12.4E %12.4E %10.1f %10.3E"%(n, name, t_loop, t_vec, t_loop / t_vec,
+                                                        np.max(np.abs(loop - vec[:n_loop]))))
+
+            t_vec, vec = _timeit(module.abundance_ratio_array, 'Fe', values['Fe'], 'H', values['H'],
+                                 input_type = 'mass', out = out)
+            print("%10i %12s %12.4E %12.4E %10.1f %10.3E"%(n, name + ' (out)', t_loop, t_vec, t_loop / t_vec,
+                                                        np.max(np.abs(loop - vec[:n_loop]))))
+
+            # many ratios at once, compared to the per-element loop for each
+            t_vec, vec = _timeit(module.abundance_ratio_arrays, values, ratios, input_type = 'mass')
+            print("%10i %12s %12.4E %12.4E %10.1f %10.3E"%(n, name + ' (x%i)'%(nratios), t_loop * nratios,
+                                                        t_vec, t_loop * nratios / t_vec,
+                                                        np.max(np.abs(loop - vec[ratios.index('Fe/H')][:n_loop]))))
+
+        del(values, out)
+
+    if cy_convert_abundances is None:
+        print("Cython kernels could not be compiled - skipped")
+
+    return
+
+
+def _nn_search_brute(X, n = 1):
+    """
+    Original brute force nearest neighbor search (full N x N
+    distance matrix)
+    """
+    XXT = np.dot(X, X.T)
+    Xii = XXT.diagonal()
+    D   = Xii - 2 * XXT + Xii[:, np.newaxis]
+
+    nn_sort = np.argsort(D, axis=1)[:,n]
+
+    return nn_sort, np.sqrt(D[np.arange(len(nn_sort)), nn_sort])
+
+
+def benchmark_nn_search(sizes = [10**3, 10**4, 10**5, 10**6], max_brute_size = 5000,
+                        n = 1, seed = 12345):
+    """
+    Compare the brute force and KD-tree nearest neighbor searches
+    (cosmology.nearest.nn_search) on uniform random points in a unit
+    box, for the non-periodic and periodic cases. The brute force
+    search is only run up to `max_brute_size` points (it needs
+    O(N^2) memory). Differences are in the distances to the n-th
+    neighbor (indexes may differ for equidistant neighbors).
+    """
+    from galaxy_analysis.cosmology.nearest import nn_search
+
+    rng = np.random.RandomState(seed)
+
+    print("%10s %12s %12s %12s %10s %10s"%('N', 'kind', 'brute (s)', 'tree (s)', 'speedup', 'max diff'))
+
+    for N in sizes:
+        X = rng.uniform(0.0, 1.0, (N, 3))
+
+        t_tree, (index, dist) = _timeit(nn_search, X, n = n, return_distances = True)
+
+        if N <= max_brute_size:
+            t_brute, (bindex, bdist) = _timeit(_nn_search_brute, X, n = n)
+            print("%10i %12s %12.4E %12.4E %10.1f %10.3E"%(N, 'box', t_brute, t_tree, t_brute / t_tree,
+                                                        np.max(np.abs(dist - bdist))))
+        else:
+            print("%10i %12s %12s %12.4E %10s %10s"%(N, 'box', 'n/a', t_tree, 'n/a', 'n/a'))
+
+        t_tree, (index, dist) = _timeit(nn_search, X, n = n, return_distances = True, box_size = 1.0)
+        print("%10i %12s %12s %12.4E %10s %10s"%(N, 'periodic', 'n/a', t_tree, 'n/a', 'n/a'))
+
+    return
+
+
+def benchmark_galaxy_startup(wdir = './', noutputs = 100):
+    """
+    Time Galaxy construction over (up to) `noutputs` outputs in `wdir`,
+    counting the number of yt.load calls made per output. Compares the
+    eager construction to lazy construction followed by reading a saved
+    scalar. Must be run in a fresh process so field definition
+    (done once per process) is included in the first output's time.
+    """
+    import glob
+    import yt
+    from galaxy_analysis.analysis import Galaxy
+
+    dsnames = np.sort(glob.glob(wdir + '/DD????/DD????'))[:noutputs]
+    dsnames = [x.split('/')[-1] for x in dsnames]
+
+    if len(dsnames) == 0:
+        print("No outputs found in " + wdir)
+        return
+
+    # count data set loads
+    nloads   = [0]
+    _yt_load = yt.load
+    def _counting_load(*args, **kwargs):
+        nloads[0] += 1
+        return _yt_load(*args, **kwargs)
+    yt.load = _counting_load
+
+    print("%12s %12s %12s %12s"%('mode', 'first (s)', 'mean (s)', 'loads/output'))
+
+    try:
+        for lazy in [False, True]:
+            t = np.zeros(len(dsnames))
+            nloads[0] = 0
+
+            for i, dsname in enumerate(dsnames):
+                start = time.time()
+                gal   = Galaxy(dsname, wdir = wdir, lazy = lazy)
+                if lazy:
+                    gal.meta_data
+                t[i] = time.time() - start
+                del(gal)
+
+            print("%12s %12.4E %12.4E %12.2f"%('lazy' if lazy else 'eager', t[0],
+                                              np.average(t[1:]) if len(t) > 1 else t[0],
+                                              nloads[0] / (1.0 * len(dsnames))))
+    finally:
+        yt.load = _yt_load
+
+    return
+
+
+if __name__ == "__main__":
+
+    benchmark_lifetimes()
+    benchmark_star_properties()
+    benchmark_abundance_ratios()
+    benchmark_nn_search()
@@ -4,3 +4,4 @@ from .IMF import *
 from .sfrFromParticles import *
 from .sn_rate import *
 from .sfhFromParticles import *
+from .particle_rates import *
@@ -3,101 +3,191 @@ import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 
 import numpy as np
-import deepdish as dd
 import h5py
 import glob
 import os
 import yt
 
-def generate_dataset(wdir = '.', overwrite = False, filename = 'orbit.h5'):
+# value of fields for outputs where a particle does not exist
+FILL_VALUE = -999
 
-    times = np.array([])
-    pid   = np.array([])
-    orbit_data = {}
-    if os.path.isfile(wdir + '/' + filename):
-        with h5py.File(wdir + '/' + filename, 'r') as hf:
-            times = hf['times']
-            pid   = hf['particles'].keys() # get all particle ID's
+# number of outputs (rows) x particles (columns) per chunk
+_CHUNKS = (16, 1024)
 
-        orbit_data = dd.io.load(wdir + '/' + filename)
-    else:
-        orbit_data['times'] = times
-        orbit_data['particles']   = {}
+_ORBIT_FIELDS = ['x','y','z','vx','vy','vz','pt','M']
 
-#    hf   = h5py.File( wdir + '/' + filename, 'w')
-#
-#    if not ('times' in hf.keys()):
-#        hf.create_dataset
 
-    # identify the data outputs in wdir
-    data_files   = np.sort(glob.glob(wdir +'/' + 'DD????/DD????'))
-    dnames       = [x[-6:] for x in data_files]
+def _particle_columns(hf, ids):
+    """
+    Columns of the given particle IDs in the store, adding columns
+    for any particles not yet in the store. Columns are in the order
+    particles were added; lookup is through the sorted ID array.
+    """
+
+    all_ids = hf['particle_index'][...]
+    order   = np.argsort(all_ids, kind = 'stable')
+    sorted_ids = all_ids[order]
 
-    # check last file - see if there are any new particles
-    ds   = yt.load( data_files[-1] )
-    data = ds.all_data()
+    columns = np.zeros(np.size(ids), dtype = np.int64)
+    found   = np.zeros(np.size(ids), dtype = bool)
+    if np.size(sorted_ids) > 0:
+        pos   = np.clip(np.searchsorted(sorted_ids, ids), 0, np.size(sorted_ids) - 1)
+        found = sorted_ids[pos] == ids
+        columns[found] = order[pos[found]]
 
-    latest_pid    = data['particle_index'].value
-    new_particles = np.setdiff1d(latest_pid, pid)
-    for p in new_particles:
-        orbit_data['particles'][p] = {}
-        for k in ['x','y','z','vx','vy','vz','pt','M']:
-            orbit_data['particles'][p][k] = np.ones(np.size(dnames))* (-999)
+    new = np.where(~found)[0]
+    if np.size(new) > 0:
+        n_old = np.size(all_ids)
+        n_new = n_old + np.size(new)
 
-        orbit_data['particles'][p]['t_o'] = data['creation_time'][data['particle_index'] == p].to('Myr').value
-        orbit_data['particles'][p]['M_o'] = data['birth_mass'][data['particle_index'] == p].value
+        for name in ['particle_index', 't_o', 'M_o']:
+            hf[name].resize( (n_new,) )
+        hf['particle_index'][n_old:] = ids[new]
 
-    # if file already existed, go through old PID and append slots if needed
-    if len(pid) > 0:
-        if len(data_files) > len(times):
-            num_new = len(data_files) - len(times)
-            for p in pid:
-                for k in orbit_data['particles'][p].keys():
-                    orbit_data['particles'][p][k] =\
-                          orbit_data['particles'][p][k].append( np.ones(num_new) * (-999))
+        for k in _ORBIT_FIELDS:
+            hf[k].resize(n_new, axis = 1)
 
-    # now loop and do everything
-    all_times = np.zeros(np.size(data_files))
+        columns[new] = n_old + np.arange(np.size(new))
 
-    if np.size(times) > 1:
-        all_times[:np.size(times)] = times
+    return columns, new
+
+def _check_layout(filename):
+    """
+    Raise a ValueError if filename is an orbit file in the older
+    (deepdish, per-particle dictionary) layout, which cannot be read
+    or added to as a columnar store
+    """
+
+    with h5py.File(filename, 'r') as hf:
+        legacy = (not ('outputs' in hf)) and (('particles' in hf) or ('times' in hf))
+
+    if legacy:
+        print(filename + " is an orbit file in the older per-particle (deepdish) layout. " +\
+              "Regenerate it with generate_dataset(..., overwrite = True)")
+        raise ValueError
+
+    return
 
-    for i,d in enumerate(dnames):
-        print(data_files[i])
-        ds  = yt.load( data_files[i] )
-        data = ds.all_data()
-        t   = ds.current_time.to("Myr").value
+def generate_dataset(wdir = '.', overwrite = False, filename = 'orbit.h5'):
+    """
+    Track the positions (pc, relative to domain center), velocities
+    (km/s), masses (Msun) and types of all particles across all outputs
+    in wdir. Results are stored in a columnar HDF5 file with one row
+    per output and one column per particle:
 
-        if all_times[i] == t:
-            continue
+        /outputs, /times              : (n_outputs)
+        /particle_index, /t_o, /M_o   : (n_particles)
+        /x, /y, /z, /vx, /vy, /vz,
+        /M, /pt                       : (n_outputs, n_particles)
 
-        all_times[i] = t
+    with FILL_VALUE where a particle does not exist. If the file
+    exists (and overwrite is False), only outputs not yet in the file
+    are loaded, and are added as new rows. Files in the older
+    per-particle layout raise a ValueError and must be regenerated
+    with overwrite = True.
+    """
 
-        if ds.parameters['NumberOfParticles'] > 0:
-            for di,p in enumerate(data['particle_index'].value):
-                j = 0
-                for coord in ['x','y','z']:
-                    orbit_data['particles'][p][coord][i] = 1.0*(data['particle_position_' + coord][di] - ds.domain_center[j]).to('pc').value
-                    orbit_data['particles'][p]['v' + coord][i] = 1.0*(data['particle_velocity_'+coord][di].to('km/s').value)
-                    j = j + 1
+    mode = 'w' if overwrite else 'a'
 
-                orbit_data['particles'][p]['M'][i]   = 1.0*data['particle_mass'][di].to('Msun').value
-                orbit_data['particles'][p]['pt'][i]  = 1.0*data['particle_type'][di].value
+    if (not overwrite) and os.path.isfile(wdir + '/' + filename):
+        _check_layout(wdir + '/' + filename)
 
-    orbit_data['times'] = all_times
+    # identify the data outputs in wdir
+    data_files   = np.sort(glob.glob(wdir +'/' + 'DD????/DD????'))
+    dnames       = [x[-6:] for x in data_files]
 
-    dd.io.save(wdir + '/' + filename, orbit_data)
+    with h5py.File(wdir + '/' + filename, mode) as hf:
+
+        if not ('outputs' in hf):
+            hf.create_dataset('outputs', shape = (0,), maxshape = (None,), dtype = 'S16', chunks = True)
+            hf.create_dataset('times', shape = (0,), maxshape = (None,), dtype = float, chunks = True)
+            hf.create_dataset('particle_index', shape = (0,), maxshape = (None,), dtype = np.int64, chunks = True)
+            for k in ['t_o', 'M_o']:
+                hf.create_dataset(k, shape = (0,), maxshape = (None,), dtype = float,
+                                  chunks = True, fillvalue = FILL_VALUE)
+            for k in _ORBIT_FIELDS:
+                hf.create_dataset(k, shape = (0,0), maxshape = (None,None), dtype = float,
+                                  chunks = _CHUNKS, fillvalue = FILL_VALUE)
+
+        done = [x.decode() for x in hf['outputs'][...]]
+
+        for i, d in enumerate(dnames):
+            if d in done:
+                continue
+
+            print(data_files[i])
+            ds   = yt.load( data_files[i] )
+            data = ds.all_data()
+
+            row = np.size(done)
+            for k in _ORBIT_FIELDS:
+                hf[k].resize(row + 1, axis = 0)
+
+            if ds.parameters['NumberOfParticles'] > 0:
+                ids = data['particle_index'].value.astype(np.int64)
+
+                columns, new = _particle_columns(hf, ids)
+
+                # new particles are added as columns at the end
+                if np.size(new) > 0:
+                    hf['t_o'][columns[new[0]]:] = data['creation_time'].to('Myr').value[new]
+                    hf['M_o'][columns[new[0]]:] = data['birth_mass'].value[new]
+
+                values = {}
+                for j, coord in enumerate(['x','y','z']):
+                    values[coord]       = (data['particle_position_' + coord] - ds.domain_center[j]).to('pc').value
+                    values['v' + coord] = data['particle_velocity_' + coord].to('km/s').value
+                values['M']  = data['particle_mass'].to('Msun').value
+                values['pt'] = data['particle_type'].value
+
+                # scatter each field into this output's row
+                nparticles = hf['particle_index'].shape[0]
+                for k in _ORBIT_FIELDS:
+                    full = np.ones(nparticles) * FILL_VALUE
+                    full[columns] = values[k]
+                    hf[k][row, :] = full
+
+            # mark output as done last, so a partial row is redone
+            hf['times'].resize( (row + 1,) )
+            hf['times'][row] = ds.current_time.to("Myr").value
+            hf['outputs'].resize( (row + 1,) )
+            hf['outputs'][row] = np.bytes_(d)
+            hf.flush()
+
+            done.append(d)
+            del(ds)
 
     return
 
+def load_orbits(wdir = '.', filename = 'orbit.h5', fields = _ORBIT_FIELDS):
+    """
+    Load the orbit store generated by generate_dataset, with outputs
+    sorted by time. Returns a dictionary of arrays.
+    """
+
+    _check_layout(wdir + '/' + filename)
+
+    orbit_data = {}
+    with h5py.File(wdir + '/' + filename, 'r') as hf:
+        times = hf['times'][...]
+        order = np.argsort(times, kind = 'stable')
+
+        orbit_data['times'] = times[order]
+        for k in ['particle_index', 't_o', 'M_o']:
+            orbit_data[k] = hf[k][...]
+        for k in fields:
+            orbit_data[k] = hf[k][...][order]
+
+    return orbit_data
+
 
 def plot_orbit_evolution(wdir = '.', filename = 'orbit.h5',
                          dt = 0.1):
 
-    data  = dd.io.load(wdir + '/' + filename)
+    data  = load_orbits(wdir, filename, fields = ['x','y','z'])
 
     times = data['times']
-    pid   = data['particles'].keys()
+    pid   = data['particle_index']
 
     plot_times = np.arange(np.min(times), np.max(times) + dt*0.5, dt)
     n_particles = np.size(pid)
@@ -111,14 +201,13 @@ def plot_orbit_evolution(wdir = '.', filename = 'orbit.h5',
         all_z = np.array([-1E99] * n_particles)
         # need to generate x,y,z coordinates to plot
         # if each particle is alive
-        for i,p in enumerate(pid):
-            if data['particles'][p]['t_o'] <= t:
-                x,y,z = data['particles'][p]['x'], data['particles'][p]['y'], data['particles'][p]['z']
-
-                select = x != -999
-                all_x[i] =  np.interp( t, times[select], x[select])
-                all_y[i] =  np.interp( t, times[select], y[select])
-                all_z[i] =  np.interp( t, times[select], z[select])
+        for i in np.where(data['t_o'] <= t)[0]:
+            x,y,z = data['x'][:,i], data['y'][:,i], data['z'][:,i]
+
+            select = x != FILL_VALUE
+            all_x[i] =  np.interp( t, times[select], x[select])
+            all_y[i] =  np.interp( t, times[select], y[select])
+            all_z[i] =  np.interp( t, times[select], z[select])
 
 
         angle = angle + dtheta
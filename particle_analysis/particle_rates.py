@@ -0,0 +1,60 @@
+import yt
+import numpy as np
+
+from galaxy_analysis.utilities import utilities
+from galaxy_analysis.particle_analysis.sfrFromParticles import _sfr_times
+from galaxy_analysis.particle_analysis.sn_rate import _explosion_times
+
+__all__ = ['rates_from_particles']
+
+_rate_names = {'SNII_snr' : 'II', 'SNIa_snr' : 'Ia', 'AGB_rate' : 'AGB'}
+
+def rates_from_particles(ds, data, bin_spacings = [None]):
+    """
+    Computes the SFR, SFH, and SNII, SNIa, and AGB rates from particles
+    for any number of bin spacings at once. Formation and explosion
+    times are gathered and sorted only once, and each rate is then
+    computed for every set of bins from cumulative sums. Gives the same
+    results as sfrFromParticles, sfhFromParticles, and snr with the
+    sample times used by sfrFromParticles.
+
+    Parameters
+    ----------
+    ds : yt data set
+    data : yt data object
+        Data object containing the particles
+    bin_spacings : list, optional
+        Bin spacing for each set of rates (as the `times` argument to
+        sfrFromParticles; None is 10 Myr). Default : [None]
+
+    Returns
+    -------
+    rates : list
+        For each bin spacing, a dictionary with 'times' (bin edges,
+        in yr), 'SFR', 'SFH' (at each bin edge), 'SNII_snr',
+        'SNIa_snr', and 'AGB_rate' (all per yr)
+    """
+
+    particle_mass = data['birth_mass'].value
+    creation_time = data['creation_time'].to('Myr')
+    currentTime   = ds.current_time.to('Myr')
+
+    formation  = utilities.sort_events(creation_time.to('yr').value, particle_mass)
+
+    explosions = {}
+    for name in _rate_names.keys():
+        explosions[name] = utilities.sort_events(_explosion_times(ds, data, _rate_names[name]) * 1.0E6)
+
+    rates = []
+    for bin_spacing in bin_spacings:
+        times = _sfr_times(creation_time, currentTime, times = bin_spacing).to('yr')
+
+        r = {'times' : times}
+        r['SFR'] = utilities.event_rate(formation, times.value)
+        r['SFH'] = utilities.cumulative_events(formation, times.value)
+        for name in explosions.keys():
+            r[name] = utilities.event_rate(explosions[name], times.value)
+
+        rates.append(r)
+
+    return rates
@@ -6,6 +6,8 @@ import matplotlib.pyplot as plt
 import numpy as np
 import glob
 
+from galaxy_analysis.utilities import utilities
+
 __all__ = ['sfhFromParticles']
 
 def sfhFromParticles(ds, data, selection = None, times = None):
@@ -34,11 +36,10 @@ def sfhFromParticles(ds, data, selection = None, times = None):
         if not hasattr(times, 'value'):
             times = times *yt.units.Myr
 
-    mass  = np.zeros(np.shape(times))
-
     times = times.to('yr')
-    for i,t in enumerate(times):
-        mass[i] = np.sum( particle_mass[creation_time <= t] )
+
+    events = utilities.sort_events(creation_time.to('yr').value, particle_mass.value)
+    mass   = utilities.cumulative_events(events, times.value)
 
     return times, mass
 
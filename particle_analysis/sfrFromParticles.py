@@ -6,6 +6,8 @@ import matplotlib.pyplot as plt
 import numpy as np
 import glob
 
+from galaxy_analysis.utilities import utilities
+
 __all__ = ['sfrFromParticles']
 
 def sfrFromParticles(ds, data, selection = None, times = None, t_o = None):
@@ -23,6 +25,21 @@ def sfrFromParticles(ds, data, selection = None, times = None, t_o = None):
     creation_time = data['creation_time'][selection].to('Myr')
     currentTime   = ds.current_time.to('Myr')
 
+    times = _sfr_times(creation_time, currentTime, times = times, t_o = t_o)
+
+    times = times.to('yr')
+
+    events = utilities.sort_events(creation_time.to('yr').value, particle_mass.value)
+    sfr    = utilities.event_rate(events, times.value)
+
+    return times, sfr
+
+def _sfr_times(creation_time, currentTime, times = None, t_o = None):
+    """
+    Sample times (bin edges) used by sfrFromParticles. times can be
+    an array of times, a bin spacing, or None (10 Myr spacing).
+    """
+
     # set start time of array
     if t_o is None:
         t_o = np.min(creation_time)
@@ -48,18 +65,7 @@ def sfrFromParticles(ds, data, selection = None, times = None, t_o = None):
         if not hasattr(times, 'value'):
             times = times * yt.units.Myr
 
-    sfr   = np.zeros(np.size(times)-1)
-
-    times = times.to('yr')
-
-    for i in np.arange(np.size(times)-1):
-        dt = times[i+1] - times[i]
-        dm = np.sum(particle_mass[creation_time <= times[i+1]]) -\
-             np.sum(particle_mass[creation_time <= times[i]])
-
-        sfr[i] = dm / dt
-
-    return times, sfr
+    return times
 
 
 if __name__=='__main__':
@@ -6,6 +6,8 @@ import matplotlib.pyplot as plt
 import numpy as np
 import glob
 
+from galaxy_analysis.utilities import utilities
+
 
 __all__ = ['future_snr', 'snr']
 
@@ -38,17 +40,30 @@ def future_snr(ds, data, times = None, sn_type = 'II'):
         times = np.linspace(current_time, current_time + 2000.0, bin_spacing)
         times = times * yt.units.Myr
 
+    explosion_times = _future_explosion_times(ds, data, sn_type)
+
+    times = times.convert_to_units('yr')
+    snr   = utilities.event_rate(utilities.sort_events(explosion_times * 1.0E6), times.value)
+
+    return times, snr
+
+def _future_explosion_times(ds, data, sn_type = 'II'):
+    """
+    Projected explosion times (in Myr) of stars that have not yet
+    gone SN (or AGB) of the given type
+    """
+
     birth_mass    = data['birth_mass'].value
     mass          = data['particle_mass'].convert_to_units('Msun').value
     creation_time = data['creation_time'].convert_to_units('Myr').value
     lifetimes     = data['dynamical_time'].convert_to_units('Myr').value
     pt            = data['particle_type']
 
+    agb_threshold = ds.parameters['IndividualStarSNIIMassCutoff']
 
     if  any( [sn_type in x for x in _core_collapse_labels]):
 
         collapse_threshold = ds.parameters['IndividualStarDirectCollapseThreshold']
-        agb_threshold      = ds.parameters['IndividualStarSNIIMassCutoff']
 
         pcut = (pt == 11) * (birth_mass <= collapse_threshold) *\
                             (birth_mass  > agb_threshold)
@@ -61,21 +76,7 @@ def future_snr(ds, data, times = None, sn_type = 'II'):
 
         pcut = (pt == 11) * (birth_mass < agb_threshold)
 
-    explosion_times = creation_time[pcut] + lifetimes[pcut]
-    explosion_times = explosion_times * yt.units.Myr
-
-    times = times.convert_to_units('yr')
-    snr   = np.zeros(np.size(times.value) - 1)
-
-    # compute SNR
-    for i in np.arange(np.size(times) - 1):
-        dt = times[i+1] - times[i]
-        dN = np.size( explosion_times[explosion_times <= times[i+1]]) -\
-             np.size( explosion_times[explosion_times <= times[i]])
-
-        snr[i] = dN / dt
-
-    return times, snr
+    return creation_time[pcut] + lifetimes[pcut]
 
 
 def snr(ds, data, times = None, sn_type = 'II'):
@@ -108,20 +109,32 @@ def snr(ds, data, times = None, sn_type = 'II'):
         times = times *yt.units.Myr
 
 
+    explosion_times = _explosion_times(ds, data, sn_type)
+
+    if explosion_times is None:
+        return -1
+
+    times = times.convert_to_units('yr')
+    snr   = utilities.event_rate(utilities.sort_events(explosion_times * 1.0E6), times.value)
+
+    return times, snr
+
+def _explosion_times(ds, data, sn_type = 'II'):
+    """
+    Times (in Myr) at which stars went SN (or AGB) of the given type,
+    empty if there are none. Returns None if sn_type is not valid.
+    """
+
+    current_time  = ds.current_time.convert_to_units('Myr').value
+
     # load particle properties
     birth_mass    = data['birth_mass'].value
     mass          = data['particle_mass'].convert_to_units("Msun").value
     creation_time = data['creation_time'].convert_to_units('Myr').value
-    metallicity   = data['metallicity_fraction'].value
 #    lifetimes     = data['dynamical_time'].convert_to_units('Myr').value
     lifetimes     = data[('io','particle_model_lifetime')].convert_to_units('Myr').value
     pt            = data['particle_type'].value
 
-    # check to see if there are any SN candidates in the first place
-#    if not any([ == x for x in np.unique(pt)]):
-#        print "no supernova of type " + sn_type + " found"
-#        return times, np.zeros(np.size(times.value) - 1)
-
     # looking for core collapse supernova rate
     if  any( [sn_type in x for x in _core_collapse_labels]):
 
@@ -130,9 +143,9 @@ def snr(ds, data, times = None, sn_type = 'II'):
         # ignore stars that did not actually go supernova
         collapse_threshold = ds.parameters['IndividualStarDirectCollapseThreshold']
         agb_threshold      = ds.parameters['IndividualStarSNIIMassCutoff']
-        if not any([(x <= collapse_threshold)*(x > agb_threshold) for x in birth_mass[pcut]]):
+        if not np.any( (birth_mass[pcut] <= collapse_threshold)*(birth_mass[pcut] > agb_threshold)):
             print("no core collapse supernova present, only direct collapse")
-            return times, np.zeros(np.size(times.value) - 1)
+            return np.zeros(0)
 
         # slice!
         pcut *= (birth_mass <= collapse_threshold)*(birth_mass > agb_threshold)
@@ -142,14 +155,14 @@ def snr(ds, data, times = None, sn_type = 'II'):
         pcut = (pt == 12)
 
         if np.size(mass[pcut]) < 1:
-            return times, np.zeros(np.size(times))
-        
+            return np.zeros(0)
+
         # SNIa are the ones that are just masless tracers, rest are WD
         if not any(mass[pcut] == 0.0):
             print("no Type Ia supernova, only white dwarfs")
             print("N_WD = %i -- Lowest mass = %.3f Msun"%(np.size(mass[pcut]), np.min(mass[pcut])))
             print("Current time = %.2E Myr - Next to explode at t = %.2E Myr"%(current_time, np.min(lifetimes[pcut] + creation_time[pcut])))
-            return times, np.zeros(np.size(times.value) - 1)
+            return np.zeros(0)
 
         # slice!
         pcut *= (mass == 0.0)
@@ -167,7 +180,7 @@ def snr(ds, data, times = None, sn_type = 'II'):
 
     else:
         print("sn_type :" + sn_type + " not a valid option - check spelling")
-        return -1
+        return None
 
 
     #
@@ -175,21 +188,7 @@ def snr(ds, data, times = None, sn_type = 'II'):
     # when stars go SN, lifetime is set to be lifetime*huge_number
     # therefore, explosion time can be backed out as:
     #
-    explosion_times = creation_time[pcut] + lifetimes[pcut]/ds.parameters['huge_number']
-    explosion_times = explosion_times * yt.units.Myr
-
-    times = times.convert_to_units('yr')
-    snr   = np.zeros(np.size(times.value) - 1)
-
-    # compute SNR
-    for i in np.arange(np.size(times) - 1):
-        dt = times[i+1] - times[i]
-        dN = np.size( explosion_times[explosion_times <= times[i+1]]) -\
-             np.size( explosion_times[explosion_times <= times[i]])
-
-        snr[i] = dN / dt
-
-    return times, snr
+    return creation_time[pcut] + lifetimes[pcut]/ds.parameters['huge_number']
 
 
 if __name__ == '__main__':
@@ -15,11 +15,15 @@ import deepdish as dd
 from multiprocessing import Pool
 from contextlib import closing
 import itertools
+import functools
+
+from scipy.spatial import cKDTree
 
 
 # --- internal ---
 from galaxy_analysis import Galaxy
 from galaxy_analysis.utilities import utilities as utilities
+from galaxy_analysis.utilities import task_runner
 #from galaxy_analysis.utilities import functions
 #from galaxy_analysis.static_data import ISM
 
@@ -29,6 +33,20 @@ MAX_NUM = 700
 
 GLOBAL_DR = 20.0 * yt.units.pc  # fix this
 
+# number of stars whose neighborhoods are gathered at once
+ENVIRONMENT_BLOCK_SIZE = 1000
+
+# relative tolerance on the distance for cells to count as equally close
+CLOSEST_TOLERANCE = 1.0E-8
+
+# compute_stats_all_datasets writes each output to its own group with h5py
+# as soon as it is computed, and marks the file with this layout version.
+# Files written with deepdish by older versions (all outputs saved at the
+# end) cannot be added to and must be regenerated with overwrite = True
+_LAYOUT_ATTRIBUTE = 'stellar_environment_layout'
+_LAYOUT_VERSION   = 2
+_INCOMPLETE_SUFFIX = '_incomplete'
+
 
 # function to do this for a single data set
 def stellar_environment(ds, data, dead_only = True, write_to_file = True,
@@ -38,6 +56,12 @@ def stellar_environment(ds, data, dead_only = True, write_to_file = True,
     conditions for ALL stars. Either writes this to file,
     using ``return_type == "file"'' or as a dictionary
     with kwargs for each particle ID number.
+
+    Cells within dR of each star (or the closest cells, if there
+    are none; all cells equidistant to within a relative
+    CLOSEST_TOLERANCE are kept) are found with a KD-tree over the cell centers built
+    once per call, and the statistics are computed for blocks of
+    ENVIRONMENT_BLOCK_SIZE stars at a time.
     """
 
     #
@@ -60,13 +84,21 @@ def stellar_environment(ds, data, dead_only = True, write_to_file = True,
     dynamical_time = data['dynamical_time'].convert_to_units('Myr').value
 
 
-    # coordinates
-    x  = data['x'].convert_to_units('pc')
-    y  = data['y'].convert_to_units('pc')
-    z  = data['z'].convert_to_units('pc')
-    px = data['particle_position_x'].convert_to_units('pc')
-    py = data['particle_position_y'].convert_to_units('pc')
-    pz = data['particle_position_z'].convert_to_units('pc')
+    # cell properties and centers, converted once
+    M  = data['cell_mass'].to('Msun').value
+    V  = data['cell_volume'].to('cm**(3)').value
+    n  = data['number_density'].value
+    T  = data['temperature'].value
+
+    cell_pos = np.array([data['x'].convert_to_units('pc').value,
+                         data['y'].convert_to_units('pc').value,
+                         data['z'].convert_to_units('pc').value]).T
+    star_pos = np.array([data['particle_position_x'].convert_to_units('pc').value,
+                         data['particle_position_y'].convert_to_units('pc').value,
+                         data['particle_position_z'].convert_to_units('pc').value]).T
+
+    if hasattr(dR, 'units'):
+        dR = dR.to('pc').value
 
     # now compute the environment properties for all stars
     prop = {}
@@ -79,37 +111,56 @@ def stellar_environment(ds, data, dead_only = True, write_to_file = True,
 
     print(np.size(pid), np.size(loop_indexes))
 
-    for i in loop_indexes:
+    if np.size(loop_indexes) == 0:
+        return prop
+
+    # spatial index over cell centers, built once for all stars
+    tree = cKDTree(cell_pos)
 
-        #if (dead_only and (lifetime - age > 1.0)): # skip for stars still alive
-        #    continue
+    for start in np.arange(0, np.size(loop_indexes), ENVIRONMENT_BLOCK_SIZE):
+        block  = loop_indexes[start : start + ENVIRONMENT_BLOCK_SIZE]
+        nblock = np.size(block)
 
-        ID = int(pid[i])
+        # all cells within dR of each star (or the closest cell, if none)
+        neighbors = tree.query_ball_point(star_pos[block], dR)
+        counts    = np.array([len(x) for x in neighbors], dtype = np.int64)
 
-        r = np.sqrt(  (x-px[i])**2 + (y-py[i])**2 + (z-pz[i])**2 )
+        # keep every cell at the closest distance (e.g. a star on a cell
+        # face), allowing for round off in the distances
+        none = np.where(counts == 0)[0]
+        if np.size(none) > 0:
+            closest_r = tree.query(star_pos[block[none]])[0]
+            closest   = tree.query_ball_point(star_pos[block[none]],
+                                              closest_r * (1.0 + CLOSEST_TOLERANCE))
+            for j, c in zip(none, closest):
+                neighbors[j] = c
+                counts[j]    = len(c)
 
-        select = r <= dR
-        #print i, pid[i], np.size(r[select])
-        if np.size(r[select]) == 0:
-            select = r <= np.min(r)
-            #print '---', i, pid[i], np.size(r[select]), np.min(r), dR
+        cells = np.concatenate([np.asarray(x, dtype = np.int64) for x in neighbors])
+        seg   = np.repeat(np.arange(nblock), counts)
 
-        M      = (data['cell_mass'].to('Msun'))[select]
-        V      = (data['cell_volume'].to('cm**(3)'))[select]
-        n      = (data['number_density'])[select]
-        T      = (data['temperature'])[select]
+        # statistics for all stars in the block at once
+        n_stats = utilities.segmented_statistics(n[cells], seg, nblock, quantiles = [0.5])
+        M_tot   = np.bincount(seg, weights = M[cells], minlength = nblock)
+        V_tot   = np.bincount(seg, weights = V[cells], minlength = nblock)
+        nV      = np.bincount(seg, weights = n[cells] * V[cells], minlength = nblock)
+        TM      = np.bincount(seg, weights = T[cells] * M[cells], minlength = nblock)
+        TV      = np.bincount(seg, weights = T[cells] * V[cells], minlength = nblock)
 
-        prop[ID] = {}
-        prop[ ID ]['env'] = {'n_min' : np.min(n), 'n_max' : np.max(n),
-                                 'n_v_avg' : np.sum(n*V)/np.sum(V), 'n_med' : np.median(n),
-                                 'T_m_avg' : np.sum(T*M)/np.sum(M), 'T_v_avg' : np.sum(T*V)/np.sum(V),
-                                 'M_tot' : np.sum(M)}
+        for j, i in enumerate(block):
+            ID = int(pid[i])
 
-        prop[ID]['c_prop'] = {'M_o' : M_o[i], 'lifetime' : lifetime[i],
-                                               't_o' : t_o[i]}
+            prop[ID] = {}
+            prop[ ID ]['env'] = {'n_min' : n_stats['min'][j], 'n_max' : n_stats['max'][j],
+                                 'n_v_avg' : nV[j] / V_tot[j], 'n_med' : n_stats['quantiles'][j,0],
+                                 'T_m_avg' : TM[j] / M_tot[j], 'T_v_avg' : TV[j] / V_tot[j],
+                                 'M_tot' : M_tot[j]}
 
-        prop[ID]['s_prop'] = {'age' : age[i], 'r_cyl' : r_cyl[i], 'z_cyl' : z_cyl[i],
-                                           'M' : M_p[i], 'ptype' : ptype[i], 'dyn_time' : dynamical_time[i]}
+            prop[ID]['c_prop'] = {'M_o' : M_o[i], 'lifetime' : lifetime[i],
+                                                   't_o' : t_o[i]}
+
+            prop[ID]['s_prop'] = {'age' : age[i], 'r_cyl' : r_cyl[i], 'z_cyl' : z_cyl[i],
+                                               'M' : M_p[i], 'ptype' : ptype[i], 'dyn_time' : dynamical_time[i]}
 
 
 #        if write_to_file:
@@ -128,7 +179,7 @@ def stellar_environment(ds, data, dead_only = True, write_to_file = True,
     return prop
 
 
-def _parallel_loop(dsname):
+def _parallel_loop(dsname, dR = GLOBAL_DR):
 
     groupname = dsname.rsplit('/')[1]
     print("starting computation on ", groupname)
@@ -140,7 +191,7 @@ def _parallel_loop(dsname):
 
     g['Time']    = gal.ds.current_time.convert_to_units('Myr').value
     # generalized function to loop through all mask types and compute stats
-    data  = stellar_environment(gal.ds, gal.df)
+    data  = stellar_environment(gal.ds, gal.df, dR = dR)
 
     for k in data.keys():
         g[k] = data[k]
@@ -155,7 +206,16 @@ def compute_stats_all_datasets(overwrite = False,
                                dir = './', outfile = 'stellar_environment.h5',
                                write_to_text = True, text_file = 'stellar_environment.dat',
                                nproc = 24, dR = None):
-
+    """
+    Compute the stellar environment of all stars in all outputs, writing
+    each output to its own group of the HDF5 file as soon as it finishes
+    (so a crash only loses the outputs in progress).
+
+    dR = None keeps the defaults of the original serial and parallel
+    loops: with nproc = 1 each star's environment is its feedback stencil,
+    otherwise a sphere of GLOBAL_DR (20 pc) is used. An explicit dR is used
+    by both.
+    """
 
     if not (dR is None):
         outfile   = "%4.4f"%(dR.value) + outfile
@@ -165,9 +225,21 @@ def compute_stats_all_datasets(overwrite = False,
 
     if not os.path.isfile(hdf5_filename) or overwrite:
         hf = h5py.File(hdf5_filename, 'w')
-        hf.close()
+    else:
+        hf = h5py.File(hdf5_filename, 'a')
+
+        if (not (_LAYOUT_ATTRIBUTE in hf.attrs)) and (len(hf.keys()) > 0):
+            hf.close()
+            print(hdf5_filename + " was written with deepdish by an older version and cannot be " +\
+                  "added to. Regenerate it with compute_stats_all_datasets(..., overwrite = True)")
+            raise ValueError
 
-    hf = dd.io.load(hdf5_filename)
+    hf.attrs[_LAYOUT_ATTRIBUTE] = _LAYOUT_VERSION
+
+    # remove anything left over from an interrupted write
+    for k in list(hf.keys()):
+        if k.endswith(_INCOMPLETE_SUFFIX):
+            del hf[k]
 
     ds_list = np.sort( glob.glob('./DD????/DD????'))
     for i, dsname in enumerate(ds_list):
@@ -210,79 +282,46 @@ def compute_stats_all_datasets(overwrite = False,
         return
 
 ####
-    if nproc == 1:
-        for i, dsname in enumerate(ds_list):
-            #print i, dsname
-            groupname = dsname.rsplit('/')[1]
-            gal = Galaxy(groupname)
-
-            hf[groupname] = {}
-            g = hf[groupname]
-            g['Time']    = gal.ds.current_time.convert_to_units('Myr').value
-            # generalized function to loop through all mask types and compute stats
-            data  = stellar_environment(gal.ds, gal.df, dR = dR)
-
-            for k in data.keys():
-                g[k] = data[k]
-
-            if write_to_text:
-                for PID in g.keys():
-                    if PID == 'Time':
-                        continue
-                    _write(file, g[PID], PID, g['Time'])
-
-            del(gal)
-
-            print("ending computation on ", groupname)
-
-    else: # parallel
-
-        # select out data sets that already exist in output
-        if not overwrite:
-            ds_list = [x for x in ds_list if ( not any( [x.rsplit('/')[1] in y for y in hf.keys() ]))]
-
-        # construct the pool, and map the results to a holder
-        #   pool splits computation among processors
-
-        #
-        # do this in a loop, so we can save progressively once a full set of processors is complete
-        #   saves you if there is a crash (kinda). This way we do better memory management if
-        #   operating on many large datasets.
-        #
-
-        for sub_list in itertools.zip_longest(*(iter(ds_list),) * nproc):
-
-            sub_list = list(sub_list)
-            sub_list = [s for s in sub_list if s is not None] # remove None values
-            reduced_nproc = np.min( [len(sub_list), nproc] )  # only run on needed processors
-
-            pool = Pool(reduced_nproc)
-            results = pool.map_async(_parallel_loop, sub_list)
-
-            pool.close() # no more processes
-            pool.join()  # wait and join running processes
-
-            # gather results and add to output
-            for r in results.get():
-                hf[r.keys()[0]] = r[r.keys()[0]]
-
-            if write_to_text:
-                for dsname in sub_list:
-                    k = dsname.split('/')[1]
-
-                    for PID in hf[k].keys():
-                        if PID == 'Time':
-                            continue
-
-                        _write(file, hf[k][PID], PID, hf[k]['Time'])
-
-            del(results)
+    # select out data sets that already exist in output
+    if not overwrite:
+        ds_list = [x for x in ds_list if not (x.rsplit('/')[1] in hf.keys())]
+
+    # gather results and write to output as each data set completes. The
+    # group is written under a temporary name and only renamed once complete
+    def _gather(result):
+        groupname = list(result.keys())[0]
+        g         = result[groupname]
+
+        tmpname = groupname + _INCOMPLETE_SUFFIX
+        if groupname in hf:
+            del hf[groupname]
+        utilities.save_dict_to_hdf5_group(hf, tmpname, g)
+        hf.move(tmpname, groupname)
+        hf.flush()
+
+        if write_to_text:
+            for PID in g.keys():
+                if PID == 'Time':
+                    continue
+                _write(file, g[PID], PID, g['Time'])
+
+        print("ending computation on ", groupname)
+        return
 
+    # dR = None : stencil in serial, GLOBAL_DR in parallel (see docstring)
+    if (dR is None) and (nproc > 1):
+        loop_dR = GLOBAL_DR
+    else:
+        loop_dR = dR
 
-    if write_to_text:
-        file.close()
+    try:
+        task_runner.run_tasks(functools.partial(_parallel_loop, dR = loop_dR), ds_list,
+                              nproc = nproc, callback = _gather)
+    finally:
+        hf.close()
 
-    dd.io.save(hdf5_filename, hf)
+        if write_to_text:
+            file.close()
 
     return
 
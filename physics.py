@@ -261,16 +261,26 @@ _popIII_lifetime_masses = np.linspace(5.,1000.,np.size(_popIII_lifetimes))
 def popIII_lifetime(m):
     """
     Interpolate popIII lifetime masses exactly as is done in pop3_maker.F
+    (lifetime of the nearest tabulated mass). Works on scalars or arrays.
     returns lifetime in years
     """
-    if np.size(m) > 1:
-        lifetimes = np.zeros(np.size(m))
-        for i,mass in enumerate(m):
-            lifetimes[i] = _popIII_lifetimes[np.argmin(np.abs(_popIII_lifetime_masses-mass))]
-        return lifetimes
-    else:
-        index = np.argmin(np.abs(_popIII_lifetime_masses-m))
-        return _popIII_lifetimes[index]
+    mass  = np.atleast_1d(m).astype(np.float64)
+    n     = np.size(_popIII_lifetime_masses)
+
+    # bracketing table masses for all stars at once
+    right = np.clip(np.searchsorted(_popIII_lifetime_masses, mass), 1, n - 1)
+    left  = right - 1
+
+    # pick the nearest, taking the lower mass on ties as np.argmin would
+    index = np.where(np.abs(_popIII_lifetime_masses[left]  - mass) <=\
+                     np.abs(_popIII_lifetime_masses[right] - mass), left, right)
+
+    lifetimes = _popIII_lifetimes[index]
+
+    if np.size(m) == 1:
+        return lifetimes[0]
+
+    return lifetimes
 
 
 def chiaki_threshold(C_f, Fe_f, H_f, return_value = False):
@@ -16,8 +16,10 @@ import sys
 import os
 import yt
 
+from scipy.spatial import cKDTree
+
 # some general plot styles for consistency
-from galaxy_analysis.analysis import Galaxy
+from galaxy_analysis.yt_fields import field_generators as fg
 from galaxy_analysis.plot import plot_styles as ps
 from galaxy_analysis.utilities import utilities
 from galaxy_analysis.static_data import anum_to_asym
@@ -53,21 +55,142 @@ def get_data(element, directory = './', t0 = None):
 
     return t, data
 
+def _event_dsname(index, all_files):
+    """
+    Name of the data set to use for an event given the index of the
+    last output before it (-9999 if the event is before all outputs)
+    """
+
+    if int(index) == -9999:
+        return glob.glob('./original/DD????/DD????')[0] # hack - "original" file
+
+    dsname = all_files[int(index)].split('_galaxy_data.h5')[0]
+
+    return dsname + '/' + dsname
+
+def _local_environment(ds, centers, SN_radius = 50.0):
+    """
+    Compute the local gas properties and number of nearby SN progenitors
+    for many events in a single data set at once. Only the region around
+    the events is loaded, and cells / stars around each event are found
+    with KD-trees over their positions.
+
+    Parameters
+    ----------
+    ds : yt data set
+        Data set to compute environments in
+    centers : np.ndarray
+        (N_events, 3) event positions in pc relative to the domain center
+    SN_radius : float, optional
+        Radius (pc) within which to count SN progenitors. Default : 50.0
+
+    Returns
+    -------
+    env : dict
+        Arrays (N_events) of each local environment field
+    """
+
+    nevents = np.shape(centers)[0]
+    centers = centers + ds.domain_center.to('pc').value
+
+    # gas within 4 of the smallest cells
+    r      = 4.0 * ds.index.get_smallest_dx().to('pc').value
+    margin = max(r, SN_radius)
+
+    pc      = ds.length_unit.to('pc').value
+    left    = np.maximum( (np.min(centers, axis = 0) - margin) / pc, ds.domain_left_edge.value)
+    right   = np.minimum( (np.max(centers, axis = 0) + margin) / pc, ds.domain_right_edge.value)
+    region  = ds.box(left, right)
+
+    cell_pos = np.array([region['x'].to('pc').value,
+                         region['y'].to('pc').value,
+                         region['z'].to('pc').value]).T
+    v  = region['cell_volume'].to('pc**3').value
+    m  = region['cell_mass'].to('Msun').value
+    T  = region['Temperature'].value
+    n  = region['number_density'].value
+
+    tree      = cKDTree(cell_pos)
+    neighbors = tree.query_ball_point(centers, r)
+    counts    = np.array([len(x) for x in neighbors], dtype = np.int64)
+
+    # use the closest cell if no cell centers are within r
+    none = np.where(counts == 0)[0]
+    if np.size(none) > 0:
+        closest = tree.query(centers[none])[1]
+        for j, c in zip(none, closest):
+            neighbors[j] = [c]
+        counts[none] = 1
+
+    cells  = np.concatenate([np.asarray(x, dtype = np.int64) for x in neighbors])
+    seg    = np.repeat(np.arange(nevents), counts)
+    starts = np.cumsum(counts) - counts
+
+    M = np.bincount(seg, weights = m[cells], minlength = nevents)
+    V = np.bincount(seg, weights = v[cells], minlength = nevents)
+
+    env = {}
+    env['avg_n']        = np.bincount(seg, weights = m[cells] * n[cells], minlength = nevents) / M
+    env['vol_avg_n']    = np.bincount(seg, weights = v[cells] * n[cells], minlength = nevents) / V
+    env['max_n']        = np.maximum.reduceat(n[cells], starts)
+    env['min_n']        = np.minimum.reduceat(n[cells], starts)
+    env['avg_T']        = np.bincount(seg, weights = m[cells] * T[cells], minlength = nevents) / M
+    env['vol_avg_T']    = np.bincount(seg, weights = v[cells] * T[cells], minlength = nevents) / V
+    env['local_mass']   = M
+    env['local_volume'] = V
+
+    # SN progenitors within SN_radius: massive stars that go SN within
+    # (-5, 10) Myr of now
+    env['N_massive_stars'] = np.zeros(nevents)
+    if ds.parameters['NumberOfParticles'] > 0:
+        tnow  = ds.current_time.to('Myr').value
+        t_o   = region['creation_time'].to('Myr').value
+        death = t_o + region[('io','particle_model_lifetime')].to('Myr').value
+        bm    = region['birth_mass'].value
+
+        select = (bm > 8.0)*(bm < 25.0)*((death - tnow) < 10.0)*((death - tnow) > -5.0)
+
+        if np.size(bm[select]) > 0:
+            star_pos = np.array([region['particle_position_x'].to('pc').value[select],
+                                 region['particle_position_y'].to('pc').value[select],
+                                 region['particle_position_z'].to('pc').value[select]]).T
+
+            env['N_massive_stars'] = cKDTree(star_pos).query_ball_point(centers, SN_radius,
+                                                                         return_length = True)
+
+    return env
+
+def _write_event(outf, mix_data, i):
+    outf.write("%.3f %.3f %.3f %.3E %.3E %.3E %.4E %.4E %.4E %.4E %.4E %.4E %.4E %.4E %5i %.2f %2i %2s\n"%(
+                mix_data['r_cyl'][i], mix_data['z'][i], mix_data['r_sph'][i],
+                mix_data['E_ej'][i], mix_data['M_ej'][i], mix_data['M_metal'][i],
+                mix_data['avg_n'][i], mix_data['vol_avg_n'][i], mix_data['min_n'][i], mix_data['max_n'][i],
+                mix_data['avg_T'][i], mix_data['vol_avg_T'][i], mix_data['local_mass'][i], mix_data['local_volume'][i],
+                mix_data['N_massive_stars'][i],
+                mix_data['time'][i], mix_data['Anum'][i], mix_data['element'][i]))
+    return
+
 def compute_local_environment(filename = './mixing_events.in',
                               outfile = "event_data_table.dat"):
+    """
+    Compute the local gas properties and number of nearby SN progenitors
+    at each mixing event, using the last output before each event.
+    Events are grouped by output, so each output is loaded only once.
+    Rows of the table are written (in event order) as soon as they, and
+    all events before them, are done.
+    """
 
-    mix_data   = load_mixing_file(filename = './mixing_events.in')
+    mix_data   = load_mixing_file(filename = filename)
+    nevents    = np.size(mix_data['time'])
 
     #
     # first, need to know datafile to check for each event
     #
     all_files = np.sort(glob.glob('DD*.h5'))
-    t = np.zeros(np.size(all_files))
-    for i in np.arange(len(all_files)):
-        t[i] = dd.io.load(all_files[i], '/meta_data/Time')
+    t = utilities.output_times(all_files)
 
-    index = np.zeros(np.size(mix_data['time']))
-    for i in np.arange(np.size(mix_data['time'])):
+    index = np.zeros(nevents)
+    for i in np.arange(nevents):
         diff = mix_data['time'][i] - t
 
         if np.size( diff[diff>0]) == 0:
@@ -77,78 +200,37 @@ def compute_local_environment(filename = './mixing_events.in',
             index[i] = int(np.argmin(diff))
 
     for field in ['avg_n','vol_avg_n','max_n','min_n','local_mass','local_volume','avg_T','vol_avg_T','N_massive_stars']:
-        mix_data[field] = np.zeros(np.size(mix_data['time']))
-#    mix_data['avg_n'] = np.zeros(np.size(mix_data['time']))
-#    mix_data['vol_avg_n'] = np.zeros(np.size(mix_data['time']))
-#    mix_data['max_n'] = np.zeros(np.size(mix_data['time']))
-#    mix_data['min_n'] = np.zeros(np.size(mix_data['time']))
-#    mix_data['local_mass']         = np.zeros(np.size(mix_data['time']))
-#    mix_data['local_volume']       = np.zeros(np.size(mix_data['time']))
-#    mix_data['avg_T']  = np.zeros(np.size(mix_data['time']))
-#    mix_data['vol_avg_T'] = np.zeros(np.size(mix_data['time']))
-    for i in np.arange(np.size(mix_data['time'])):
-        # now loop through and compute
-        if int(index[i]) == -9999:
-            dsname = glob.glob('./original/DD????/DD????')[0]
-        else:
-            dsname = all_files[int(index[i])].strip('_galaxy_data.h5')
-            dsname = dsname + '/' + dsname
-
-        print(dsname)
-        ds   = yt.load(dsname)
-        gal  = Galaxy(dsname.split('/')[0])
-        data = ds.all_data()
-
-        center  = np.array([mix_data['x'][i],
-                            mix_data['y'][i],
-                            mix_data['z'][i]])
-
-        center  = center / ds.length_unit.to('pc').value + ds.domain_center.value
-
-        r       = np.min(data['dx']) * 4
-
-        sp = ds.sphere(center, r)
-        large_sp = gal.ds.sphere(center, 50.0*yt.units.pc)
-
+        mix_data[field] = np.zeros(nevents)
 
-        v  = sp['cell_volume']
-        m  = sp['cell_mass']
-        T  = sp['Temperature']
-        n  = sp['number_density']
+    dsnames = np.array([_event_dsname(x, all_files) for x in index])
+    centers = np.array([mix_data['x'], mix_data['y'], mix_data['z']]).T
 
-        mix_data['avg_n'][i] = np.sum(m * n) / np.sum(m)
-        mix_data['vol_avg_n'][i] = np.sum(v*n)/np.sum(v)
-        mix_data['max_n'][i] = np.max(n)
-        mix_data['min_n'][i] = np.min(n)
-        mix_data['avg_T'][i]    = np.sum(m * T) / np.sum(m)
-        mix_data['vol_avg_T'][i] = np.sum(v * T) / np.sum(v)
-        mix_data['local_mass'][i]         = np.sum(m.to('Msun'))
-        mix_data['local_volume'][i]       = np.sum(v.to('pc**3'))
+    outf = open(outfile,'w')
+    outf.write("r_cyl z r_sph E51 M_ej M_Metal n_m n_v n_min n_max T_m T_v local_mass local_volume N_SN_stars time Anum Element\n")
 
-        t_o   = large_sp['creation_time'].to('Myr')
-        death = t_o + large_sp[('io','particle_model_lifetime')].to('Myr')
-        bm     = large_sp['birth_mass']
-        tnow = ds.current_time.to('Myr')
-        N_SN_stars = np.size( bm[ (bm > 8.0)*(bm<25.0)*((death - tnow) < 10.0*yt.units.Myr)*((death-tnow) > -5.0*yt.units.Myr)])
+    done     = np.zeros(nevents, dtype = bool)
+    nwritten = 0
+    # each output in order of its first event
+    for dsname in dsnames[np.sort(np.unique(dsnames, return_index = True)[1])]:
+        events = np.where(dsnames == dsname)[0]
+        print(dsname, np.size(events))
 
-        mix_data['N_massive_stars'][i]    = N_SN_stars
+        ds  = fg.load_and_define(dsname)
+        env = _local_environment(ds, centers[events])
+        del(ds)
 
+        for k in env.keys():
+            mix_data[k][events] = env[k]
+        done[events] = True
 
-    dd.io.save(outfile + '.h5', mix_data)
+        while (nwritten < nevents) and done[nwritten]:
+            _write_event(outf, mix_data, nwritten)
+            nwritten = nwritten + 1
+        outf.flush()
 
-    outf = open(outfile,'w')
-
-    outf.write("r_cyl z r_sph E51 M_ej M_Metal n_m n_v n_min n_max T_m T_v local_mass local_volume N_SN_stars time Anum Element\n")
-    for i in np.arange(np.size(mix_data['time'])):
-        outf.write("%.3f %.3f %.3f %.3E %.3E %.3E %.4E %.4E %.4E %.4E %.4E %.4E %.4E %.4E %5i %.2f %2i %2s\n"%(
-                    mix_data['r_cyl'][i], mix_data['z'][i], mix_data['r_sph'][i],
-                    mix_data['E_ej'][i], mix_data['M_ej'][i], mix_data['M_metal'][i],
-                    mix_data['avg_n'][i], mix_data['vol_avg_n'][i], mix_data['min_n'][i], mix_data['max_n'][i],
-                    mix_data['avg_T'][i], mix_data['vol_avg_T'][i], mix_data['local_mass'][i], mix_data['local_volume'][i],
-                    mix_data['N_massive_stars'][i],
-                    mix_data['time'][i], mix_data['Anum'][i], mix_data['element'][i]))
     outf.close()
 
+    dd.io.save(outfile + '.h5', mix_data)
 
     return
 
@@ -42,8 +42,6 @@ def plot_mass_loading_comparison(work_dir = './', output_dir = None,
         for i,k in enumerate(comparison.keys()):
             color[k] = 'C%1i'%(i)
 
-    gather_keys = {'mass_outflow' : ['gas_profiles','outflow','sphere']}
-
     all_data = {}
 
     for sim in list(comparison.keys()):
@@ -51,9 +49,9 @@ def plot_mass_loading_comparison(work_dir = './', output_dir = None,
                                                          tmin=0.0,tmax= 1000.0)
         all_data[sim] = {}
         all_data[sim]['times'] = times
-        for k in list(gather_keys.keys()):
-
-            all_data[sim][k] = utilities.extract_nested_dict_aslist(None, gather_keys[k], data_list, False)
+        # one read per file, flattened to one array per field
+        loaded = utilities.get_properties(['/gas_profiles/outflow/sphere'], file_list = data_list)
+        all_data[sim]['mass_outflow'] = loaded['/gas_profiles/outflow/sphere/gas/cell_mass']
 
         all_data[sim]['SFR'] = utilities.extract_nested_dict_asarray(None, ['time_data','SFR_1'], [data_list[-1]], False)[0]
         all_data[sim]['SFR_time'] = utilities.extract_nested_dict_asarray(None, ['time_data','time_1'], [data_list[-1]], False)[0]
@@ -80,8 +78,7 @@ def plot_mass_loading_comparison(work_dir = './', output_dir = None,
         #t = all_data[sim]['times'] - all_data[sim]['times'][0]
         t = all_data[sim]['times'] - all_data[sim]['times'][0]
 
-        outflow  = all_data[sim]['mass_outflow'] #[('gas','cell_mass')]
-        Mdot     = np.array([x[('gas','cell_mass')] for x in outflow])
+        Mdot     = all_data[sim]['mass_outflow'] # ('gas','cell_mass')
         SFR_func      = all_data[sim]['SFR_fit']
         yplot = Mdot[:,rbin]# / SFR_func(t)
 
@@ -128,8 +125,7 @@ def plot_mass_loading_comparison(work_dir = './', output_dir = None,
         #t = all_data[sim]['times'] - all_data[sim]['times'][0]
         t = all_data[sim]['times'] - all_data[sim]['times'][0]
 
-        outflow  = all_data[sim]['mass_outflow'] #[('gas','cell_mass')]
-        Mdot     = np.array([x[('gas','cell_mass')] for x in outflow])
+        Mdot     = all_data[sim]['mass_outflow'] # ('gas','cell_mass')
         SFR_func      = all_data[sim]['SFR_fit']
         print(np.size(Mdot[:,rbin]), np.size(t))
         yplot = Mdot[:,rbin] / SFR_func(t)
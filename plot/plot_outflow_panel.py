@@ -43,24 +43,22 @@ def plot_outflow_panel(dir = '.', tmin = None, tmax = None, mass_loading = False
     x = x['centers_rvir']
 
     # load everything to memory at start - limits number of reads from disk
-    all_data_dict = {}
     if mass_loading:
-        norm = np.ones(np.size(data_list))
-        for i,k in enumerate(data_list):
-            all_data_dict[k] = dd.io.load(k, '/gas_profiles/outflow/sphere')
-            norm[i]          = dd.io.load(k, '/meta_data/SFR_100')
+        loaded = utilities.get_properties(['/gas_profiles/outflow/sphere', '/meta_data/SFR_100'],
+                                          file_list = data_list)
+        norm   = 1.0 * loaded['/meta_data/SFR_100']
     else:
-        for k in data_list:
-            all_data_dict[k] = dd.io.load(k, '/gas_profiles/outflow/sphere')
-        norm = np.ones(len(list(all_data_dict.keys())))
+        loaded = utilities.get_properties(['/gas_profiles/outflow/sphere'], file_list = data_list)
+        norm   = np.ones(np.size(data_list))
+
 #    times[norm == 0.0] = None
 
     axi, axj = 0,0
     for field in fields:
         axind = (axi, axj)
 
-        load_field = ('gas',field) # because I'm dumb and keyed them like this
-        binned_y   = utilities.extract_nested_dict_asarray(all_data_dict, load_field)
+        # keyed as ('gas',field), which get_properties flattens to gas/field
+        binned_y   = loaded['/gas_profiles/outflow/sphere/gas/' + field]
 
         # plot at 0.1, 0.25, 0.5, and 1 Rvir for now:
         for loc in [0.1, 0.25, 0.5, 1.0]:
@@ -1 +1,2 @@
 from ._star_analysis import *
+from ._stellar_model import *
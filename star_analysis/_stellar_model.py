@@ -0,0 +1,500 @@
+"""
+Array-based stellar model properties.
+
+Evaluates the same model properties as the onezone `Star` objects
+(luminosity, radiation, Teff, R, lifetime) for every particle at once,
+using the tabulated PARSEC ZAMS and OSTAR2002 data sets that ship with
+the individual star model in `individualstar_data`. This avoids building
+one `Star` object per particle and lets every `particle_model_*` field
+share a single evaluation through a small per-dataset cache.
+
+`compare_to_onezone` checks the table model against onezone over the
+PARSEC grid (see misc/benchmarks.py, benchmark_star_properties).
+Particles the tables do not describe (masses outside the PARSEC
+grid, PopIII and other non main sequence / WD / remnant types) and the
+properties only onezone provides (agb_phase_length, mechanical_luminosity)
+always go through onezone `Star` objects.
+"""
+
+import os
+import numpy as np
+from collections import OrderedDict
+
+__all__ = ['STAR_PROPERTY_NAMES', 'compute_star_properties',
+           'interpolate_stellar_properties', 'clear_star_property_cache',
+           'compare_to_onezone', 'table_mass_range']
+
+_data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         '..', 'individualstar_data')
+
+# cgs constants
+_Lsun = 3.828E33
+_G    = 6.674E-8
+_Msun = 1.989E33
+_h    = 6.6261E-27
+_k    = 1.3807E-16
+_c    = 2.9979E10
+_eV   = 1.6022E-12
+
+#
+# OSTAR2002 metallicity grid (in units of solar), in the column order of
+# the tabulated rates (C, G, L, S, T, V, W, X, Y, Z grids). Solar
+# metallicity of the grid is Z = 0.017
+#
+_OSTAR_Z          = np.array([2.0, 1.0, 0.5, 0.2, 0.1, 1.0/30.0, 1.0/50.0,
+                              1.0/100.0, 1.0/1000.0, 0.0])
+_OSTAR_Z_SOLAR    = 0.017
+
+# band limits in eV
+_HI_ENERGY   = 13.6
+_HeI_ENERGY  = 24.587
+_FUV_BAND    = (5.6, 11.2)
+_LW_BAND     = (11.2, 13.6)
+
+STAR_PROPERTY_NAMES = ['luminosity', 'L_FUV', 'L_LW', 'Q0', 'Q1', 'E0', 'E1',
+                       'Teff', 'R', 'lifetime', 'age_agb', 'agb_phase_length',
+                       'mechanical_luminosity']
+
+# properties that are zeroed out for particles that are not main sequence stars
+_radiation_properties = ['luminosity', 'L_FUV', 'L_LW', 'Q0', 'Q1', 'E0', 'E1']
+
+# properties of onezone Star objects (as in get_star_property) that are
+# also computed here from the tables
+_star_properties = _radiation_properties + ['Teff', 'R']
+
+# properties that are only available from onezone
+_onezone_properties = ['agb_phase_length', 'mechanical_luminosity']
+
+# particle types the tables describe (main sequence stars, WDs and remnants)
+_table_types = [11, 12, 13]
+
+_tables      = {}
+_cache       = OrderedDict()
+_CACHE_SIZE  = 8
+
+
+def _load_tables():
+    """
+    Load and grid the stellar evolution and radiation tables once
+    """
+
+    if len(_tables) > 0:
+        return _tables
+
+    # PARSEC ZAMS: M, Z, log(L/Lsun), log(Teff), log(R), lifetime, agb start
+    data = np.genfromtxt(_data_dir + '/parsec_zams.in')
+    M    = np.unique(data[:,0])
+    Z    = np.unique(data[:,1])
+
+    # sort into a regular (nM x nZ) grid
+    order = np.lexsort((data[:,1], data[:,0]))
+    data  = data[order]
+    se    = {'M' : M, 'Z' : Z}
+    for i, name in enumerate(['logL', 'logTeff', 'logR', 'lifetime', 'age_agb']):
+        se[name] = data[:,i+2].reshape(np.size(M), np.size(Z))
+    _tables['SE'] = se
+
+    # OSTAR2002: Teff, log(g), then one column per metallicity bin
+    rad = {}
+    for name, fname in [('Q0', 'q0_photon_rates.in'), ('Q1', 'q1_photon_rates.in'),
+                        ('FUV', 'FUV_energy_rates.in'), ('LW', 'LW_energy_rates.in')]:
+        data  = np.genfromtxt(_data_dir + '/' + fname)
+        T     = np.unique(data[:,0])
+        g     = np.unique(data[:,1])
+        order = np.lexsort((data[:,1], data[:,0]))
+
+        # store with metallicity increasing along the last axis
+        zsort = np.argsort(_OSTAR_Z)
+        rad[name] = data[order][:,2:][:,zsort].reshape(np.size(T), np.size(g), np.size(_OSTAR_Z))
+        rad['Teff'] = T
+        rad['logg'] = g
+    rad['Z'] = np.sort(_OSTAR_Z) * _OSTAR_Z_SOLAR
+    _tables['OSTAR'] = rad
+
+    _tables['BB'] = _blackbody_tables()
+
+    return _tables
+
+
+def table_mass_range():
+    """
+    Minimum and maximum mass (Msun) of the PARSEC table. Properties
+    of stars outside this range are clamped to the table edges by
+    `interpolate_stellar_properties`.
+    """
+    se = _load_tables()['SE']
+    return se['M'][0], se['M'][-1]
+
+
+def _blackbody_tables(nT = 500, nE = 2000):
+    """
+    Tabulate the blackbody surface fluxes needed for stars outside the
+    OSTAR2002 grid on a fine grid in temperature. Photon fluxes are in
+    1/s/cm^2 and energy fluxes in erg/s/cm^2.
+    """
+
+    T = np.logspace(3.0, 6.0, nT)
+
+    def _integrate(emin, emax, photons = False):
+        E = np.logspace(np.log10(emin), np.log10(emax), nE) * _eV
+        x = E[np.newaxis,:] / (_k * T[:,np.newaxis])
+        with np.errstate(over = 'ignore'):
+            y = 2.0 * np.pi * E**3 / (_h**3 * _c**2) / np.expm1(x) # energy flux per unit energy
+        if photons:
+            y = y / E
+        return np.sum(0.5 * (y[:,1:] + y[:,:-1]) * np.diff(E), axis = 1)
+
+    bb = {'Teff' : T}
+    bb['q0']  = _integrate(_HI_ENERGY,  1.0E4, photons = True)
+    bb['q1']  = _integrate(_HeI_ENERGY, 1.0E4, photons = True)
+    bb['e0']  = _integrate(_HI_ENERGY,  1.0E4)
+    bb['e1']  = _integrate(_HeI_ENERGY, 1.0E4)
+    bb['FUV'] = _integrate(*_FUV_BAND)
+    bb['LW']  = _integrate(*_LW_BAND)
+
+    return bb
+
+
+def _bilinear_weights(x, xgrid):
+    """
+    Lower index and fractional distance for linear interpolation
+    of each x on xgrid, clamping to the table edges.
+    """
+    x = np.clip(x, xgrid[0], xgrid[-1])
+    i = np.clip(np.searchsorted(xgrid, x, side = 'right') - 1, 0, np.size(xgrid) - 2)
+    t = (x - xgrid[i]) / (xgrid[i+1] - xgrid[i])
+    return i, t
+
+
+def interpolate_stellar_properties(M, Z, fields = None):
+    """
+    Vectorized bilinear interpolation of the PARSEC ZAMS table in
+    mass and metallicity. Values outside the table are clamped to the
+    table edges.
+
+    Parameters
+    ----------
+    M, Z   : 1D array
+             Stellar (birth) mass in Msun and metallicity fraction
+    fields : list, optional
+             Any of 'luminosity' (erg/s), 'Teff' (K), 'R' (cm), 'lifetime' (s)
+             and 'age_agb' (s). Default : all
+
+    Returns
+    -------
+    properties : dictionary
+             Dictionary of arrays of each requested property
+    """
+
+    se = _load_tables()['SE']
+
+    if fields is None:
+        fields = ['luminosity', 'Teff', 'R', 'lifetime', 'age_agb']
+
+    M = np.atleast_1d(np.asarray(M, dtype = np.float64))
+    Z = np.atleast_1d(np.asarray(Z, dtype = np.float64))
+
+    i, t = _bilinear_weights(M, se['M'])
+    j, u = _bilinear_weights(Z, se['Z'])
+
+    def _interp(y):
+        return (1.0-t)*(1.0-u)*y[i,j] + t*(1.0-u)*y[i+1,j] +\
+                    t*u*y[i+1,j+1] + (1.0-t)*u*y[i,j+1]
+
+    table_name = {'luminosity' : 'logL', 'Teff' : 'logTeff', 'R' : 'logR',
+                  'lifetime' : 'lifetime', 'age_agb' : 'age_agb'}
+
+    properties = {}
+    for field in fields:
+        properties[field] = _interp(se[table_name[field]])
+
+    for field in ['luminosity', 'Teff', 'R']:
+        if field in properties:
+            properties[field] = 10.0**(properties[field])
+
+    if 'luminosity' in properties:
+        properties['luminosity'] *= _Lsun
+
+    return properties
+
+
+def _radiation_properties_from_tables(Teff, R, M, Z):
+    """
+    Ionizing photon rates and FUV / LW luminosities from the OSTAR2002
+    grid where possible, falling back to a blackbody everywhere else
+    (outside the grid, or where any corner of the grid cell is missing).
+    Mean ionizing photon energies are always from the blackbody.
+    """
+
+    tables = _load_tables()
+    ostar  = tables['OSTAR']
+    bb     = tables['BB']
+
+    area = 4.0 * np.pi * R * R
+    logg = np.log10(_G * (M * _Msun) / (R * R))
+
+    logT  = np.log10(Teff)
+    bbT   = np.log10(bb['Teff'])
+    _bb   = lambda name : 10.0**np.interp(logT, bbT, np.log10(np.maximum(bb[name], 1.0E-300)))
+
+    rad = {}
+    rad['Q0']    = _bb('q0')  * area
+    rad['Q1']    = _bb('q1')  * area
+    rad['L_FUV'] = _bb('FUV') * area
+    rad['L_LW']  = _bb('LW')  * area
+
+    q0 = _bb('q0') ; q1 = _bb('q1')
+    rad['E0'] = np.where(q0 > 0, _bb('e0') / np.maximum(q0, 1.0E-300), 0.0)
+    rad['E1'] = np.where(q1 > 0, _bb('e1') / np.maximum(q1, 1.0E-300), 0.0)
+
+    in_grid = (Teff >= ostar['Teff'][0]) * (Teff <= ostar['Teff'][-1]) *\
+              (logg >= ostar['logg'][0]) * (logg <= ostar['logg'][-1])
+
+    if np.any(in_grid):
+        i, t = _bilinear_weights(Teff[in_grid], ostar['Teff'])
+        j, u = _bilinear_weights(logg[in_grid], ostar['logg'])
+        k, v = _bilinear_weights(Z[in_grid],    ostar['Z'])
+
+        for name, out in [('Q0','Q0'), ('Q1','Q1'), ('FUV','L_FUV'), ('LW','L_LW')]:
+            y = ostar[name]
+            corners = np.array([y[i,j,k],     y[i+1,j,k],     y[i,j+1,k],     y[i,j,k+1],
+                                y[i+1,j+1,k], y[i+1,j,k+1],   y[i,j+1,k+1],   y[i+1,j+1,k+1]])
+            value = (1-t)*(1-u)*(1-v)*corners[0] + t*(1-u)*(1-v)*corners[1] +\
+                    (1-t)*u*(1-v)*corners[2]     + (1-t)*(1-u)*v*corners[3] +\
+                    t*u*(1-v)*corners[4]         + t*(1-u)*v*corners[5]     +\
+                    (1-t)*u*v*corners[6]         + t*u*v*corners[7]
+
+            # missing models in the grid are stored as zero
+            use_grid = np.all(corners > 0, axis = 0)
+
+            grid_values = rad[out][in_grid]
+            grid_values[use_grid] = value[use_grid] * area[in_grid][use_grid]
+            rad[out][in_grid] = grid_values
+
+    return rad
+
+
+def _table_star_properties(M, Z):
+    """
+    All table properties for stars of mass M and metallicity Z
+    """
+
+    properties = interpolate_stellar_properties(M, Z)
+    properties.update(_radiation_properties_from_tables(properties['Teff'],
+                                                        properties['R'], M, Z))
+    return properties
+
+
+def _with_midpoints(x):
+    """
+    Grid nodes and the (log) midpoints between them
+    """
+    x   = np.asarray(x, dtype = np.float64)
+    mid = np.sqrt(x[1:] * x[:-1])
+    return np.sort(np.concatenate([x, mid]))
+
+
+def compare_to_onezone(masses = None, metallicities = None, property_names = None):
+    """
+    Compare the table model to onezone over a grid of main sequence stars.
+    Lifetimes are compared to `StellarEvolutionData.interpolate` (as used
+    for the particle_model_lifetime field) and all other properties to
+    `get_star_property` for onezone `Star` objects. 'age_agb' is not an
+    onezone property and is not compared.
+
+    Parameters
+    ----------
+    masses, metallicities : 1D array, optional
+        Mass (Msun) and metallicity fraction grid. Default : the PARSEC
+        table nodes and the midpoints between them
+    property_names : list, optional
+        Default : all properties computed from the tables
+
+    Returns
+    -------
+    max_difference : dictionary
+        Maximum relative difference to onezone for each property
+    """
+    from onezone import data_tables
+    from ._star_analysis import Star, StarList, get_star_property
+
+    se = _load_tables()['SE']
+
+    if masses is None:
+        masses = _with_midpoints(se['M'])
+    if metallicities is None:
+        metallicities = _with_midpoints(se['Z'])
+    if property_names is None:
+        property_names = _star_properties + ['lifetime']
+
+    M, Z = np.meshgrid(masses, metallicities, indexing = 'ij')
+    M    = M.flatten()
+    Z    = Z.flatten()
+
+    table   = _table_star_properties(M, Z)
+    onezone = {}
+
+    if 'lifetime' in property_names:
+        SE_table = data_tables.StellarEvolutionData()
+        onezone['lifetime'] = np.array([SE_table.interpolate({'mass' : m, 'metallicity' : z}, 'lifetime')
+                                        for m, z in zip(M, Z)])
+
+    star_names = [k for k in property_names if k in _star_properties]
+    if len(star_names) > 0:
+        AllStars = StarList([Star(star_type = 'star', M = m, Z = z, tform = 0.0, id = i)
+                             for i, (m, z) in enumerate(zip(M, Z))])
+        for k in star_names:
+            onezone[k] = get_star_property(None, None, AllStars = AllStars, property_names = [k])
+
+    max_difference = {}
+    for k in onezone.keys():
+        x = np.asarray(onezone[k], dtype = np.float64)
+        max_difference[k] = np.max(np.abs(table[k] - x) / np.maximum(np.abs(x), 1.0E-300))
+
+    return max_difference
+
+
+def _onezone_star_properties(ds, data, select, property_names, overload_type, ptype):
+    """
+    Properties of the selected particles from onezone `Star` objects
+    (as in get_star_property). 'lifetime' is from the onezone stellar
+    evolution table, as for the table model.
+    """
+    from onezone import data_tables
+    from ._star_analysis import get_list_of_stars, get_star_property
+
+    fields = ['birth_mass', 'metallicity_fraction', 'creation_time', 'particle_index',
+              'particle_type', 'particle_mass', 'dynamical_time']
+    sub    = {}
+    for f in fields:
+        sub[f] = data[(ptype,f)][select]
+
+    properties = {}
+
+    if 'lifetime' in property_names:
+        SE_table = data_tables.StellarEvolutionData()
+        properties['lifetime'] = np.array([SE_table.interpolate({'mass' : m, 'metallicity' : z}, 'lifetime')
+                                           for m, z in zip(sub['birth_mass'].value,
+                                                           sub['metallicity_fraction'].value)])
+
+    star_names = [k for k in property_names if k in _star_properties + _onezone_properties]
+    if len(star_names) > 0:
+        AllStars = get_list_of_stars(ds, sub, overload_type = overload_type)
+        for k in star_names:
+            properties[k] = np.asarray(get_star_property(ds, sub, AllStars = AllStars,
+                                                         property_names = [k]), dtype = np.float64)
+
+    return properties
+
+
+def clear_star_property_cache():
+    """
+    Empty the cache of computed stellar properties
+    """
+    _cache.clear()
+    return
+
+
+def compute_star_properties(ds, data, property_names = None, overload_type = None,
+                            ptype = 'all', use_cache = True):
+    """
+    Compute stellar model properties for all particles in `data` at once.
+
+    Every property in STAR_PROPERTY_NAMES is evaluated together and
+    cached per dataset and particle set, so that requesting many
+    `particle_model_*` fields on the same data only evaluates the model
+    once. Masses outside the PARSEC table (below 0.95 or above 120 Msun)
+    are not clamped to the table edges, but evaluated with onezone as
+    in `get_star_property`, as are agb_phase_length and
+    mechanical_luminosity (only when requested).
+
+    Parameters
+    ----------
+    ds             : yt dataset
+    data           : yt data container (or field data object)
+    property_names : string or list, optional
+                     Properties to return. Default : all
+    overload_type  : int, optional
+                     If None, use the particle types from the simulation:
+                     only main sequence stars (particle_type 11) radiate,
+                     WDs and remnants (12, 13) are zeroed, and all other
+                     types (e.g. PopIII, 14) are evaluated with onezone.
+                     If 11, 12 or 13, treat all particles as that type,
+                     and otherwise as main sequence stars (as in
+                     `get_list_of_stars`).
+    ptype          : string, optional
+                     Particle type to read fields from. Default : 'all'
+    use_cache      : bool, optional
+                     Default : True
+
+    Returns
+    -------
+    Array if a single property name is given, otherwise dictionary of
+    arrays. Units are cgs (erg/s, 1/s, erg, K, cm, s).
+    """
+
+    single_field = isinstance(property_names, str)
+    if property_names is None:
+        property_names = STAR_PROPERTY_NAMES
+    elif single_field:
+        property_names = [property_names]
+
+    M  = np.asarray(data[(ptype,'birth_mass')].value, dtype = np.float64)
+    Z  = np.asarray(data[(ptype,'metallicity_fraction')].value, dtype = np.float64)
+
+    # particle types as in get_list_of_stars
+    if overload_type is None:
+        PT = np.abs(np.asarray(data[(ptype,'particle_type')].value))
+    elif overload_type in [11,12,13]:
+        PT = np.ones(np.size(M)) * overload_type
+    else:
+        PT = np.ones(np.size(M)) * 11
+
+    key = None
+    if use_cache and np.size(M) > 1:
+        index = np.asarray(data[(ptype,'particle_index')].value)
+        key   = (str(ds), getattr(ds, 'unique_identifier', id(ds)), overload_type,
+                 np.size(index), hash(index.tobytes()))
+
+    if key is not None and key in _cache:
+        _cache.move_to_end(key)
+        properties = _cache[key]
+    else:
+        properties = _table_star_properties(M, Z)
+
+        not_ms = PT != 11
+        for name in _radiation_properties:
+            properties[name][not_ms] = 0.0
+
+        # particles the tables do not describe: masses outside the PARSEC
+        # grid (which would otherwise be clamped to the table edge), PopIII
+        # stars and other particle types. Single values are yt's field
+        # validation and are left to the tables (as the dummy_call in
+        # get_star_property)
+        Mmin, Mmax = table_mass_range()
+        outside    = np.logical_not(np.isin(PT, _table_types)) + (M < Mmin) + (M > Mmax)
+        if np.any(outside) and np.size(M) > 1:
+            p = _onezone_star_properties(ds, data, outside, _star_properties + ['lifetime'],
+                                         overload_type, ptype)
+            for k in p.keys():
+                properties[k][outside] = p[k]
+
+        if key is not None:
+            _cache[key] = properties
+            while len(_cache) > _CACHE_SIZE:
+                _cache.popitem(last = False)
+
+    # properties only onezone provides are computed when first requested
+    names = [k for k in property_names if (k in _onezone_properties) and not (k in properties)]
+    if len(names) > 0:
+        if np.size(M) > 1:
+            properties.update(_onezone_star_properties(ds, data, np.ones(np.size(M), dtype = bool),
+                                                       names, overload_type, ptype))
+        else:
+            for k in names:
+                properties[k] = np.zeros(np.size(M))
+
+    if single_field:
+        return properties[property_names[0]]
+
+    return {k : properties[k] for k in property_names}
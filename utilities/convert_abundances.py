@@ -61,18 +61,62 @@ def elemental_abundance(element, mass):
     return n
 
 
-def abundance_ratio_array(x1e, x1, x2e, x2, input_type = 'abundance', normalize='solar'):
+def _ratio_offset(x1e, x2e, input_type = 'abundance'):
+    """
+    Constant added to log10(x1/x2) to get [x1/x2]: the solar
+    normalization, and the molecular weight ratio if converting
+    from mass
+    """
+
+    offset = -(SOLAR_ABUNDANCE[x1e] - SOLAR_ABUNDANCE[x2e])
+
+    if input_type == 'mass':
+        offset = offset + np.log10(MOLECULAR_WEIGHT[x2e] / MOLECULAR_WEIGHT[x1e])
+
+    return offset
+
+def abundance_ratio_array(x1e, x1, x2e, x2, input_type = 'abundance', normalize='solar',
+                          out = None):
     """
     Rrturns abundance ratios for elements given element symbol (x1e), array of values (x1),
     and second symbol (x2e) and array of values (x2). input_type is either "abundance"
-    or "mass".
+    or "mass". If given, the ratios are written into `out` (a float64 array the
+    same size as x1, which may be x1 itself).
     """
 
     if np.size(x1) != np.size(x2):
         print("Arrays are not of equal size")
         raise ValueError
 
-    return np.array([  abundance_ratio( (x1e,val1), (x2e,val2), input_type=input_type) for val1,val2 in zip(x1,x2)])
+    offset = _ratio_offset(x1e, x2e, input_type)
+
+    out = np.divide(np.asarray(x1, dtype = np.float64), np.asarray(x2, dtype = np.float64),
+                    out = out)
+    np.log10(out, out = out)
+    out += offset
+
+    return out
+
+def abundance_ratio_arrays(values, ratios, input_type = 'abundance', out = None):
+    """
+    Compute many abundance ratios at once given a dictionary of arrays of
+    values (abundance or mass, as in abundance_ratio_array) for each element.
+    Each element is converted to a log abundance once, so the cost is one
+    log per element plus one subtraction per ratio.
+
+    Returns an array of shape (len(ratios), n), written into `out` if given.
+    """
+
+    if isinstance(ratios, str):
+        ratios = [ratios]
+
+    log_abundances = {}
+    for r in ratios:
+        for e in r.split('/'):
+            if not (e in log_abundances):
+                log_abundances[e] = log_abundance(e, values[e], input_type)
+
+    return abundance_ratios(log_abundances, ratios, out = out)
 
 def abundance_ratio(x1, x2, input_type = 'abundance'):
     """
@@ -123,6 +167,66 @@ def abundance_ratio(x1, x2, input_type = 'abundance'):
 
     return aratio
 
+def log_abundance(element, x, input_type = 'abundance'):
+    """
+    Log of the abundance (number of particles, or number density) of
+    element relative to solar:
+
+        log10(x) - log(e_x)_sun
+
+    so that any abundance ratio is just a difference of these:
+
+        [x1/x2] = log_abundance(x1) - log_abundance(x2)
+
+    If input_type is 'mass', x is a mass (or mass density) in cgs and is
+    converted to number (or number density) first.
+    """
+
+    x = np.asarray(x, dtype = np.float64)
+
+    if input_type == 'mass':
+        x = x / (MOLECULAR_WEIGHT[element] * AMU)
+
+    return np.log10(x) - SOLAR_ABUNDANCE[element]
+
+def abundance_ratios(log_abundances, ratios, out = None):
+    """
+    Compute many abundance ratios at once from log abundances (as
+    returned by log_abundance) computed once per element.
+
+    Parameters
+    ----------
+    log_abundances : dict
+        Log abundance array for each element name
+    ratios : list
+        Ratio names, e.g. ['Fe/H', 'O/Fe']
+    out : np.ndarray, optional
+        Array of shape (len(ratios), n) to write ratios into.
+        Default : None (new array)
+
+    Returns
+    -------
+    out : np.ndarray
+        [x1/x2] for each ratio, shape (len(ratios), n)
+    """
+
+    if isinstance(ratios, str):
+        ratios = [ratios]
+
+    n = np.size(log_abundances[ratios[0].split('/')[0]])
+
+    if out is None:
+        out = np.empty( (len(ratios), n), dtype = np.float64)
+    elif np.shape(out) != (len(ratios), n):
+        print("Output array has shape ", np.shape(out), " but should have shape ", (len(ratios), n))
+        raise ValueError
+
+    for i, r in enumerate(ratios):
+        e1, e2 = r.split('/')
+        np.subtract(log_abundances[e1], log_abundances[e2], out = out[i])
+
+    return out
+
 def renormalize(aratio, e1, e2, to_solar = False):
     """
     Takes an abundance ratio (aratio) between elements e1 and e2, and reconverts
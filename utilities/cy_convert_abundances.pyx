@@ -1,15 +1,18 @@
+# cython: boundscheck=False, wraparound=False, cdivision=True
 """
 
     Author : A. Emerick
 
 
     Cython versions of some of the routines in convert_abundances.py that can
-    be used to speed things up if doing many conversions. Speed up increases
-    with number of conversions, from factors of ~2 for <1E6 points to
-    ~ for 1E8 points. Can get faster.
+    be used to speed things up if doing many conversions. The solar
+    normalization and molecular weights are looked up once per call (not per
+    element), and the loops run over contiguous float64 buffers without the
+    GIL. See misc/benchmarks.py (benchmark_abundance_ratios) for timings
+    against the NumPy versions in convert_abundances.py.
 
     Currently lacking setup.py to handle cython routines in this repo. Best way
-    to deal with this for now is doing: 
+    to deal with this for now is doing:
 
     import pyximport; pyximport.install(setup_args={'include_dirs':[np.get_include()]},
                                         language_level=3)
@@ -19,66 +22,137 @@
 import numpy as np
 cimport numpy as np
 
+from libc.math cimport log10
 
-# --- These could be changed to pure cython variables / arrays to speed things
-#     up even more, but I'm a little lazy
 from galaxy_analysis.static_data import SOLAR_ABUNDANCE, MOLECULAR_WEIGHT, AMU
 
 
+cdef double _ratio_offset(str x1e, str x2e, str input_type) except *:
+    """
+    Constant added to log10(x1/x2) to get [x1/x2]
+    """
+
+    cdef double offset = -(SOLAR_ABUNDANCE[x1e] - SOLAR_ABUNDANCE[x2e])
+
+    if input_type == 'mass':
+        offset = offset + log10(MOLECULAR_WEIGHT[x2e] / MOLECULAR_WEIGHT[x1e])
+
+    return offset
+
+cdef void _ratio_kernel(const double[::1] x1, const double[::1] x2,
+                        double offset, double[::1] out) noexcept nogil:
+    cdef Py_ssize_t i
+
+    for i in range(x1.shape[0]):
+        out[i] = log10(x1[i] / x2[i]) + offset
+
+    return
+
+cdef void _log_kernel(const double[::1] x, double offset, double[::1] out) noexcept nogil:
+    cdef Py_ssize_t i
+
+    for i in range(x.shape[0]):
+        out[i] = log10(x[i]) + offset
+
+    return
+
+cdef void _difference_kernel(const double[::1] x1, const double[::1] x2,
+                             double[::1] out) noexcept nogil:
+    cdef Py_ssize_t i
+
+    for i in range(x1.shape[0]):
+        out[i] = x1[i] - x2[i]
+
+    return
 
 cpdef np.ndarray abundance_ratio_array(str x1e,
-                           double[:] x1,
-                           str x2e,
-                           double[:] x2,
-                           str input_type = 'abundance', str normalize='solar'):
+                                       x1,
+                                       str x2e,
+                                       x2,
+                                       str input_type = 'abundance', str normalize='solar',
+                                       np.ndarray out = None):
     """
     Rrturns abundance ratios for elements given element symbol (x1e), array of values (x1),
     and second symbol (x2e) and array of values (x2). input_type is either "abundance"
-    or "mass".
+    or "mass". If given, the ratios are written into `out` (a contiguous float64
+    array the same size as x1).
     """
 
-    if x1.shape[0] != x2.shape[0]:
+    cdef const double[::1] x1v = np.ascontiguousarray(x1, dtype = np.float64)
+    cdef const double[::1] x2v = np.ascontiguousarray(x2, dtype = np.float64)
+
+    if x1v.shape[0] != x2v.shape[0]:
         print("Arrays are not of equal size")
         raise ValueError
 
-    cdef double[:] result = np.zeros(x1.shape[0])
-    cdef int i = 0
-
-    for i in np.arange(x1.shape[0]):
-        result[i] = cy_abundance_ratio( x1e, x1[i], x2e, x2[i],input_type=input_type)
-
-    return np.array(result)
+    if out is None:
+        out = np.empty(x1v.shape[0], dtype = np.float64)
+    elif out.ndim != 1 or out.shape[0] != x1v.shape[0]:
+        # must check here, as the kernel does no bounds checking
+        print("Output array has shape ", np.shape(out), " but should have shape ", (x1v.shape[0],))
+        raise ValueError
 
-cdef double cy_elemental_abundance(str element, double mass):
+    cdef double[::1] outv = out
+    cdef double offset    = _ratio_offset(x1e, x2e, input_type)
 
-    cdef double n = mass / (MOLECULAR_WEIGHT[element] * AMU)
+    with nogil:
+        _ratio_kernel(x1v, x2v, offset, outv)
 
-    return n
+    return out
 
-cdef double cy_abundance_ratio(str x1e, double x1_abund, str x2e, double x2_abund, str input_type = 'abundance'):
+cpdef np.ndarray abundance_ratio_arrays(dict values, list ratios,
+                                        str input_type = 'abundance',
+                                        np.ndarray out = None):
     """
-    Normalize abundance ratio to solar. x1 and x2 are tuples
-    containing either element atomic number and abundance, or
-    atomic symbol and abundance (abundance = number of particles).
-    E.g.:
-       normalize_abundance_ratio( ('Fe',1), ('H', 100) )
-    or
-       normalize_abundance_ratio( (26, 1), (1, 100) )
-
-    Returns [x1/x2] where
-       [x1/x2] = log10(x1/x2) - log10(x1_sun / x2_sun)
-
-    Optionally, x1 and x2 can be mass (in cgs, unless astropy units
-    are used) and
+    Compute many abundance ratios at once given a dictionary of arrays of
+    values (abundance or mass) for each element. Each element is converted
+    to a log abundance once, and each ratio is a subtraction of these.
+    Returns an array of shape (len(ratios), n), written into `out`
+    (contiguous, float64) if given.
     """
 
-    if input_type == 'mass':
-        x1_abund = cy_elemental_abundance(x1e, x1_abund)
-        x2_abund = cy_elemental_abundance(x2e, x2_abund)
+    cdef dict log_abundances = {}
+    cdef const double[::1] xv
+    cdef double[::1] logv
+    cdef double offset
+    cdef Py_ssize_t i, n = -1
+
+    for r in ratios:
+        for e in r.split('/'):
+            if e in log_abundances:
+                continue
+
+            xv = np.ascontiguousarray(values[e], dtype = np.float64)
+            if n < 0:
+                n = xv.shape[0]
+            elif xv.shape[0] != n:
+                print("Arrays are not of equal size")
+                raise ValueError
+
+            offset = -SOLAR_ABUNDANCE[e]
+            if input_type == 'mass':
+                offset = offset - log10(MOLECULAR_WEIGHT[e] * AMU)
+
+            log_abundances[e] = np.empty(n, dtype = np.float64)
+            logv = log_abundances[e]
+            with nogil:
+                _log_kernel(xv, offset, logv)
+
+    if out is None:
+        out = np.empty( (len(ratios), n), dtype = np.float64)
+    elif np.shape(out) != (len(ratios), n):
+        # must check here, as the kernel does no bounds checking
+        print("Output array has shape ", np.shape(out), " but should have shape ", (len(ratios), n))
+        raise ValueError
 
-    cdef double x1_solar = SOLAR_ABUNDANCE[x1e]
-    cdef double x2_solar = SOLAR_ABUNDANCE[x2e]
+    cdef double[:, ::1] outv = out
+    cdef const double[::1] l1, l2
 
-    cdef double aratio = np.log10(x1_abund / x2_abund) - (x1_solar - x2_solar) # np.log10( x1_solar / x2_solar)
+    for i in range(len(ratios)):
+        e1, e2 = ratios[i].split('/')
+        l1 = log_abundances[e1]
+        l2 = log_abundances[e2]
+        with nogil:
+            _difference_kernel(l1, l2, outv[i])
 
-    return aratio
+    return out
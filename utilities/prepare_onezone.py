@@ -83,9 +83,7 @@ def get_parameters_from_analysis(galname, onez = None, gal_files = None):
     data = dd.io.load(galname)
     t_first_star = data['particle_meta_data']['t_first_star']
 
-    all_t = np.zeros(len(gal_files))
-    for i,f in enumerate(gal_files):
-        all_t[i] = dd.io.load(f, '/meta_data/Time')
+    all_t = utilities.output_times(gal_files)
 
     imin = np.argmin( np.abs(all_t - t_first_star))
 
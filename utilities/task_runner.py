@@ -0,0 +1,115 @@
+"""
+    task_runner
+
+    Notes: Runs a per-output analysis function over many outputs with a
+           single, long-lived pool of worker processes. Outputs are
+           handed out one at a time as workers free up (so one slow
+           output does not hold up the rest), each worker defines the
+           derived fields once when it starts, and results are passed
+           back to a single callback in the parent process as they
+           finish (e.g. to write them to file).
+"""
+import numpy as np
+import glob
+
+from multiprocessing import Pool
+from contextlib import closing
+
+import yt
+
+
+def _find_field_dataset(wdir = './'):
+    """
+    Find a data set to define the derived fields from. Uses the most
+    recent output that loads, as is done in Galaxy.
+    """
+
+    dfiles = np.sort(glob.glob(wdir + '/' + 'DD????/DD????'))
+
+    for dsname in dfiles[::-1]:
+        try:
+            yt.load(dsname)
+        except:
+            continue
+
+        return dsname
+
+    return None
+
+def _initialize_worker(field_dsname):
+    """
+    Define the derived fields once for this worker process
+    """
+    if field_dsname is None:
+        return
+
+    from galaxy_analysis.yt_fields import field_generators as fg
+
+    if fg.FIELDS_DEFINED:
+        return
+
+    fg.define_derived_fields(yt.load(field_dsname))
+
+    return
+
+def run_tasks(function, tasks, nproc = 1, callback = None,
+              wdir = './', define_fields = True, maxtasksperchild = None):
+    """
+    Apply `function` to each of `tasks` (e.g. a list of data set names),
+    in parallel if `nproc` > 1. Returns once all tasks are complete.
+
+    Parameters
+    ----------
+    function : callable
+        Function of a single task. Must be picklable (i.e. defined at
+        module level, or a functools.partial of one) when nproc > 1.
+    tasks : iterable
+        Tasks to run
+    nproc : int, optional
+        Number of worker processes. Default : 1 (run in serial)
+    callback : callable, optional
+        Called in the parent process with each result, in the order
+        tasks complete (not the order given). Default : None
+    wdir : str, optional
+        Directory to look for outputs in to define the derived fields
+        in each worker. Default : './'
+    define_fields : bool, optional
+        Define the derived fields once in each worker on startup.
+        Default : True
+    maxtasksperchild : int, optional
+        Replace each worker after this many tasks (to release memory).
+        Default : None (workers last for the whole run)
+
+    Returns
+    -------
+    None
+    """
+
+    tasks = list(tasks)
+
+    if len(tasks) == 0:
+        return
+
+    if nproc == 1:
+        for task in tasks:
+            result = function(task)
+            if not (callback is None):
+                callback(result)
+        return
+
+    field_dsname = None
+    if define_fields:
+        field_dsname = _find_field_dataset(wdir)
+
+    nproc = np.min( [len(tasks), nproc] ) # only run on needed processors
+
+    with closing(Pool(nproc, initializer = _initialize_worker, initargs = (field_dsname,),
+                      maxtasksperchild = maxtasksperchild)) as pool:
+
+        for result in pool.imap_unordered(function, tasks, chunksize = 1):
+            if not (callback is None):
+                callback(result)
+
+    pool.join()
+
+    return
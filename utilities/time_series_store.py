@@ -0,0 +1,345 @@
+"""
+    time_series_store
+
+    Notes: Consolidates the per-output DDxxxx_galaxy_data.h5 files written
+           by Galaxy.save into a single columnar HDF5 file. Every numeric
+           value in the nested output dictionaries (e.g. /meta_data/M_HI or
+           /gas_profiles/.../Disk/...) becomes one chunked, resizable dataset
+           with one row per output, so that pulling a quantity across all
+           outputs is a single read. The store is updated incrementally:
+           only new (or modified) outputs are loaded when it is updated.
+
+           Usage:
+
+               > update_time_series_store(dir = '.')
+               > times, M_HI = get_time_series('/meta_data/M_HI', dir = '.')
+"""
+import numpy as np
+import glob
+import os
+
+import h5py
+import deepdish as dd
+
+
+STORE_NAME = 'galaxy_time_series.h5'
+
+# number of rows per chunk in each consolidated dataset
+_CHUNK_ROWS = 64
+
+
+def _field_path_string(field_path):
+    """
+    Convert a field path given as a list of keys or a string into a
+    string with a leading '/'
+    """
+
+    if isinstance(field_path, str):
+        if field_path[0] != '/':
+            field_path = '/' + field_path
+    else:
+        field_path = "/" + "/".join(field_path)
+
+    return field_path
+
+def _flatten_numeric(dictionary, prefix = ''):
+    """
+    Flatten a nested dictionary into {'/path/to/key' : array}, keeping
+    only numeric values (which are converted to float arrays)
+    """
+
+    flat = {}
+    for k in dictionary.keys():
+        value = dictionary[k]
+        path  = prefix + '/' + str(k)
+
+        if isinstance(value, dict):
+            flat.update(_flatten_numeric(value, path))
+            continue
+
+        if value is None:
+            continue
+
+        if hasattr(value, 'value'):
+            value = value.value
+
+        value = np.asarray(value)
+        if (not (value.dtype.kind in 'biuf')) or (value.size == 0 and value.ndim > 0):
+            continue
+
+        flat[path] = value.astype(float)
+
+    return flat
+
+def _resizable(hf, name, shape, dtype):
+    """
+    Get (or create) a 1D resizable dataset
+    """
+
+    if name in hf:
+        hf[name].resize( (shape,) )
+        return hf[name]
+
+    return hf.create_dataset(name, shape = (shape,), maxshape = (None,),
+                             dtype = dtype, chunks = (_CHUNK_ROWS,))
+
+def _check_path_conflicts(hf, path_sources):
+    """
+    Make sure no path is both a value (dataset) and a group of values,
+    either between outputs or between an output and the store. The
+    store keeps one dataset per value, so these cannot be consolidated.
+
+    Parameters
+    ----------
+    hf : h5py File
+        Open store
+    path_sources : dict
+        {'/path/to/key' : output file name} for the outputs being added
+    """
+
+    for path in path_sources.keys():
+        parts = path.split('/')[1:]
+
+        conflict = None
+        for j in np.arange(1, len(parts)):
+            parent = '/' + '/'.join(parts[:j])
+
+            if parent in path_sources:
+                conflict = parent + " is a value in " + path_sources[parent]
+            elif (('data' + parent) in hf) and isinstance(hf['data' + parent], h5py.Dataset):
+                conflict = parent + " is a value in the store"
+
+            if not (conflict is None):
+                break
+
+        if (conflict is None) and (('data' + path) in hf) and isinstance(hf['data' + path], h5py.Group):
+            conflict = path + " is a group in the store"
+
+        if not (conflict is None):
+            print(path + " in " + path_sources[path] + " is a value, but " + conflict +\
+                  ". Regenerate the time series store, or fix the output files.")
+            raise ValueError
+
+    return
+
+def update_time_series_store(dir = '.', store_name = STORE_NAME, data_list = None,
+                             batch_size = 50):
+    """
+    Add any new or modified DDxxxx_galaxy_data.h5 outputs to the
+    time series store, creating the store if it does not exist.
+
+    All columns are resized once to fit every new output, then each
+    batch is written with one block write per column (plus one write
+    per modified output), so compressed chunks are not rewritten row
+    by row.
+
+    Parameters
+    ----------
+    dir : str, optional
+        Directory containing the outputs and the store. Default : '.'
+    store_name : str, optional
+        File name of the store. Default : STORE_NAME
+    data_list : list, optional
+        Outputs to consolidate. Default : all DD????_galaxy_data.h5 in dir
+    batch_size : int, optional
+        Number of outputs loaded before each write to the store.
+        Default : 50
+
+    Returns
+    -------
+    nupdated : int
+        Number of outputs added or updated
+    """
+
+    if data_list is None:
+        data_list = np.sort(glob.glob(dir + '/DD????_galaxy_data.h5'))
+
+    with h5py.File(dir + '/' + store_name, 'a') as hf:
+
+        if 'files' in hf:
+            names  = [x.decode() for x in hf['files'][...]]
+            mtimes = hf['mtime'][...]
+        else:
+            names  = []
+            mtimes = np.zeros(0)
+
+        # drop empty rows left at the end by an interrupted update
+        nkeep = len(names)
+        while (nkeep > 0) and (names[nkeep - 1] == ''):
+            nkeep = nkeep - 1
+
+        if nkeep < len(names):
+            names  = names[:nkeep]
+            mtimes = mtimes[:nkeep]
+            hf.visititems(lambda name, obj : obj.resize(nkeep, axis = 0)
+                                             if isinstance(obj, h5py.Dataset) else None)
+
+        row_of = {}
+        for i, n in enumerate(names):
+            row_of[n] = i
+
+        todo = []
+        for fname in data_list:
+            name = os.path.basename(fname)
+            if (not (name in row_of)) or (mtimes[row_of[name]] != os.path.getmtime(fname)):
+                todo.append(fname)
+
+        if len(todo) == 0:
+            return 0
+
+        # assign rows to all new outputs up front (appended in order)
+        nold = len(names)
+        for fname in todo:
+            name = os.path.basename(fname)
+            if not (name in row_of):
+                row_of[name] = len(names)
+                names.append(name)
+        nrows = len(names)
+
+        # resize the index datasets and existing columns once (new rows
+        # are filled with NaN)
+        files = _resizable(hf, 'files', nrows, 'S256')
+        mtime = _resizable(hf, 'mtime', nrows, float)
+        times = _resizable(hf, 'times', nrows, float)
+
+        existing = []
+        if 'data' in hf:
+            hf['data'].visititems(lambda name, obj : existing.append('/' + name)
+                                                     if isinstance(obj, h5py.Dataset) else None)
+        for path in existing:
+            hf['data' + path].resize(nrows, axis = 0)
+
+        for start in np.arange(0, len(todo), batch_size):
+            batch = todo[start : start + batch_size]
+
+            rows = np.array([row_of[os.path.basename(x)] for x in batch], dtype = int)
+            flat = [_flatten_numeric(dd.io.load(x)) for x in batch]
+
+            # new outputs occupy a contiguous block of rows, modified
+            # outputs keep their old (scattered) rows
+            new      = rows >= nold
+            new_rows = rows[new]
+            if np.size(new_rows) > 0:
+                new_slice = slice(np.min(new_rows), np.max(new_rows) + 1)
+            updated   = np.where(np.logical_not(new))[0]
+
+            path_sources = {}
+            for i in np.arange(len(batch)):
+                for path in flat[i].keys():
+                    path_sources[path] = batch[i]
+            _check_path_conflicts(hf, path_sources)
+
+            # index datasets
+            block_times = np.array([x.get('/meta_data/Time', np.nan) for x in flat], dtype = float)
+            block_mtime = np.array([os.path.getmtime(x) for x in batch], dtype = float)
+            block_files = np.array([np.bytes_(names[r]) for r in rows], dtype = 'S256')
+            for dset, block in [(files, block_files), (mtime, block_mtime), (times, block_times)]:
+                if np.size(new_rows) > 0:
+                    dset[new_slice] = block[new]
+                for i in updated:
+                    dset[rows[i]] = block[i]
+
+            # create columns for paths not yet in the store
+            for path in path_sources.keys():
+                if not (('data' + path) in hf):
+                    shape = np.shape(flat[[i for i in np.arange(len(batch)) if path in flat[i]][0]][path])
+                    hf.create_dataset('data' + path, shape = (nrows,) + shape,
+                                      maxshape = (None,) + shape, dtype = float,
+                                      chunks = (_CHUNK_ROWS,) + shape,
+                                      fillvalue = np.nan, compression = 'gzip')
+                    existing.append(path)
+
+            # gather each column's new rows and write them as one block
+            for path in existing:
+                column = hf['data' + path]
+                block  = np.full( (len(batch),) + column.shape[1:], np.nan)
+
+                for i in np.arange(len(batch)):
+                    value = flat[i].get(path, None)
+
+                    if value is None:
+                        continue
+                    elif np.shape(value) != column.shape[1:]:
+                        print("Shape of " + path + " in " + batch[i] + " does not match store. Setting to NaN")
+                    else:
+                        block[i] = value
+
+                if np.size(new_rows) > 0:
+                    column[new_slice] = block[new]
+                for i in updated:
+                    column[rows[i]] = block[i]
+
+            hf.flush()
+
+    return len(todo)
+
+def get_time_series(field_path, dir = '.', store_name = STORE_NAME,
+                    tmin = None, tmax = None, file_list = None):
+    """
+    Load a single quantity across all outputs in the store.
+
+    Parameters
+    ----------
+    field_path : str or list
+        Path to the quantity, either as a string of keys separated by
+        '/' (e.g. '/meta_data/M_HI') or a list of keys
+    dir : str, optional
+        Directory containing the store. Default : '.'
+    store_name : str, optional
+        File name of the store. Default : STORE_NAME
+    tmin, tmax : float, optional
+        Only return outputs with tmin <= time < tmax. Default : None
+    file_list : list, optional
+        Only return these outputs (matched by file name), in this
+        order, instead of all outputs sorted by time. tmin and tmax
+        are ignored if given. Default : None
+
+    Returns
+    -------
+    times : np.ndarray
+        Time of each output, sorted (or in the order of file_list)
+    values : np.ndarray
+        Value in each output, with shape (n_outputs, ...). NaN where
+        the quantity was not present in an output.
+    """
+
+    field_path = _field_path_string(field_path)
+
+    with h5py.File(dir + '/' + store_name, 'r') as hf:
+
+        if not (('data' + field_path) in hf):
+            print(field_path + " not found in time series store " + dir + '/' + store_name)
+            raise ValueError
+
+        times  = hf['times'][...]
+        values = hf['data' + field_path][...]
+        names  = [x.decode() for x in hf['files'][...]]
+
+    if not (file_list is None):
+        row_of = {}
+        for i, n in enumerate(names):
+            row_of[n] = i
+
+        missing = [x for x in file_list if not (os.path.basename(x) in row_of)]
+        if len(missing) > 0:
+            print("Outputs not found in time series store " + dir + '/' + store_name + ": ", missing)
+            raise ValueError
+
+        rows = np.array([row_of[os.path.basename(x)] for x in file_list], dtype = int)
+        return times[rows], values[rows]
+
+    if tmin is None: tmin = -np.inf
+    if tmax is None: tmax =  np.inf
+
+    order  = np.argsort(times, kind = 'stable')
+    times  = times[order]
+    values = values[order]
+
+    select = (times >= tmin) * (times < tmax)
+
+    return times[select], values[select]
+
+
+if __name__ == "__main__":
+
+    update_time_series_store()
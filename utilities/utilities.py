@@ -2,12 +2,20 @@ import numpy as np
 import sys
 import contextlib
 import glob
+import os
 import deepdish as dd
+import h5py
+import functools
+from multiprocessing import Pool
 
 from galaxy_analysis.static_data import asym_to_anum
+from galaxy_analysis.utilities import time_series_store
 
 from astroML.time_series import ACF_EK
 
+# name of the sidecar time index file kept with the analysis outputs
+TIME_INDEX_NAME = 'galaxy_time_index.h5'
+
 def map_to_pixels(x0,x1,y0=None, y1=None):
     """
     Map a single axis (or two axes with optional
@@ -237,7 +245,7 @@ rowcoldict = {2 : (1,1), 3: (1,3), 4:(2,2),
               25: (5,5)}
 
 def get_property(field_path, file_list=None, dir = '.', tmin = None, tmax = None, data_list = None,
-                 times = None, self_contained = False):
+                 times = None, self_contained = False, store = None):
     """
     field_path can either be a list of strings corresponding to the kwargs in the nested dictionary
     to pull from, or just a single string with kwargs separated by '/'. Must have a leading '/'.
@@ -246,12 +254,27 @@ def get_property(field_path, file_list=None, dir = '.', tmin = None, tmax = None
              field_path = ['meta_data','M_HI']
         or
              firld_path = '/meta_data/M_HI'
+
+    If `store` is given (the file name of a consolidated time series store
+    in `dir`, see time_series_store), the values are read from the store
+    in a single read instead of from each output file, and are returned
+    as from the output files: values and times if file_list is None,
+    otherwise only the values for each file in file_list. The store is
+    not used for self-contained data.
     """
 
     return_times = False
     if file_list is None:
         return_times = True
 
+    if not (store is None) and not self_contained:
+        t, x = time_series_store.get_time_series(field_path, dir = dir, store_name = store,
+                                                 tmin = tmin, tmax = tmax, file_list = file_list)
+        if return_times:
+            return x, t
+        else:
+            return x
+
     if file_list is None:
         file_list, t = select_data_by_time( dir = dir, tmin = tmin, tmax = tmax,
                                             data_list = None, times = None, self_contained = False)
@@ -283,6 +306,207 @@ def get_property(field_path, file_list=None, dir = '.', tmin = None, tmax = None
     else:
         return x
 
+def _load_paths(fname, paths, prefix = ''):
+    """
+    Read several paths (each prefixed with `prefix`) from one file
+    """
+    return dd.io.load(fname, [prefix + x for x in paths])
+
+def _flatten_leaves(value, path):
+    """
+    Flatten a (possibly nested) dictionary loaded from `path` into
+    {'/path/to/leaf' : value}. Tuple keys (e.g. ('gas','cell_mass'))
+    become one path component per element. Non-dictionary values are
+    returned as {path : value}.
+    """
+
+    if not isinstance(value, dict):
+        return {path : value}
+
+    flat = {}
+    for k in value.keys():
+        if isinstance(k, tuple):
+            name = '/'.join([str(y) for y in k])
+        else:
+            name = str(k)
+
+        flat.update(_flatten_leaves(value[k], path + '/' + name))
+
+    return flat
+
+def get_properties(field_paths, file_list=None, dir = '.', tmin = None, tmax = None, data_list = None,
+                   times = None, self_contained = False, nproc = 1):
+    """
+    Batched version of `get_property` for a list of field paths. Each
+    file is opened once to read all requested paths, optionally reading
+    files in parallel on a pool of `nproc` processes (not threads, as
+    deepdish / PyTables is not thread safe).
+
+    field_paths is a list of field paths, each either a list of strings
+    or a single string with kwargs separated by '/' (see `get_property`).
+
+    Returns a dictionary of arrays stacked over files, keyed by each
+    field path as a '/' separated string with a leading '/'. Paths to
+    groups (dictionaries) are flattened, giving one stacked array per
+    leaf keyed by its full path (see `_flatten_leaves`); leaves missing
+    from some files are NaN there. If file_list is None, the times of
+    the selected files are also returned, as in `get_property`.
+    """
+
+    return_times = False
+    if file_list is None:
+        return_times = True
+        file_list, t = select_data_by_time( dir = dir, tmin = tmin, tmax = tmax,
+                                            data_list = None, times = None, self_contained = False)
+
+    paths = []
+    for field_path in field_paths:
+        if isinstance(field_path, str):
+            if field_path[0] != '/':
+                field_path = '/' + field_path
+        else:
+            field_path = "/" + "/".join(field_path)
+        paths.append(field_path)
+
+    if self_contained:
+        if not isinstance(file_list, str):
+            print("If loading self-contained data, file_list MUST be the name of the file")
+            raise ValueError
+
+        if data_list is None:
+            print("If loading self-contained data, data_list must be kwargs of 'files' in top level to loop over")
+            raise ValueError
+
+        # one file, so read in serial
+        load_data = lambda dname : _load_paths(file_list, paths, prefix = '/' + str(dname))
+        all_data  = list(map(load_data, data_list))
+
+    elif nproc > 1:
+        pool = Pool(nproc)
+        all_data = pool.map(functools.partial(_load_paths, paths = paths), file_list)
+        pool.close()
+        pool.join()
+    else:
+        all_data = [_load_paths(fname, paths) for fname in file_list]
+
+    x = {}
+    for j, field_path in enumerate(paths):
+        flat   = [_flatten_leaves(d[j], field_path) for d in all_data]
+
+        leaves = []
+        for f in flat:
+            leaves += [k for k in f.keys() if not (k in leaves)]
+
+        for leaf in leaves:
+            present = [f[leaf] for f in flat if leaf in f]
+            missing = np.full(np.shape(present[0]), np.nan)
+
+            try:
+                x[leaf] = np.array( [f.get(leaf, missing) for f in flat] )
+            except ValueError:
+                print("Cannot stack " + leaf + " over files, as its shape differs between files")
+                raise
+
+    if return_times:
+        return x, t
+    else:
+        return x
+
+def _index_output(fname):
+    """
+    Gather the time index entry (time, cycle, top level keys) for a
+    single DD????_galaxy_data.h5 file
+    """
+
+    time = dd.io.load(fname, '/meta_data/Time')
+    if hasattr(time, 'value'):
+        time = time.value
+
+    try:
+        cycle = int(dd.io.load(fname, '/meta_data/cycle'))
+    except:
+        cycle = -1 # not saved for older outputs
+
+    with h5py.File(fname, 'r') as f:
+        keys = ','.join(sorted(f.keys()))
+
+    return float(time), cycle, keys
+
+def load_time_index(data_list, index_name = TIME_INDEX_NAME):
+    """
+    Load the time index for a list of DD????_galaxy_data.h5 files. The
+    index (file name, mtime, time, cycle, and top level keys of each
+    file) is kept in a small sidecar file (`index_name`) in the directory
+    of the outputs. It is built the first time it is needed, and entries
+    are only recomputed for files that are new or whose mtime changed.
+
+    Parameters
+    ----------
+    data_list : list
+        Paths to the outputs
+    index_name : str, optional
+        File name of the sidecar index. Default : TIME_INDEX_NAME
+
+    Returns
+    -------
+    index : dict
+        Dictionary with arrays 'Time', 'cycle', and 'mtime' and a list
+        of lists 'keys', aligned with data_list
+    """
+
+    n     = len(data_list)
+    index = {'Time' : np.zeros(n), 'cycle' : np.zeros(n, dtype = int),
+             'mtime' : np.zeros(n), 'keys' : [None] * n}
+
+    # one index per directory
+    directories = {}
+    for i, fname in enumerate(data_list):
+        directories.setdefault(os.path.dirname(fname), []).append(i)
+
+    for directory in directories.keys():
+        index_file = os.path.join(directory, index_name)
+
+        entries = {}
+        if os.path.isfile(index_file):
+            with h5py.File(index_file, 'r') as f:
+                for j, name in enumerate(f['files'][...]):
+                    entries[name.decode()] = (f['mtime'][j], f['Time'][j],
+                                              f['cycle'][j], f['keys'][j].decode())
+
+        changed = False
+        for i in directories[directory]:
+            fname = data_list[i]
+            name  = os.path.basename(fname)
+            mtime = os.path.getmtime(fname)
+
+            if (not (name in entries)) or (entries[name][0] != mtime):
+                entries[name] = (mtime,) + _index_output(fname)
+                changed = True
+
+            index['mtime'][i], index['Time'][i], index['cycle'][i], keys = entries[name]
+            index['keys'][i] = keys.split(',')
+
+        if changed:
+            # write to a temporary file and swap, so readers never see a partial index
+            names = sorted(entries.keys())
+            with h5py.File(index_file + '.tmp', 'w') as f:
+                f.create_dataset('files', data = np.array(names).astype('S'))
+                f.create_dataset('mtime', data = np.array([entries[x][0] for x in names]))
+                f.create_dataset('Time',  data = np.array([entries[x][1] for x in names]))
+                f.create_dataset('cycle', data = np.array([entries[x][2] for x in names]))
+                f.create_dataset('keys',  data = np.array([entries[x][3] for x in names]).astype('S'))
+            os.replace(index_file + '.tmp', index_file)
+
+    return index
+
+def output_times(data_list):
+    """
+    Simulation time of each of a list of DD????_galaxy_data.h5 files,
+    from the time index (see `load_time_index`)
+    """
+
+    return load_time_index(data_list)['Time']
+
 def select_data_by_time(dir = '.', tmin = None, tmax = None,
                         data_list = None, times = None, self_contained = False):
     """
@@ -308,8 +532,7 @@ def select_data_by_time(dir = '.', tmin = None, tmax = None,
         for i, d in enumerate(data_list):
             times[i] = sc_data[d]['general']['Time']
     else:
-        for i, d in enumerate(data_list):
-            times[i] = dd.io.load(d, '/meta_data/Time')
+        times = output_times(data_list)
 
     # now select which data sets to average
     if tmin is None and tmax is None:
@@ -581,7 +804,24 @@ def weighted_percentile(values, percentiles, weight=None, values_sorted=False):
     return weighted_quantile(values, percentiles/100.0, weight=weight, values_sorted=values_sorted)
 
 
-def compute_statistics(values, weights=None, limits = [-np.inf, np.inf]):
+#
+# size above which `compute_statistics` switches to approximate percentiles
+# by default (None is always exact), and the number of histogram bins used
+#
+APPROXIMATE_STATISTICS_SIZE  = None
+APPROXIMATE_STATISTICS_NBINS = 4096
+
+#
+# percentiles computed by `compute_statistics` and `binned_statistics`, with
+# string formatter to eliminate trailing zeros and decimals in percentile
+#
+# e.g. percentile_0.135  and percentile_10
+#
+_PERCENTILES_LIST = [0.135, 2.275, 10, 15.865, 25, 50, 75, 84.135, 90, 97.725, 99.865]
+_perc_string      = lambda x : ("%.3f"%(x)).rstrip("0").rstrip('.')
+
+def compute_statistics(values, weights=None, limits = [-np.inf, np.inf],
+                       approximate_above = None):
     """
     Compute a set of statistics for a given set of values with optional
     weights and limits.
@@ -600,6 +840,12 @@ def compute_statistics(values, weights=None, limits = [-np.inf, np.inf]):
     limits    : list, tuple (optional)
                 Minimum and maximum values to consider (2D list, tuple).
                 Default considers all values. Default: [-np.inf, np.inf].
+    approximate_above : int (optional)
+                If the number of values is above this size, percentiles
+                are computed approximately from a fixed-bin weighted
+                histogram instead of a full sort (mean, variance, min,
+                and max remain exact). Default: APPROXIMATE_STATISTICS_SIZE
+                (None, always exact).
 
     Returns:
     --------
@@ -619,16 +865,9 @@ def compute_statistics(values, weights=None, limits = [-np.inf, np.inf]):
              'mean_median_diff' : 0,
              'variance' : 0,
              'std': 0, 'min' : 0, 'max' : 0}
-    #
-    # percentiles to compute, with string formatter
-    # to eliminate trailing zeros and decimals in percentile
-    #
-    # e.g. percentile_0.135  and percentile_10
-    #
-    percentiles_list = [0.135, 2.275, 10, 15.865, 25, 50, 75, 84.135, 90, 97.725, 99.865]
-    perc_string = lambda x : ("%.3f"%(x)).rstrip("0").rstrip('.')
-    for pval in percentiles_list:
-        stats['percent_' + perc_string(pval)] = 0
+    # percentiles to compute
+    for pval in _PERCENTILES_LIST:
+        stats['percent_' + _perc_string(pval)] = 0
 
     # some shorthand percentiles for the 1,2,3 sigma percentiles
     for k in ['0.1','2','16','84','98','99']:
@@ -653,17 +892,179 @@ def compute_statistics(values, weights=None, limits = [-np.inf, np.inf]):
 
         _weights = weights[mask]
 
-    stats['limits'] = limits
+    if approximate_above is None:
+        approximate_above = APPROXIMATE_STATISTICS_SIZE
+
+    #
+    # sort once (or histogram once, for very large arrays), build the
+    # weighted CDF once, and read every percentile off of it
+    #
+    quantiles = np.array(_PERCENTILES_LIST) / 100.0
+    if (not (approximate_above is None)) and (nvalues > approximate_above):
+        segment_stats = _approximate_statistics(_values, _weights, quantiles)
+    else:
+        segment_stats = segmented_statistics(_values, np.zeros(nvalues, dtype = np.int64), 1,
+                                             weights = _weights, quantiles = quantiles)
+
+    _stats = _statistics_from_segments(segment_stats, limits = limits)
+
+    # unpack the single segment
+    for k in _stats.keys():
+        if k == 'limits':
+            stats[k] = _stats[k]
+        elif k in ['1-sigma','2-sigma','3-sigma']:
+            stats[k] = [_stats[k][0][0], _stats[k][1][0]]
+        else:
+            stats[k] = _stats[k][0]
+
     stats['number'] = nvalues
 
+    return stats
+
+def segmented_statistics(values, segments, nsegments, weights = None,
+                         quantiles = None):
+    """
+    Weighted statistics of `values` computed separately within each of
+    `nsegments` groups, all at once. Values are sorted once by
+    (segment, value), the weighted CDF of every segment is built from a
+    single cumulative sum, and all quantiles of all segments are read off
+    that CDF in vectorized form (interpolating as in `weighted_quantile`).
+
+    Parameters
+    ----------
+    values    : 1D array
+                Values to compute statistics of
+    segments  : 1D int array
+                Segment (e.g. bin) index of each value, in [0, nsegments)
+    nsegments : int
+                Number of segments
+    weights   : 1D array, optional
+                Weights for each value. Default : None (equal weights)
+    quantiles : 1D array, optional
+                Quantiles in [0,1] to compute in each segment. Default : None
+
+    Returns
+    -------
+    result : dictionary
+             Arrays over segments of 'number', 'sum_of_weights', 'mean',
+             'variance', 'min' and 'max', and a (nsegments x nquantiles)
+             array 'quantiles'. Statistics of empty segments are NaN.
+    """
+
+    values   = np.asarray(values, dtype = np.float64)
+    segments = np.asarray(segments, dtype = np.int64)
+    if weights is None:
+        weights = np.ones(np.size(values))
+    weights  = np.asarray(weights, dtype = np.float64)
+
+    if quantiles is None:
+        quantiles = []
+    quantiles = np.atleast_1d(np.asarray(quantiles, dtype = np.float64))
+
+    order = np.lexsort((values, segments))
+    v     = values[order]
+    s     = segments[order]
+    w     = weights[order]
+
+    number = np.bincount(s, minlength = nsegments)
+    W      = np.bincount(s, weights = w, minlength = nsegments)
+    empty  = (number == 0)
+
+    starts = np.zeros(nsegments + 1, dtype = np.int64)
+    starts[1:] = np.cumsum(number)
+
+    result = {'number' : number, 'sum_of_weights' : W}
+
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        mean = np.bincount(s, weights = w * v, minlength = nsegments) / W
+        result['mean']     = mean
+        result['variance'] = np.bincount(s, weights = w * (v - mean[s])**2,
+                                         minlength = nsegments) / W
+
+    nvalues = np.size(v)
+    first   = np.clip(starts[:-1], 0, max(nvalues - 1, 0))
+    last    = np.clip(starts[1:] - 1, 0, max(nvalues - 1, 0))
 
-    stats['mean']      = np.average(_values, weights=_weights)
-    stats['variance']  = np.sum(weights/np.sum(weights) * (_values - stats['mean'])**2)
-    stats['std']       = np.sqrt(stats['variance'])
+    result['min'] = np.where(empty, np.nan, v[first] if nvalues > 0 else np.nan)
+    result['max'] = np.where(empty, np.nan, v[last]  if nvalues > 0 else np.nan)
 
-    for pval in percentiles_list:
-        stats['percent_' + perc_string(pval)] =\
-                                  weighted_percentile(_values,pval,_weights)
+    if np.size(quantiles) == 0 or nvalues == 0:
+        result['quantiles'] = np.nan * np.ones((nsegments, np.size(quantiles)))
+        return result
+
+    # weighted CDF of each segment from a single cumulative sum
+    cw     = np.cumsum(w)
+    offset = np.concatenate([[0.0], cw])[starts[:-1]]
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        cdf = (cw - 0.5 * w - offset[s]) / W[s]
+
+    # locate every (segment, quantile) pair with one search on a key
+    # that is monotonic across segments
+    key     = s + cdf
+    targets = np.arange(nsegments)[:,np.newaxis] + quantiles[np.newaxis,:]
+    pos     = np.searchsorted(key, targets.ravel(), side = 'right').reshape(np.shape(targets))
+
+    lo = np.clip(pos - 1, first[:,np.newaxis], last[:,np.newaxis])
+    hi = np.clip(pos,     first[:,np.newaxis], last[:,np.newaxis])
+
+    dcdf = cdf[hi] - cdf[lo]
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        frac = np.where(dcdf > 0, (quantiles[np.newaxis,:] - cdf[lo]) / dcdf, 0.0)
+    frac = np.clip(frac, 0.0, 1.0)
+
+    q = v[lo] + frac * (v[hi] - v[lo])
+    q[empty] = np.nan
+    result['quantiles'] = q
+
+    return result
+
+def _approximate_statistics(values, weights, quantiles, nbins = None):
+    """
+    Single segment version of `segmented_statistics` that avoids sorting.
+    Moments, min, and max are exact; quantiles are interpolated from the
+    weighted CDF of a fixed-bin histogram of the values.
+    """
+
+    if nbins is None:
+        nbins = APPROXIMATE_STATISTICS_NBINS
+
+    values  = np.asarray(values, dtype = np.float64)
+    weights = np.asarray(weights, dtype = np.float64)
+
+    W    = np.sum(weights)
+    mean = np.sum(weights * values) / W
+
+    result = {'number'         : np.array([np.size(values)]),
+              'sum_of_weights' : np.array([W]),
+              'mean'           : np.array([mean]),
+              'variance'       : np.array([np.sum(weights * (values - mean)**2) / W]),
+              'min'            : np.array([np.min(values)]),
+              'max'            : np.array([np.max(values)])}
+
+    hist, edges = np.histogram(values, bins = nbins, range = (result['min'][0], result['max'][0]),
+                               weights = weights)
+    cdf = np.zeros(nbins + 1)
+    cdf[1:] = np.cumsum(hist) / W
+
+    result['quantiles'] = np.interp(quantiles, cdf, edges)[np.newaxis,:]
+
+    return result
+
+def _statistics_from_segments(segment_stats, limits = None):
+    """
+    Map the output of `segmented_statistics` onto the named statistics
+    returned by `compute_statistics` (each as an array over segments).
+    """
+
+    stats = {}
+    stats['limits']   = limits
+    stats['number']   = segment_stats['number']
+    stats['mean']     = segment_stats['mean']
+    stats['variance'] = segment_stats['variance']
+    stats['std']      = np.sqrt(stats['variance'])
+
+    for i, pval in enumerate(_PERCENTILES_LIST):
+        stats['percent_' + _perc_string(pval)] = segment_stats['quantiles'][:,i]
 
     stats['median'] = stats['percent_50']
 
@@ -687,9 +1088,8 @@ def compute_statistics(values, weights=None, limits = [-np.inf, np.inf]):
     stats['mean_median_diff']     = stats['mean'] - stats['median']
 
     # min, max
-    stats['min'] = np.min(_values)
-    stats['max'] = np.max(_values)
-
+    stats['min'] = segment_stats['min']
+    stats['max'] = segment_stats['max']
 
     return stats
 
@@ -749,7 +1149,6 @@ def binned_statistics(values_x, values_y, limits = None, nbins = 100,
         limits = [bins[0], bins[-1]]
         nbins  = np.size(bins)
 
-
     mask = (values_x >= limits[0]) * (values_x < limits[-1])
     _values_x = values_x[mask]
     _values_y = values_y[mask]
@@ -759,10 +1158,6 @@ def binned_statistics(values_x, values_y, limits = None, nbins = 100,
     else:
         _weights = weights[mask]
 
-    # get kwargs of statistics that will be computed
-    # to build dictionary of lists to house the binned stats
-    empty_stats = compute_statistics(None)
-
     binned_stats = {'bins'        : bins,      # bin edges
                     'lbins'       : bins[:-1], # left bin edges
                     'rbins'       : bins[1:],  # right bin edges
@@ -775,64 +1170,91 @@ def binned_statistics(values_x, values_y, limits = None, nbins = 100,
                     'nbins'       : nbins}
 
     #
-    # initialize the statistics (better than appending to a list)
+    # bin [bins[i], bins[i+1]) is segment i. Apply the y limits once and
+    # compute the statistics of every bin together
     #
+    n_segments  = np.size(bins) - 1
+    bin_indexes = np.clip(np.digitize(_values_x, bins, right = False) - 1, 0, n_segments - 1)
+
+    y_mask      = (_values_y >= y_limits[0]) * (_values_y < y_limits[-1])
+
+    segment_stats = segmented_statistics(_values_y[y_mask], bin_indexes[y_mask], n_segments,
+                                         weights = _weights[y_mask],
+                                         quantiles = np.array(_PERCENTILES_LIST) / 100.0)
+
+    stats = _statistics_from_segments(segment_stats)
 
     # stats to skip and not save in binned statistic.
     # these are all lists / tuples and redundant with other
     # information
     skip_stats = ['limits','1-sigma','2-sigma','3-sigma']
 
-    for k in empty_stats.keys():
+    empty = segment_stats['number'] == 0
+    for k in stats.keys():
         if k in skip_stats:
             continue
-        binned_stats[k] = np.zeros(binned_stats['nbins']-1)
+        binned_stats[k] = np.array(stats[k], dtype = np.float64)
+        #
+        # Set the stats of empty bins to the empty value
+        # (by default, np.nan to mask out when plotting)
+        #
+        if k != 'number':
+            binned_stats[k][empty] = empty_value
 
+    # save masked y values if requested
     if return_binned_values:
-        binned_stats['binned_y'] = [None] * binned_stats['nbins']
+        binned_stats['binned_y'] = [_values_y[bin_indexes == i] for i in np.arange(n_segments)]
 
-    #
-    # generate the masks for all of the points
-    #
-    bin_indexes = np.digitize(_values_x, bins, right = False)
-    print(binned_stats['nbins'],np.min(bin_indexes),np.max(bin_indexes))
-    for i in np.arange(binned_stats['nbins']-1):
-        #
-        # Generate mask and get y values in this bin
-        #
-        mask     = bin_indexes == i
-        masked_y = _values_y[mask]
+    return binned_stats
 
-        #
-        # compute and save all stats for this bin.
-        # this function returns
-        #
-        stats = compute_statistics(masked_y, weights = _weights[mask],
-                                   limits = y_limits)
-        if stats['number'] == 0:
-            #
-            # Set the stats to the empty value
-            # (by default, np.nan to mask out when plotting)
-            #
-            for k in stats.keys():
-                if k in skip_stats:
-                    continue
-                binned_stats[k][i] = empty_value
-            stats['number'] = 0
+def segmented_weighted_stats(values, segments, nsegments, weights):
+    """
+    Segmented version of `compute_weighted_stats`. Computes the same
+    weighted statistics (same keys) independently for each of
+    `nsegments` groups of `values`, where `segments` gives the integer
+    group index (0 <= segments < nsegments) of each value. All groups
+    are handled with a single sort through `segmented_statistics`.
 
-        else:
-            for k in stats.keys():
-                if k in skip_stats:
-                    continue
-                # print(i,k,stats[k])
-                binned_stats[k][i] = stats[k]
+    Parameters
+    ----------
+    values : array
+        Values to compute statistics of
+    segments : integer array
+        Group index of each value
+    nsegments : int
+        Total number of groups
+    weights : array
+        Weights of each value
+
+    Returns
+    -------
+    d : dict
+        Dictionary of arrays (of size nsegments) for each statistic.
+        Empty groups are NaN.
+    """
 
-        # save masked y values if requested
-        if return_binned_values:
-            binned_stats['binned_y'][i] = masked_y
+    _stats = segmented_statistics(values, segments, nsegments,
+                                  weights = weights, quantiles = [0.1, 0.25, 0.5, 0.75, 0.9])
 
+    d = {}
+    d['w-avg_mean'] = _stats['mean'] # not necessarily the actual mean we might be interested in
+    d['mean']       = 1.0*d['w-avg_mean'] # for backwards compatability (but this is bad)
+    d['variance']   = _stats['variance']
+    d['std']        = np.sqrt(d['variance'])
 
-    return binned_stats
+    q             = _stats['quantiles']
+    d['decile_1']  = q[:,0] # decile 1
+    d['Q1']        = q[:,1] # quartile 1
+    d['median']    = q[:,2]
+    d['Q3']        = q[:,3]
+    d['decile_9']  = q[:,4]
+    d['inner_quartile_range'] = d['Q3'] - d['Q1']
+    d['d9_d1_range']        = d['decile_9'] - d['decile_1']
+
+    d['min']      = _stats['min']
+    d['max']      = _stats['max']
+
+    return d
 
 def compute_weighted_stats(x, w, return_dict = True):
     """
@@ -854,24 +1276,12 @@ def compute_weighted_stats(x, w, return_dict = True):
     if hasattr(w,'value'):
         _w = w.value
 
-    d = {}
-    d['w-avg_mean'] = np.average(                _x, weights=_w) # not necessarily the actual mean we might be interested in
-    d['mean']       = 1.0*d['w-avg_mean'] # for backwards compatability (but this is bad)
-    d['variance']   = np.average( (_x-d['mean'])**2, weights=_w)
-    d['std']        = np.sqrt(d['variance'])
+    # moments and all quantiles from a single sort
+    _stats = segmented_weighted_stats(_x, np.zeros(np.size(_x), dtype = np.int64), 1, _w)
 
-    # no weighted quantiles in numpy - need to use defined function
-    q             = weighted_quantile(_x, [0.1, 0.25, 0.5, 0.75, 0.9], weight=_w)
-    d['decile_1']  = q[0] # decile 1
-    d['Q1']        = q[1] # quartile 1
-    d['median']    = q[2]
-    d['Q3']        = q[3]
-    d['decile_9']  = q[4]
-    d['inner_quartile_range'] = d['Q3'] - d['Q1']
-    d['d9_d1_range']        = d['decile_9'] - d['decile_1']
-
-    d['min']      = np.min(_x)
-    d['max']      = np.max(_x)
+    d = {}
+    for k in _stats.keys():
+        d[k] = _stats[k][0]
 
     if hasattr(x, 'value'):
         for k in d.keys():
@@ -879,6 +1289,277 @@ def compute_weighted_stats(x, w, return_dict = True):
 
     return d
 
+def sort_events(event_times, weights = None):
+    """
+    Sort event times (e.g. star formation or SN times) once so that
+    cumulative counts and rates can be computed for any set of sample
+    times with `cumulative_events` and `event_rate`.
+
+    Parameters
+    ----------
+    event_times : array
+        Time of each event
+    weights : array, optional
+        Weight of each event (e.g. mass formed). Default : None (each
+        event counts as 1)
+
+    Returns
+    -------
+    events : tuple
+        (sorted event times, cumulative weights), where the cumulative
+        weights have a leading zero
+    """
+
+    event_times = np.asarray(event_times, dtype = np.float64)
+    order       = np.argsort(event_times, kind = 'stable')
+
+    if weights is None:
+        weights = np.ones(np.size(event_times))
+    weights = np.asarray(weights, dtype = np.float64)[order]
+
+    cumulative = np.zeros(np.size(event_times) + 1)
+    cumulative[1:] = np.cumsum(weights)
+
+    return event_times[order], cumulative
+
+def cumulative_events(events, times):
+    """
+    Total weight of all events with time <= each of `times`, given
+    events from `sort_events` (with times in the same units)
+    """
+
+    sorted_times, cumulative = events
+
+    return cumulative[np.searchsorted(sorted_times, np.asarray(times, dtype = np.float64), side = 'right')]
+
+def event_rate(events, times):
+    """
+    Rate of events (total weight per unit time) in each of the bins
+    between consecutive `times`, given events from `sort_events`
+    (with times in the same units)
+    """
+
+    times = np.asarray(times, dtype = np.float64)
+
+    return np.diff(cumulative_events(events, times)) / np.diff(times)
+
+def masked_field_sums(data_source, fields, filters, units = 'Msun'):
+    """
+    Sums a set of fields over a set of masks in a single pass over
+    the data. Each field is read exactly once per chunk of `data_source`,
+    each mask is evaluated once per chunk, and all (mask, field) sums
+    are accumulated together as a single matrix product.
+
+    Parameters
+    ----------
+    data_source : yt data container
+            Region to reduce over (e.g. ds.all_data(), a disk or a sphere).
+    fields      : list
+            List of yt field names to sum.
+    filters     : dict
+            Dictionary of mask name -> function. Each function takes a
+            chunk of the data source and returns a boolean array
+            (e.g. the functions in `static_data.ISM_FILTER`). A value
+            of None selects every cell in the data source.
+    units       : string or list, optional
+            Units to convert each field to before summing. Either a single
+            string for all fields or a list of the same length as `fields`.
+            Default : 'Msun'
+
+    Returns
+    -------
+    sums : dictionary
+            Nested dictionary of sums as floats, sums[filter_name][field].
+    """
+
+    if isinstance(units, str):
+        units = [units] * len(fields)
+
+    if len(units) != len(fields):
+        print("Must provide one unit per field (%i) or a single unit string (%i)"%(len(fields),len(units)))
+        raise ValueError
+
+    names  = list(filters.keys())
+    totals = np.zeros((len(names), len(fields)))
+
+    for chunk in data_source.chunks([], 'io'):
+        # (nfields x ncells) block, each field read once
+        values = np.array([np.asarray(chunk[f].to(u)) for f,u in zip(fields,units)])
+        ncells = np.shape(values)[1]
+
+        if ncells == 0:
+            continue
+
+        # (nfilters x ncells) block of masks
+        masks = np.empty((len(names), ncells))
+        for i, name in enumerate(names):
+            if filters[name] is None:
+                masks[i] = 1.0
+            else:
+                masks[i] = np.asarray(filters[name](chunk), dtype = bool)
+
+        totals += np.dot(masks, values.T)
+
+    sums = {}
+    for i, name in enumerate(names):
+        sums[name] = {}
+        for j, f in enumerate(fields):
+            sums[name][f] = totals[i,j]
+
+    return sums
+
+def binned_field_sums(x, bins, values, mask = None):
+    """
+    Sums one or more fields in bins of `x`. The coordinate is digitized
+    once and every field is summed together with a single weighted
+    `np.bincount` over a stacked (nfields x n) matrix.
+
+    Parameters
+    ----------
+    x      : 1D array
+            Coordinate to bin on.
+    bins   : 1D array
+            Monotonically increasing bin edges. Bin i contains
+            bins[i] <= x < bins[i+1]; values outside the bins are ignored.
+    values : 1D or 2D array
+            Field values to sum, either a single field of the same length
+            as `x` or a stacked (nfields x len(x)) array.
+    mask   : 1D bool array, optional
+            Only sum values where mask is True. Default : None
+
+    Returns
+    -------
+    sums : array
+            Sums in each bin, (nfields x nbins), or (nbins) if `values`
+            is 1D.
+    """
+
+    x      = np.asarray(x)
+    values = np.asarray(values)
+
+    single = (np.ndim(values) == 1)
+    values = np.atleast_2d(values)
+
+    nfields = np.shape(values)[0]
+    nbins   = np.size(bins) - 1
+
+    index  = np.digitize(x, bins) - 1
+    select = (index >= 0) * (index < nbins)
+    if not (mask is None):
+        select = select * np.asarray(mask, dtype = bool)
+
+    index = index[select]
+
+    # offset each field into its own block of bins so all fields
+    # are summed together in one pass
+    flat_index = (np.arange(nfields)[:,np.newaxis] * nbins + index).ravel()
+    sums = np.bincount(flat_index, weights = values[:,select].ravel(),
+                       minlength = nfields * nbins).reshape(nfields, nbins)
+
+    if single:
+        return sums[0]
+
+    return sums
+
+def save_dict_to_hdf5_group(parent, name, dictionary):
+    """
+    Write a nested dictionary into a new group `name` of an open h5py
+    file or group. Dictionaries become groups and everything else is
+    written as a dataset. None values become NaN, lists of strings are
+    stored as fixed-length byte strings, and unit-ful yt arrays are
+    stored as plain values (in their current units).
+
+    Parameters
+    ----------
+    parent : h5py File or Group
+        Open (writeable) HDF5 location to create the group in
+    name : str
+        Name of the new group
+    dictionary : dict
+        Nested dictionary to save
+
+    Returns
+    -------
+    group : h5py Group
+        The newly created group
+    """
+
+    group = parent.create_group(name)
+
+    for k in dictionary.keys():
+        value = dictionary[k]
+
+        if isinstance(value, dict):
+            save_dict_to_hdf5_group(group, str(k), value)
+            continue
+
+        if value is None:
+            value = np.nan
+        elif hasattr(value, 'value'):
+            value = value.value
+
+        value = np.asarray(value)
+        if value.dtype.kind == 'U':
+            value = value.astype('S')
+        elif value.dtype.kind == 'O':
+            value = np.array(value.tolist(), dtype = float) # None -> NaN
+
+        group.create_dataset(str(k), data = value)
+
+    return group
+
+# attributes written by PyTables (and so deepdish) that are not data
+_PYTABLES_ATTRIBUTES = ['CLASS', 'TITLE', 'VERSION', 'FILTERS', 'PYTABLES_FORMAT_VERSION',
+                        'DEEPDISH_IO_VERSION']
+
+def load_dict_from_hdf5_group(group):
+    """
+    Load an h5py group into a nested dictionary (inverse of
+    `save_dict_to_hdf5_group`). Byte strings are decoded to str.
+    Attributes are loaded as entries too, as these are where deepdish
+    (PyTables) stores scalars, apart from the PyTables bookkeeping
+    attributes.
+
+    Parameters
+    ----------
+    group : h5py File or Group
+        Open HDF5 location to read
+
+    Returns
+    -------
+    dictionary : dict
+    """
+
+    dictionary = {}
+    for k in group.keys():
+        item = group[k]
+
+        if isinstance(item, h5py.Group):
+            dictionary[k] = load_dict_from_hdf5_group(item)
+            continue
+
+        value = item[()]
+        if isinstance(value, bytes):
+            value = value.decode()
+        elif isinstance(value, np.ndarray) and value.dtype.kind == 'S':
+            value = value.astype('U')
+
+        dictionary[k] = value
+
+    for k in group.attrs.keys():
+        if k in _PYTABLES_ATTRIBUTES:
+            continue
+
+        value = group.attrs[k]
+        if isinstance(value, bytes):
+            value = value.decode()
+        elif isinstance(value, np.ndarray) and value.dtype.kind == 'S':
+            value = value.astype('U')
+
+        dictionary[k] = value
+
+    return dictionary
+
 def chemistry_species_from_fields(fields):
     """
     Returns a list of the individual chemical species fields
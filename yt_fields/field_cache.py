@@ -0,0 +1,531 @@
+"""
+    field_cache
+
+    Notes: Opt-in, on-disk cache for expensive derived fields. Once
+           enabled for a set of fields, each field is computed at most
+           once per grid (or data object and io chunk) and output: the
+           result is written to a sidecar HDF5 file next to the output
+           (DDxxxx/DDxxxx.field_cache.h5) and read back on later loads
+           instead of being recomputed. cache_statistics counts reads
+           from and writes to the cache.
+
+           One cache file is kept open at a time (that of the output
+           being worked on). A cache file that another process has open
+           for writing (e.g. when task_runner workers share an output)
+           is read only or, if locked, silently not used: those fields
+           are computed but not cached.
+
+           Cached values are stored per field, keyed by a hash of the
+           function that generates the field (its code, the values it
+           closes over, e.g. element names or modes, and the module
+           level functions and static data, e.g. SOLAR_ABUNDANCE, that
+           it refers to by name), of the same for every field it depends
+           on (e.g. O_log_abundance and H_log_abundance for O_over_H),
+           and of CACHE_VERSION. Fields whose functions close over
+           anything other than primitive values (e.g. a data set) are
+           not cached. Changes the hash cannot see (e.g. to yt, to
+           attributes of other modules, or to data read from files)
+           are NOT detected: in that case remove the cache files by
+           hand (clear_field_cache) or bump CACHE_VERSION. The total size of
+           all cache files can be capped, in which case the least recently
+           written files are removed first.
+
+           Usage (before loading data sets):
+
+               > from galaxy_analysis.yt_fields import field_cache
+               > field_cache.enable_field_cache(['O_over_H', 'Fe_over_H'])
+"""
+import numpy as np
+import hashlib
+import glob
+import os
+import atexit
+
+import h5py
+import yt
+from yt.fields.local_fields import local_fields
+
+
+CACHE_SUFFIX = '.field_cache.h5'
+
+# part of every cache key - bump to invalidate all existing cache files
+CACHE_VERSION = 1
+
+# settings for the cache. 'max_size' is in bytes (None for no limit)
+_cache_settings = {'max_size' : None}
+
+# field info container and original (uncached) function of each field
+# with caching enabled, keyed by (id(field_info), field key)
+_cached_fields = {}
+
+# number of values read from (hits) and computed for (misses) the cache
+_cache_statistics = {'hits' : 0, 'misses' : 0}
+
+# cache files that have been checked against max_size in this session
+_evicted_for = set()
+
+# (cache file, field) pairs whose values from older versions of the
+# field have been removed in this session
+_pruned = set()
+
+# the one cache file kept open (see _cache_file)
+_open_cache = {'filename' : None, 'file' : None}
+
+
+# types whose repr is the same in every process
+_primitive_types = (str, bytes, bool, int, float, complex, type(None))
+
+def _primitive_repr(value):
+    """
+    repr of a primitive value (or a tuple, list, set or dict of them)
+    that is the same in every process. Raises a TypeError for anything
+    else (e.g. data sets or arrays), whose repr may include memory
+    addresses.
+    """
+
+    if isinstance(value, _primitive_types):
+        return repr(value)
+    elif isinstance(value, (tuple, list)):
+        return type(value).__name__ + "(" + ",".join([_primitive_repr(x) for x in value]) + ")"
+    elif isinstance(value, (set, frozenset)):
+        return type(value).__name__ + "(" + ",".join(sorted([_primitive_repr(x) for x in value])) + ")"
+    elif isinstance(value, dict):
+        return "dict(" + ",".join(sorted([_primitive_repr(k) + ":" + _primitive_repr(value[k])
+                                          for k in value.keys()])) + ")"
+
+    raise TypeError("cannot hash value of type " + type(value).__name__)
+
+def _global_repr(value):
+    """
+    repr of a module level value referred to by a field function, or
+    None if it is not data (e.g. modules and classes) and is skipped
+    """
+
+    if isinstance(value, np.ndarray):
+        return str(value.dtype) + str(value.shape) + hashlib.md5(value.tobytes()).hexdigest()
+
+    try:
+        return _primitive_repr(value)
+    except TypeError:
+        return None
+
+def _function_hash(function):
+    """
+    Hash of a field function's code, of the values it closes over, and
+    of the module level functions and data it refers to by name
+    (recursing into any functions it closes over or calls). Only
+    primitive values are allowed in the closure of the field function
+    itself (see _primitive_repr), so that the hash is the same in every
+    process; a TypeError is raised otherwise. Module level values (and
+    values closed over by module level functions) that are not data
+    (see _global_repr) are skipped.
+    """
+
+    h    = hashlib.md5()
+    seen = set()
+
+    def _update_code(code, f):
+        h.update(code.co_code)
+        h.update(repr(code.co_names).encode())
+        for c in code.co_consts:
+            if hasattr(c, 'co_code'):
+                _update_code(c, f)
+            else:
+                h.update(_primitive_repr(c).encode())
+
+        for name in code.co_names:
+            if not (name in f.__globals__):
+                continue
+
+            value = f.__globals__[name]
+            if hasattr(value, '__code__'):
+                _update(value, strict = False)
+            else:
+                r = _global_repr(value)
+                if not (r is None):
+                    h.update((name + "=" + r).encode())
+        return
+
+    def _update(f, strict = True):
+        if id(f.__code__) in seen:
+            return
+        seen.add(id(f.__code__))
+
+        _update_code(f.__code__, f)
+        for cell in (f.__closure__ or []):
+            value = cell.cell_contents
+            if hasattr(value, '__code__'):
+                _update(value, strict)
+            elif strict:
+                h.update(_primitive_repr(value).encode())
+            else:
+                r = _global_repr(value)
+                if not (r is None):
+                    h.update(r.encode())
+        return
+
+    _update(function)
+
+    return h.hexdigest()
+
+def _field_key(ds, field_name, function_key):
+    """
+    Cache key of a field in a data set: the hash of its own function
+    (function_key), of the functions of every field it depends on
+    (from yt's field dependencies, recursively), and CACHE_VERSION.
+    Computed once per field and data set.
+    """
+
+    keys = ds.__dict__.setdefault('_field_cache_keys', {})
+    if field_name in keys:
+        return keys[field_name]
+
+    h = hashlib.md5()
+    h.update(("%i"%(CACHE_VERSION) + function_key).encode())
+
+    dependencies = getattr(ds, 'field_dependencies', {})
+    seen         = set([field_name])
+
+    def _update(name):
+        if not (name in dependencies):
+            return
+
+        for dependency in sorted(dependencies[name].requested, key = str):
+            if dependency in seen:
+                continue
+            seen.add(dependency)
+
+            h.update(repr(dependency).encode())
+            if dependency in ds.field_info:
+                function = ds.field_info[dependency]._function
+                function = getattr(function, '_field_cache_original', function)
+                try:
+                    h.update(_function_hash(function).encode())
+                except TypeError:
+                    pass # e.g. yt's own fields - only its name is used
+
+            _update(dependency)
+        return
+
+    _update(field_name)
+
+    keys[field_name] = h.hexdigest()
+
+    return keys[field_name]
+
+def _cache_filename(ds):
+    return os.path.join(ds.directory, ds.basename + CACHE_SUFFIX)
+
+def _describe(value):
+    """
+    Stable string for a data object argument or field parameter
+    """
+
+    if hasattr(value, '_con_args'): # another data object (e.g. of a cut region)
+        return str(value._type_name) + "(" +\
+               ",".join([_describe(getattr(value, a, None)) for a in value._con_args]) + ")"
+    elif hasattr(value, 'units') and hasattr(value, 'value'):
+        return repr(np.asarray(value.value).tolist()) + str(value.units)
+    elif isinstance(value, np.ndarray):
+        return repr(value.tolist())
+
+    return repr(value)
+
+def _data_key(data):
+    """
+    Name for the values of this data object, or None if the data object
+    should not be cached (e.g. yt's field detection).
+
+    Grids are keyed by their id. Other data objects (regions, spheres,
+    etc.) are evaluated one io chunk at a time, so are keyed by the data
+    object (its type, construction arguments, and field parameters) and
+    the (sorted) ids of the grids in the current chunk.
+    """
+
+    if getattr(data, '_type_name', None) == 'grid':
+        if not hasattr(data, 'id'):
+            return None
+        return "grid_%i_g%i"%(data.id, getattr(data, '_num_ghost_zones', 0))
+
+    chunk = getattr(data, '_current_chunk', None)
+    if (chunk is None) or (not hasattr(data, '_con_args')):
+        return None
+
+    try:
+        ids = np.sort([g.id for g in chunk.objs])
+    except AttributeError:
+        return None # not grid based
+
+    h = hashlib.md5()
+    h.update(_describe(data).encode())
+    parameters = getattr(data, 'field_parameters', {})
+    for k in sorted(parameters.keys()):
+        h.update((str(k) + _describe(parameters[k])).encode())
+
+    h.update(ids.tobytes())
+
+    return "%s_%s"%(data._type_name, h.hexdigest())
+
+def _evict(ds):
+    """
+    Remove the oldest cache files (by modification time) in the
+    simulation directory until the total size is below max_size. Done
+    once per output (on the first write to its cache file), not on
+    every write.
+    """
+
+    max_size = _cache_settings['max_size']
+    if max_size is None:
+        return
+
+    files = glob.glob(os.path.join(os.path.dirname(os.path.abspath(ds.directory)),
+                                   '*', '*' + CACHE_SUFFIX))
+    files = sorted(files, key = os.path.getmtime)
+    sizes = [os.path.getsize(f) for f in files]
+    total = np.sum(sizes)
+
+    current = os.path.abspath(_cache_filename(ds))
+    for f, size in zip(files, sizes):
+        if total <= max_size:
+            break
+        if os.path.abspath(f) == current:
+            continue
+
+        os.remove(f)
+        total = total - size
+
+    return
+
+def _close_cache_file():
+    """
+    Close the open cache file (if any)
+    """
+
+    if not (_open_cache['file'] is None):
+        try:
+            _open_cache['file'].close()
+        except (IOError, OSError, ValueError):
+            pass # already closed
+
+    _open_cache['filename'] = None
+    _open_cache['file']     = None
+
+    return
+
+atexit.register(_close_cache_file)
+
+def _cache_file(filename):
+    """
+    Handle to the cache file of an output. Only one cache file is kept
+    open at a time: it is opened on first use and stays open (so each
+    output's cache is opened once, not once per field and grid or
+    chunk) until another output's cache is used or the cache is
+    disabled or cleared.
+
+    The file is opened for appending. If that fails, e.g. because
+    another process (such as another task_runner worker) has it open
+    for writing, it is opened read only if possible (values are read
+    but not written); otherwise None is returned and fields of this
+    output are silently computed without caching (until another
+    output's cache is used).
+    """
+
+    if _open_cache['filename'] == filename:
+        return _open_cache['file']
+
+    _close_cache_file()
+
+    try:
+        hf = h5py.File(filename, 'a')
+    except (IOError, OSError):
+        hf = None
+        if os.path.isfile(filename):
+            try:
+                hf = h5py.File(filename, 'r')
+            except (IOError, OSError):
+                hf = None
+
+    _open_cache['filename'] = filename
+    _open_cache['file']     = hf
+
+    return hf
+
+def _cached_function_generator(name, function):
+    """
+    Wrap a field function to read from / write to the cache
+    """
+
+    field_name   = "_".join(name) if isinstance(name, tuple) else name
+    function_key = _function_hash(function)
+
+    def _cached_field(field, data):
+        grid = _data_key(data)
+        if grid is None:
+            return function(field, data)
+
+        filename = _cache_filename(data.ds)
+        hf       = _cache_file(filename)
+        if hf is None:
+            return function(field, data) # cache file unavailable
+
+        key   = _field_key(data.ds, getattr(field, 'name', name), function_key)
+        group = field_name + '/' + key
+
+        if (group + '/' + grid) in hf:
+            dset = hf[group + '/' + grid]
+            _cache_statistics['hits'] += 1
+            return data.ds.arr(dset[...], dset.attrs['units'])
+
+        _cache_statistics['misses'] += 1
+        values = function(field, data)
+
+        if hf.mode == 'r':
+            return values # opened read only - skip caching
+
+        try:
+            # remove values made with an older version of the field
+            # (once per output and field)
+            if not ((filename, field_name) in _pruned):
+                _pruned.add( (filename, field_name) )
+                if field_name in hf:
+                    for old_key in list(hf[field_name].keys()):
+                        if old_key != key:
+                            del hf[field_name + '/' + old_key]
+
+            value = values.value if hasattr(values, 'value') else np.asarray(values)
+            dset  = hf.create_dataset(group + '/' + grid, data = value,
+                                      chunks = True if np.ndim(value) > 0 else None,
+                                      compression = 'gzip' if np.ndim(value) > 0 else None)
+            dset.attrs['units'] = str(getattr(values, 'units', ''))
+            hf.flush()
+        except (IOError, OSError):
+            return values # cache file unwriteable - skip caching
+
+        # make room for this output's cache once, on its first write
+        if not (filename in _evicted_for):
+            _evicted_for.add(filename)
+            _evict(data.ds)
+
+        return values
+
+    _cached_field._field_cache          = True
+    _cached_field._field_cache_original = function
+
+    return _cached_field
+
+def _matching_fields(field_info, fields):
+    """
+    Keys in field_info matching any of the requested field names (either
+    full (ftype, fname) tuples or just fname)
+    """
+
+    matches = []
+    for k in field_info.keys():
+        if (k in fields) or (isinstance(k, tuple) and k[1] in fields):
+            matches.append(k)
+
+    return matches
+
+def enable_field_cache(fields, ds = None, max_size = None):
+    """
+    Enable the on-disk cache for the given derived fields. Applies to
+    fields defined globally (e.g. through generate_derived_fields) for all
+    data sets loaded after this call, and, if `ds` is given, to fields
+    defined on that data set.
+
+    Parameters
+    ----------
+    fields : list
+        Field names, either (ftype, fname) tuples or fname strings
+        (matching any field type)
+    ds : yt data set, optional
+        Also enable caching for fields defined on this data set only
+        (e.g. through ds.add_field). Default : None
+    max_size : float, optional
+        Maximum total size (in bytes) of all cache files in the
+        simulation directory. Default : None (no limit)
+
+    Returns
+    -------
+    cached : list
+        Field keys that caching was enabled for
+    """
+
+    _cache_settings['max_size'] = max_size
+
+    field_infos = [local_fields]
+    if not (ds is None):
+        field_infos.append(ds.field_info)
+
+    cached   = []
+    nmatched = 0
+    for field_info in field_infos:
+        for k in _matching_fields(field_info, fields):
+            derived_field = field_info[k]
+            nmatched      = nmatched + 1
+
+            if getattr(derived_field._function, '_field_cache', False):
+                continue # already cached
+
+            try:
+                function = _cached_function_generator(k, derived_field._function)
+            except TypeError as error:
+                print("Not caching ", k, ": the field function closes over values "+\
+                      "that cannot be hashed consistently (", error, ")")
+                continue
+
+            _cached_fields[(id(field_info), k)] = (field_info, derived_field._function)
+            derived_field._function = function
+            cached.append(k)
+
+    if nmatched == 0:
+        print("No defined fields matched the requested fields for caching")
+
+    return cached
+
+def disable_field_cache(fields = None):
+    """
+    Restore the original (uncached) functions of cached fields. If
+    fields is None, disables caching for all fields. Cache files are
+    not removed (but are closed).
+    """
+
+    _close_cache_file()
+
+    for (field_info_id, k) in list(_cached_fields.keys()):
+        if (fields is None) or (k in fields) or (isinstance(k, tuple) and k[1] in fields):
+            field_info, original = _cached_fields.pop( (field_info_id, k) )
+            if k in field_info:
+                field_info[k]._function = original
+
+    return
+
+def cache_statistics(reset = False):
+    """
+    Number of field values read from the cache ('hits') and computed
+    ('misses') in this session, e.g. to check that a second load of a
+    data set reads from the cache file. Counts are set to zero after
+    returning if reset is True.
+    """
+
+    statistics = dict(_cache_statistics)
+
+    if reset:
+        for k in _cache_statistics.keys():
+            _cache_statistics[k] = 0
+
+    return statistics
+
+def clear_field_cache(ds):
+    """
+    Remove the cache file for a data set
+    """
+
+    filename = _cache_filename(ds)
+    if _open_cache['filename'] == filename:
+        _close_cache_file()
+
+    if os.path.isfile(filename):
+        os.remove(filename)
+
+    return
@@ -38,6 +38,11 @@ SE_table = data_tables.StellarEvolutionData()
 
 FIELDS_DEFINED = False
 
+# derived fields defined so far in this process, keyed by the (sorted)
+# species set of the simulation. Values record whether the particle
+# fields were also defined for that species set
+_FIELD_REGISTRY = {}
+
 def _density_function_generator(asym):
     if not isinstance(asym, Iterable):
         asym = [asym]
@@ -623,16 +628,12 @@ def _particle_abundance_ratio_function_generator(ratios, ds = None):
     if not isinstance(ratios, Iterable):
         ratios = [ratios]
 
-    def return_function(ele1, ele2, field1, field2):
-        def _abundance_ratio(field, data):
-            mass1 = data[field1].value
-            mass1 = ((mass1 * data['birth_mass'].value) * yt.units.Msun).to('g')
-
-            mass2 = data[field2].value
-            mass2 = ((mass2 * data['birth_mass'].value) * yt.units.Msun).to('g')
-            ratio = convert_abundances.abundance_ratio( (ele1, mass1.value), (ele2, mass2.value), 'mass')
+    _particle_log_abundance_function_generator(_ratio_elements(ratios))
 
-            return ratio * yt.units.g / yt.units.g
+    def return_function(ele1, ele2):
+        def _abundance_ratio(field, data):
+            return data[('all','particle_' + ele1 + '_log_abundance')] -\
+                   data[('all','particle_' + ele2 + '_log_abundance')]
 
         return _abundance_ratio
 
@@ -640,12 +641,9 @@ def _particle_abundance_ratio_function_generator(ratios, ds = None):
     for r in ratios:
         ele1, ele2 = r.rsplit('/')
 
-        field1 = ('all','particle_' + ele1 + '_fraction')
-        field2 = ('all','particle_' + ele2 + '_fraction')
-
         fieldname = 'particle_' + ele1 + '_over_' + ele2
 
-        yt.add_field(('all', fieldname), function = return_function(ele1,ele2,field1,field2),
+        yt.add_field(('all', fieldname), function = return_function(ele1,ele2),
                               units = "", particle_type = True)
         nfields = nfields + 1
 
@@ -667,11 +665,22 @@ def _particle_abundance_ratio_function_generator(ratios, ds = None):
 
         return _alpha_5_over_x
 
+    # particle_alpha_abundance and particle_alpha_5_abundance are defined by
+    # _particle_abundance_function_generator (which may not have been called
+    # yet) from these species, so check for the species themselves
+    if ds is None:
+        species = _ratio_elements(ratios)
+    else:
+        species = utilities.species_from_fields(ds.field_list)
+    has_alpha   = all([x in species for x in ['O', 'Mg', 'Si']])
+    has_alpha_5 = has_alpha and all([x in species for x in ['S', 'Ca']])
+
     denoms = [x.split('/')[1] for x in ratios]
     denoms = np.unique(denoms)
-    if ('all','particle_alpha_abundance') in ds.derived_field_list:
-        for x in denoms:
+    for x in denoms:
+        if has_alpha:
             yt.add_field(('all','particle_alpha_over_' + x), function = _alpha_return_function(x), units = "", particle_type = True)
+        if has_alpha_5:
             yt.add_field(('all','particle_alpha_5_over_' + x), function = _alpha_5_return_function(x), units = "", particle_type = True)
 
 
@@ -693,76 +702,172 @@ def _particle_abundance_ratio_function_generator(ratios, ds = None):
 
     return nfields
 
-#
-# Construct arbitrary abundance ratio fields in yt
-# using a function generator
-#
-def _abundance_ratio_function_generator(ratios, metals, H_mode = 'total'):
+def _H_density(data, mode = 'total'):
+    """
+    Hydrogen mass density (in g/cm**3). mode is 'total' (all H
+    species), 'HI', or 'HII'.
+    """
 
-    if not isinstance(ratios, Iterable):
-        ratios = [ratios]
+    if mode == 'total':
+        dens = data[('enzo','HI_Density')] + data[('enzo','HII_Density')]
 
-    def _H_mass(data, mode):
+        if ('enzo','H2I_Density') in data.ds.field_list:
+            dens += data[('enzo','HM_Density')] + data[('enzo','H2I_Density')] +\
+                    data[('enzo','H2II_Density')]
 
-        if mode == 'total':
-            mass = data[('enzo','HI_Density')] + data[('enzo','HII_Density')]
+    elif mode == 'HI':
+        dens = data[('enzo','HI_Density')]
+    elif mode == 'HII':
+        dens = data[('enzo','HII_Density')]
 
-            if ('enzo','H2I_Density') in data.ds.field_list:
-                mass += data[('enzo','HM_Density')] + data[('enzo','H2I_Density')] +\
-                        data[('enzo','H2II_Density')]
+    return dens.to('g/cm**3')
 
-        elif mode == 'HI':
-            mass = data[('enzo','HI_Density')]
-        elif mode == 'HII':
-            mass = data[('enzo','HII_Denisty')]
+def _gas_log_abundance(data, element, H_mode = 'total'):
+    """
+    log10(n_x) - log(e_x)_sun for element in each cell, from the
+    element's mass density
+    """
 
-        return mass
+    if element == 'H':
+        dens = _H_density(data, H_mode)
+    elif element == 'He':
+        dens = data[('gas','He_density')].to('g/cm**3')
+    else:
+        dens = data[('enzo', element + '_Density')].value * data.ds.mass_unit / data.ds.length_unit**3
+        dens = dens.to('g/cm**3')
 
-    def return_function(ele1, ele2, field1, field2):
-        def _abundance_ratio(field, data):
+    return convert_abundances.log_abundance(element, dens.value, 'mass')
 
-            if ele1 == 'H':
-                mass1 = _H_mass(data, H_mode)
-            else:
-                mass1 = data[field1]
+def _particle_log_abundance(data, element):
+    """
+    log10(N_x) - log(e_x)_sun for element in each particle, from the
+    particle's element mass fraction and birth mass
+    """
 
-            if ele1 != 'H' and ele1 != 'He':
-                mass1 = mass1.value * data.ds.mass_unit / data.ds.length_unit**3
-            mass1 = (mass1 * data['cell_volume']).to('g')
+    mass = data[('all','particle_' + element + '_fraction')].value * data['birth_mass'].value
+    mass = (mass * yt.units.Msun).to('g')
 
-            if ele2 == 'H':
-                mass2 = _H_mass(data, H_mode)
-            else:
-                mass2 = data[field2]
+    return convert_abundances.log_abundance(element, mass.value, 'mass')
 
-            if ele2 != 'H' and  ele2 != 'He':
-                mass2 = mass2.value * data.ds.mass_unit / data.ds.length_unit**3
-            mass2 = (mass2 * data['cell_volume']).to('g')
+def _log_abundance_function_generator(asym, H_mode = 'total'):
+    """
+    Define ('gas', x + '_log_abundance') fields: log10(n_x) - log(e_x)_sun.
+    Abundance ratio fields are differences of these, so each element's
+    density is read and converted only once per chunk.
+    """
 
-            ratio = convert_abundances.abundance_ratio( (ele1, mass1.value), (ele2, mass2.value), 'mass')
+    if not isinstance(asym, Iterable):
+        asym = [asym]
 
-            return ratio * yt.units.g / yt.units.g
+    def return_function(a):
+        def _log_abundance(field, data):
+            return _gas_log_abundance(data, a, H_mode) * yt.units.g / yt.units.g
 
-        return _abundance_ratio
+        return _log_abundance
 
-    nfields = 0
+    for a in asym:
+        yt.add_field(('gas', a + '_log_abundance'), sampling_type = 'cell',
+                     function = return_function(a), units = "")
+
+    return
+
+def _particle_log_abundance_function_generator(asym):
+    """
+    Define ('all', 'particle_' + x + '_log_abundance') fields, as in
+    _log_abundance_function_generator for particles
+    """
+
+    if not isinstance(asym, Iterable):
+        asym = [asym]
+
+    def return_function(a):
+        def _log_abundance(field, data):
+            return _particle_log_abundance(data, a) * yt.units.g / yt.units.g
+
+        return _log_abundance
+
+    for a in asym:
+        yt.add_field(('all', 'particle_' + a + '_log_abundance'), function = return_function(a),
+                     units = "", particle_type = True)
+
+    return
+
+def _ratio_elements(ratios):
+    """
+    Unique element names in a list of ratios
+    """
+
+    elements = []
     for r in ratios:
+        for e in r.split('/'):
+            if not (e in elements):
+                elements.append(e)
 
-        ele1, ele2 = r.rsplit('/')
+    return elements
 
-        if ele1 != 'H' and ele2 != 'He':
-            field1 = ('enzo', ele1 + '_Density')
-        else:
-            field1 = ('gas', ele1 + '_density')
+def abundance_ratios(data, ratios, H_mode = 'total', particles = False):
+    """
+    Compute many abundance ratios at once for a data object (e.g. a
+    region or data set's all_data()). Each element's density (or
+    particle mass fraction) is read and converted to a log abundance
+    only once, and each ratio is a subtraction of these.
+
+    Parameters
+    ----------
+    data : yt data object
+        Data to compute ratios for
+    ratios : list
+        Ratio names, e.g. ['Fe/H', 'O/Fe']
+    H_mode : str, optional
+        Which H species to include for ratios with H ('total', 'HI',
+        or 'HII'). Gas only. Default : 'total'
+    particles : bool, optional
+        Compute ratios for star particles instead of gas cells.
+        Default : False
+
+    Returns
+    -------
+    aratios : np.ndarray
+        Abundance ratios, shape (len(ratios), number of cells / particles)
+    """
 
-        if ele2 != 'H' and ele2 != 'He':
-            field2 = ('enzo', ele2 + '_Density')
+    if isinstance(ratios, str):
+        ratios = [ratios]
+
+    log_abundances = {}
+    for e in _ratio_elements(ratios):
+        if particles:
+            log_abundances[e] = _particle_log_abundance(data, e)
         else:
-            field2 = ('gas', ele2 + '_density')
+            log_abundances[e] = _gas_log_abundance(data, e, H_mode)
+
+    return convert_abundances.abundance_ratios(log_abundances, ratios)
+
+#
+# Construct arbitrary abundance ratio fields in yt
+# using a function generator
+#
+def _abundance_ratio_function_generator(ratios, metals, H_mode = 'total'):
+
+    if not isinstance(ratios, Iterable):
+        ratios = [ratios]
+
+    _log_abundance_function_generator(_ratio_elements(ratios), H_mode)
+
+    def return_function(ele1, ele2):
+        def _abundance_ratio(field, data):
+            return data[('gas', ele1 + '_log_abundance')] - data[('gas', ele2 + '_log_abundance')]
+
+        return _abundance_ratio
+
+    nfields = 0
+    for r in ratios:
+
+        ele1, ele2 = r.rsplit('/')
 
         fieldname = ele1 + '_over_' + ele2
 
-        yt.add_field(('gas', fieldname), function = return_function(ele1,ele2,field1,field2),
+        yt.add_field(('gas', fieldname), function = return_function(ele1,ele2),
                               units = "", sampling_type = 'cell')
         nfields = nfields + 1
 
@@ -820,15 +925,11 @@ def generate_stellar_model_fields(ds):
 
     def _function_generator(field_name):
         def _function(field, data):
-            if np.size(data[(field.name[0],'particle_mass')]) == 1:
-                # this is ugly, but a way to bypass yt's validation step
-                # because throwing junk values into the routine below will cause problems
-                with utilities.nostdout():
-                    p = star_analysis.get_star_property(ds, data, property_names = [field_name],
-                                                            dummy_call = True, overload_type = None)
-            else:
-                p = star_analysis.get_star_property(ds, data, property_names = [field_name],
-                                                        overload_type = overload_type[field_name] )
+            # all model properties are evaluated at once for every particle and
+            # cached, so each additional particle_model_ field is a lookup
+            p = star_analysis.compute_star_properties(ds, data, property_names = field_name,
+                                                      overload_type = overload_type[field_name],
+                                                      ptype = field.name[0])
             p = p * units[field_name]
 
             return p
@@ -867,23 +968,30 @@ def generate_stellar_model_fields(ds):
 
     def _lifetime(field, data):
         ptname = field.name[0]
-        m = data[(ptname,'birth_mass')].value
-        z = data[(ptname,'metallicity_fraction')].value
-        ispopiii = data[(ptname,'particle_is_popiii')]
+        m = np.atleast_1d(data[(ptname,'birth_mass')].value)
+        z = np.atleast_1d(data[(ptname,'metallicity_fraction')].value)
+        ispopiii = np.atleast_1d(data[(ptname,'particle_is_popiii')]).astype(bool)
 
-        if np.size(m) == 1:  # get around yt's checking
-            lt = np.shape(m)
-        else:
-            lt = np.zeros(np.size(m))
-            for i in np.arange(np.size(m)):
-                if m[i] < 0 and z[i] < 0:
-                    lt[i] = 0.0
-                elif ispopiii[i]:
-                    lt[i] = (physics.popIII_lifetime(m[i]) * yt.units.yr).to('Myr').value
-                else:
-                    lt[i] = SE_table.interpolate({'mass' : m[i], 'metallicity' : z[i]}, 'lifetime')
-                    lt[i] = (lt[i] * yt.units.s).to('Myr').value
+        # batched lookup: bilinear (M,Z) table interpolation for popII and
+        # nearest tabulated mass for popIII, for all particles at once.
+        # Agreement with SE_table is checked in misc/benchmarks.py
+        # (benchmark_star_properties). Masses outside the table, which
+        # the interpolation would clamp, use SE_table
+        lt = star_analysis.interpolate_stellar_properties(m, z, ['lifetime'])['lifetime']
+
+        mass_range = star_analysis.table_mass_range()
+        use_se     = np.logical_not(ispopiii) * ((m < mass_range[0]) + (m > mass_range[1]))
+        use_se     = use_se * np.logical_not((m < 0) * (z < 0))
 
+        for i in np.where(use_se)[0]:
+            lt[i] = SE_table.interpolate({'mass' : m[i], 'metallicity' : z[i]}, 'lifetime')
+
+        lt = (lt * yt.units.s).to('Myr').value
+
+        if np.any(ispopiii):
+            lt[ispopiii] = (physics.popIII_lifetime(m[ispopiii]) * yt.units.yr).to('Myr').value
+
+        lt[(m < 0) * (z < 0)] = 0.0
 
         return lt * yt.units.Myr
 
@@ -1384,9 +1492,46 @@ def generate_derived_fields(ds):
 
     #generate_grackle_fields(ds)
 
+    global FIELDS_DEFINED
     FIELDS_DEFINED = True
+
+    key = _field_registry_key(ds)
+    _FIELD_REGISTRY[key] = _FIELD_REGISTRY.get(key, False) or (ds.parameters['NumberOfParticles'] > 0)
+
     return
 
+def _field_registry_key(ds):
+    return tuple(sorted(utilities.species_from_fields(ds.field_list, include_primordial = True)))
+
+def derived_fields_defined(ds):
+    """
+    True if the derived fields needed for this data set have already
+    been defined in this process (for the same species set, including
+    particle fields if the data set has particles).
+    """
+
+    key = _field_registry_key(ds)
+
+    if not (key in _FIELD_REGISTRY):
+        return False
+
+    return _FIELD_REGISTRY[key] or (not (ds.parameters['NumberOfParticles'] > 0))
+
+def define_derived_fields(ds):
+    """
+    Define the derived fields for this data set if they are not already
+    defined in this process. Returns True if new fields were defined, in
+    which case data sets loaded before this call (including ds) need
+    to be reloaded to see them.
+    """
+
+    if derived_fields_defined(ds):
+        return False
+
+    generate_derived_fields(ds)
+
+    return True
+
 
 
 def load_and_define(name):
@@ -1399,10 +1544,9 @@ def load_and_define(name):
 
     ds = yt.load(name)
 
-    if not FIELDS_DEFINED:
-        generate_derived_fields(ds)
+    # only reload if fields had to be defined for this species set
+    if define_derived_fields(ds):
         ds = yt.load(name)
-        generate_derived_fields(ds)
 
     gradient_available = generate_gradient_fields(ds)
 